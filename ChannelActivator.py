@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+
+IDLE_TIMEOUT = 1800
+POLL_INTERVAL = 60
+BATCH_SIZE = 100
+WORKERS = 4
+
+# Brings dormant channels up and puts idle ones back to sleep. A dormant handler
+# holds no writer thread, open database, n-gram model or completion pool. It is
+# activated when its chat gets busy, when it is mentioned, or when the stream
+# goes live, and released again once it has been quiet for idle_timeout seconds
+# while offline. An idle_timeout of 0 keeps every channel active from the start.
+class ChannelActivator():
+
+    def __init__(self, get_twitch, idle_timeout=IDLE_TIMEOUT, poll_interval=POLL_INTERVAL, workers=WORKERS, logger=None):
+        self.get_twitch = get_twitch
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.enabled = idle_timeout > 0
+        self.logger = logger if logger else logging.getLogger('retroBot.activation')
+        self.lock = Lock()
+        self.handlers = {}
+        self.pending = set()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='activation')
+        self.stats = {
+            'activations': 0,
+            'deactivations': 0,
+            'live_polls': 0,
+            'live_poll_failures': 0,
+        }
+        if self.enabled:
+            self.thread = Thread(target=self.checkLoop, name='channel_activator', daemon=True)
+            self.thread.start()
+
+    def register(self, handler):
+        with self.lock:
+            self.handlers[handler.channel] = handler
+
+    # Activation opens the database and may load a large model, so it runs on
+    # the pool rather than on the IRC thread that noticed the traffic.
+    def activate(self, handler, reason):
+        with self.lock:
+            if handler.channel in self.pending:
+                return
+            self.pending.add(handler.channel)
+        self.pool.submit(self.runTransition, handler, handler.activate, reason, 'activations')
+
+    def deactivate(self, handler, reason):
+        with self.lock:
+            if handler.channel in self.pending:
+                return
+            self.pending.add(handler.channel)
+        self.pool.submit(self.runTransition, handler, handler.deactivate, reason, 'deactivations')
+
+    def runTransition(self, handler, transition, reason, stat):
+        start = time.perf_counter()
+        try:
+            changed = transition()
+        except Exception as e:
+            handler.logger.error(f'Could not {transition.__name__} channel: {e}')
+            changed = False
+        finally:
+            with self.lock:
+                self.pending.discard(handler.channel)
+        if changed:
+            handler.logger.info(f'Ran {transition.__name__} ({reason}) in {time.perf_counter() - start:.3f} s')
+            with self.lock:
+                self.stats[stat] += 1
+
+    # One get_streams call covers up to 100 channels.
+    def pollLive(self, handlers):
+        user_ids = [handler.user_id for handler in handlers if handler.user_id]
+        live = set()
+        twitch = self.get_twitch()
+        for start in range(0, len(user_ids), BATCH_SIZE):
+            for stream in twitch.get_streams(user_id=user_ids[start:start + BATCH_SIZE], first=BATCH_SIZE)['data']:
+                live.add(stream['user_id'])
+        with self.lock:
+            self.stats['live_polls'] += 1
+        return live
+
+    def check(self):
+        with self.lock:
+            handlers = list(self.handlers.values())
+        try:
+            live = self.pollLive(handlers)
+        except Exception as e:
+            with self.lock:
+                self.stats['live_poll_failures'] += 1
+            self.logger.warning(f'Could not check which streams are live: {e}')
+            live = None
+        now = time.monotonic()
+        for handler in handlers:
+            if live != None:
+                handler.live = handler.user_id in live
+            if handler.live and not handler.active and now >= handler.activation_retry_at:
+                self.activate(handler, 'stream live')
+            elif handler.active and not handler.live and now - handler.last_activity >= self.idle_timeout:
+                self.deactivate(handler, f'idle for {now - handler.last_activity:.0f} s')
+
+    def checkLoop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.check()
+            except Exception as e:
+                self.logger.error(f'Channel activation check failed: {e}')
+            stats = self.getStats()
+            self.logger.debug(f"{stats['active']} of {stats['channels']} channels active, {stats['threads']} threads")
+
+    def getResources(self):
+        with self.lock:
+            handlers = list(self.handlers.values())
+        return [handler.getResources() for handler in handlers]
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            handlers = list(self.handlers.values())
+        stats['channels'] = len(handlers)
+        stats['active'] = sum(1 for handler in handlers if handler.active)
+        stats['live'] = sum(1 for handler in handlers if handler.live)
+        stats['threads'] = threading.active_count()
+        return stats
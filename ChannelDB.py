@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import MessageStore
+
+# Also created on its own for the upload cache of files sent by hand
+UPLOADS_TABLE = 'create table if not exists uploads(hash TEXT NOT NULL PRIMARY KEY, file_id TEXT NOT NULL, kind TEXT NOT NULL, bytes INTEGER NOT NULL, start_row INTEGER, end_row INTEGER, created TIMESTAMP NOT NULL, last_used TIMESTAMP NOT NULL)'
+# Bump when SCHEMA changes. Databases already at this version skip schema setup.
+SCHEMA_VERSION = 5
+SCHEMA = (
+    'create table if not exists segments(segment INTEGER NOT NULL PRIMARY KEY, first_row INTEGER NOT NULL, created TIMESTAMP NOT NULL)',
+    'create table if not exists models(iteration INTEGER NOT NULL PRIMARY KEY, date TIMESTAMP NOT NULL, message_count INTEGER NOT NULL, model TEXT NOT NULL)',
+    'create table if not exists fine_tunes(id INTEGER NOT NULL PRIMARY KEY, file_id TEXT NOT NULL, job_id TEXT, state TEXT NOT NULL, cutoff_row INTEGER NOT NULL, message_count INTEGER NOT NULL, created TIMESTAMP NOT NULL, updated TIMESTAMP NOT NULL, validation_file_id TEXT)',
+    'create table if not exists state(key TEXT NOT NULL PRIMARY KEY, value INTEGER NOT NULL)',
+    'create table if not exists hash_counts(hash BLOB NOT NULL, segment INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (hash, segment)) without rowid',
+    UPLOADS_TABLE,
+)
+# Tables replaced by a different layout. message_hashes counted every message
+# ever seen; hash_counts keeps the counts per segment.
+DROPPED_TABLES = ('message_hashes',)
+# Columns added to a table after its first release, as (table, column, definition)
+COLUMNS = (
+    ('fine_tunes', 'validation_file_id', 'TEXT'),
+)
+
+sqlite3.register_adapter(bool, int)
+sqlite3.register_converter("BOOLEAN", lambda v: bool(int(v)))
+
+def messageDir(config):
+    return config['gpt'].get('message_dir') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'messages')
+
+def channelDBFile(config, channel):
+    return os.path.join(messageDir(config), f'{channel.lower()}.db')
+
+def ngramFile(config, channel):
+    return os.path.join(messageDir(config), f'{channel.lower()}.ngram')
+
+def uploadCacheFile(config):
+    return os.path.join(messageDir(config), 'uploads.db')
+
+def archiveDir(config, channel):
+    return os.path.join(messageDir(config), 'archive', channel.lower())
+
+# auto_vacuum only takes effect on an existing file after a full vacuum, so
+# databases created before it was set pay for one rewrite during the upgrade.
+# The vacuum runs after the migration, once every message row has an explicit id.
+def openChannelDB(db_file, db_timeout=10):
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    connection = sqlite3.connect(db_file, timeout=db_timeout)
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA user_version')
+    if cursor.fetchone()[0] < SCHEMA_VERSION:
+        cursor.execute("select count(*) from sqlite_master where type = 'table'")
+        existing = cursor.fetchone()[0] > 0
+        cursor.execute('PRAGMA auto_vacuum')
+        rewrite = existing and cursor.fetchone()[0] != 2
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        for table in DROPPED_TABLES:
+            cursor.execute(f'drop table if exists {table}')
+        for table, column, definition in COLUMNS:
+            cursor.execute(f'PRAGMA table_info({table})')
+            if column not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute(f'alter table {table} add column {column} {definition}')
+        MessageStore.migrate(connection)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        connection.commit()
+        if rewrite:
+            cursor.execute('vacuum')
+    cursor.close()
+    return connection
+
+def prepareChannelDB(db_file, db_timeout=10):
+    openChannelDB(db_file, db_timeout).close()
+
+# The upload cache for files sent by hand, which have no channel behind them
+def prepareUploadDB(db_file, db_timeout=10):
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    connection = sqlite3.connect(db_file, timeout=db_timeout)
+    connection.execute(UPLOADS_TABLE)
+    connection.commit()
+    connection.close()
@@ -0,0 +1,86 @@
+import logging
+from collections import deque
+from threading import Thread, Lock
+
+class CompletionPool():
+
+    def __init__(self, fetch, size=20, low_water=5, name='completion_pool', logger=None):
+        self.fetch = fetch
+        self.size = size
+        self.low_water = low_water
+        self.name = name
+        self.logger = logger if logger else logging.getLogger(f'retroBot.{name}')
+        self.lock = Lock()
+        self.model = None
+        self.generation = 0
+        self.completions = deque()
+        self.refilling = False
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'refills': 0,
+            'refill_failures': 0,
+            'discarded': 0,
+        }
+
+    # Completions from the previous model are dropped in the same step that
+    # switches models, and refills started before the switch are discarded.
+    def setModel(self, model):
+        with self.lock:
+            self.model = model
+            self.generation += 1
+            self.stats['discarded'] += len(self.completions)
+            self.completions = deque()
+        self.refill()
+
+    def take(self):
+        with self.lock:
+            if self.completions:
+                completion = self.completions.popleft()
+                self.stats['hits'] += 1
+            else:
+                completion = None
+                self.stats['misses'] += 1
+            low = len(self.completions) <= self.low_water
+        if low:
+            self.refill()
+        return completion
+
+    def refill(self):
+        with self.lock:
+            if self.refilling or self.size <= 0 or self.model == None:
+                return
+            self.refilling = True
+            generation = self.generation
+            model = self.model
+            count = self.size - len(self.completions)
+        Thread(target=self.refillPool, args=(generation, model, count), name=f'{self.name}_refill', daemon=True).start()
+
+    def refillPool(self, generation, model, count):
+        try:
+            completions = self.fetch(model, count)
+        except Exception as e:
+            self.logger.warning(f'Could not refill the completion pool: {e}')
+            completions = None
+        with self.lock:
+            self.refilling = False
+            stale = generation != self.generation
+            if completions == None:
+                self.stats['refill_failures'] += 1
+            elif not stale:
+                self.completions.extend(completions)
+                self.stats['refills'] += 1
+            else:
+                self.stats['discarded'] += len(completions)
+        # A setModel during the fetch found this refill running and started none
+        # for the new model, so it is started here.
+        if stale:
+            self.refill()
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.completions)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,133 @@
+import sqlite3
+import tempfile
+import json
+import hashlib
+import heapq
+import logging
+import random
+import re
+import time
+import MessageStore
+
+PAGE_SIZE = MessageStore.PAGE_SIZE
+SPOOL_SIZE = 8 * 1024 * 1024
+SAMPLING_STRATEGIES = ('recency', 'weighted')
+# Prompt separator and end of completion, charged to every example
+EXAMPLE_OVERHEAD = 2
+TOKEN_PATTERN = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+")
+
+def iterRows(db_file, db_timeout=10, start_row=0, end_row=None, page_size=PAGE_SIZE):
+    connection = sqlite3.connect(db_file, timeout=db_timeout)
+    try:
+        yield from MessageStore.iterRows(connection, start_row, end_row, page_size)
+    finally:
+        connection.close()
+
+def getLastRow(db_file, db_timeout=10):
+    connection = sqlite3.connect(db_file, timeout=db_timeout)
+    last_row = MessageStore.lastRow(connection)
+    connection.close()
+    return last_row
+
+def encodeExample(encoder, message):
+    return encoder.encode({'prompt': '\n', 'completion': message}).encode('utf-8') + b'\n'
+
+def writeJSONL(rows, out):
+    encoder = json.JSONEncoder()
+    count = 0
+    for row in rows:
+        out.write(encodeExample(encoder, row[1]))
+        count += 1
+    return count
+
+def spoolDataSet(rows, max_size=SPOOL_SIZE):
+    out = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+b')
+    count = writeJSONL(rows, out)
+    out.seek(0)
+    return out, count
+
+# Approximates the GPT-3 BPE token count without the tokenizer: split the way
+# its pre-tokenizer does, then charge about one token per four characters.
+def estimateTokens(text):
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PATTERN.findall(text))
+
+class DataSetBuilder():
+
+    def __init__(self, token_budget=0, sampling='recency', validation_fraction=0.0, seed=0, min_words=2, min_chars=4, logger=None):
+        if sampling not in SAMPLING_STRATEGIES:
+            raise ValueError(f'Unknown sampling strategy "{sampling}". Must be one of: {", ".join(SAMPLING_STRATEGIES)}')
+        self.token_budget = token_budget
+        self.sampling = sampling
+        self.validation_fraction = validation_fraction
+        self.seed = seed
+        self.min_words = min_words
+        self.min_chars = min_chars
+        self.logger = logger if logger else logging.getLogger('retroBot.dataset')
+
+    def distinctWords(self, message):
+        return len({word.lower() for word in message.split()})
+
+    def filterRows(self, rows, stats):
+        for id, message in rows:
+            stats['rows_seen'] += 1
+            words = self.distinctWords(message)
+            if len(message.strip()) < self.min_chars or words < self.min_words:
+                stats['low_information_rows'] += 1
+                continue
+            yield id, message, estimateTokens(message) + EXAMPLE_OVERHEAD, words
+
+    # Keeps the highest keyed rows that fit the budget in a heap. Recency keys on
+    # the row id; weighted draws a seeded Efraimidis-Spirakis key so rows with
+    # more distinct words are more likely to be kept.
+    def sample(self, rows, rng, stats):
+        heap = []
+        total = 0
+        for id, message, tokens, words in rows:
+            key = id if self.sampling == 'recency' else rng.random() ** (1.0 / words)
+            heapq.heappush(heap, (key, id, message, tokens))
+            total += tokens
+            while total > self.token_budget:
+                total -= heapq.heappop(heap)[3]
+                stats['over_budget_rows'] += 1
+        for key, id, message, tokens in sorted(heap, key=lambda entry: entry[1]):
+            yield id, message, tokens, None
+
+    # Returns (training file, validation file or None, stats). Without a token
+    # budget rows stream straight through to the spooled files. Each file's
+    # SHA-256 is taken as it is written, for the upload cache.
+    def build(self, rows, max_size=SPOOL_SIZE):
+        start = time.perf_counter()
+        stats = dict.fromkeys(('rows_seen', 'low_information_rows', 'over_budget_rows', 'training_rows', 'validation_rows', 'tokens', 'training_bytes', 'validation_bytes'), 0)
+        rng = random.Random(self.seed)
+        selected = self.filterRows(rows, stats)
+        if self.token_budget:
+            selected = self.sample(selected, rng, stats)
+        encoder = json.JSONEncoder()
+        training = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+b')
+        validation = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+b') if self.validation_fraction else None
+        training_hash = hashlib.sha256()
+        validation_hash = hashlib.sha256()
+        for id, message, tokens, words in selected:
+            example = encodeExample(encoder, message)
+            if validation != None and rng.random() < self.validation_fraction:
+                validation.write(example)
+                validation_hash.update(example)
+                stats['validation_rows'] += 1
+                stats['validation_bytes'] += len(example)
+            else:
+                training.write(example)
+                training_hash.update(example)
+                stats['training_rows'] += 1
+                stats['training_bytes'] += len(example)
+            stats['tokens'] += tokens
+        if validation != None and stats['validation_rows'] == 0:
+            validation.close()
+            validation = None
+        training.seek(0)
+        if validation != None:
+            validation.seek(0)
+        stats['training_hash'] = training_hash.hexdigest()
+        stats['validation_hash'] = validation_hash.hexdigest() if validation != None else None
+        stats['seconds'] = time.perf_counter() - start
+        stats['rows_per_second'] = stats['rows_seen'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+        return training, validation, stats
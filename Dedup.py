@@ -0,0 +1,205 @@
+import hashlib
+import zlib
+import random
+from collections import OrderedDict
+from threading import Lock
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+def normalize(message):
+    return ' '.join(message.lower().split())
+
+class MinHashIndex():
+
+    def __init__(self, num_perm=32, bands=8, shingle_size=3, max_signatures=20000, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError(f'num_perm ({num_perm}) must be divisible by bands ({bands})')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_signatures = max_signatures
+        rng = random.Random(seed)
+        self.a = rng.randrange(1, MERSENNE_PRIME)
+        self.b = rng.randrange(0, MERSENNE_PRIME)
+        self.signatures = OrderedDict()
+        self.buckets = {}
+        self.next_id = 0
+
+    # One-permutation MinHash: each shingle is hashed once and lands in one of
+    # num_perm bins, keeping the minimum per bin. Empty bins borrow from the next
+    # filled bin so short messages still produce comparable signatures.
+    def signature(self, text):
+        size = self.shingle_size
+        shingles = {zlib.crc32(text[i:i + size].encode('utf-8')) for i in range(len(text) - size + 1)}
+        if not shingles:
+            return None
+        num_perm = self.num_perm
+        a = self.a
+        b = self.b
+        bins = [None] * num_perm
+        for shingle in shingles:
+            value, index = divmod((a * shingle + b) % MERSENNE_PRIME, num_perm)
+            if bins[index] == None or value < bins[index]:
+                bins[index] = value
+        for index in range(num_perm):
+            if bins[index] == None:
+                offset = 1
+                while bins[(index + offset) % num_perm] == None:
+                    offset += 1
+                bins[index] = (bins[(index + offset) % num_perm], offset)
+        return tuple(bins)
+
+    def bandKeys(self, signature):
+        rows = self.rows
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def query(self, signature, threshold):
+        candidates = set()
+        for key in self.bandKeys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        best = None
+        best_similarity = threshold
+        for candidate in candidates:
+            other = self.signatures[candidate][0]
+            similarity = sum(1 for x, y in zip(signature, other) if x == y) / self.num_perm
+            if similarity >= best_similarity:
+                best = candidate
+                best_similarity = similarity
+        return best
+
+    def add(self, signature):
+        signature_id = self.next_id
+        self.next_id += 1
+        self.signatures[signature_id] = [signature, 1]
+        for key in self.bandKeys(signature):
+            self.buckets.setdefault(key, set()).add(signature_id)
+        while len(self.signatures) > self.max_signatures:
+            self.evict()
+        return signature_id
+
+    def evict(self):
+        signature_id, (signature, count) = self.signatures.popitem(last=False)
+        for key in self.bandKeys(signature):
+            bucket = self.buckets.get(key)
+            if bucket != None:
+                bucket.discard(signature_id)
+                if not bucket:
+                    del self.buckets[key]
+
+    # Returns how many times the phrase has been seen, including this one.
+    def observe(self, text, threshold):
+        signature = self.signature(text)
+        if signature == None:
+            return 1
+        match = self.query(signature, threshold)
+        if match == None:
+            self.add(signature)
+            return 1
+        entry = self.signatures[match]
+        entry[1] += 1
+        self.signatures.move_to_end(match)
+        return entry[1]
+
+# Counts are kept per message segment, which is what one fine tune trains on, so
+# the phrase cap applies to each dataset rather than to the whole history.
+# Segments that have been trained on and dropped take their counts with them.
+def pruneCounts(connection, segments):
+    connection.executemany('delete from hash_counts where segment = ?', [(segment,) for segment in segments])
+
+class Deduplicator():
+
+    def __init__(self, phrase_cap=3, near_threshold=0.8, max_signatures=20000):
+        self.phrase_cap = phrase_cap
+        self.near_threshold = near_threshold
+        self.max_signatures = max_signatures
+        self.index = MinHashIndex(max_signatures=max_signatures)
+        self.segment = None
+        self.lock = Lock()
+        self.stats = {
+            'seen': 0,
+            'exact_removed': 0,
+            'near_removed': 0,
+        }
+
+    def initDB(self, connection):
+        cursor = connection.cursor()
+        cursor.execute("select key, value from state where key in ('dedup_seen', 'dedup_exact_removed', 'dedup_near_removed')")
+        with self.lock:
+            for key, value in cursor.fetchall():
+                self.stats[key[len('dedup_'):]] = value
+        cursor.close()
+
+    # Runs on the writer thread inside the batch's transaction, so the hash
+    # counts and the inserted rows are committed together. segment is the one
+    # the kept rows are written to.
+    def filterBatch(self, connection, messages, segment=0):
+        kept, record = self.checkBatch(connection, messages, segment)
+        record(connection)
+        return kept
+
+    # Decides which messages to keep without writing anything. Returns them with
+    # a function that records the new counts and stats, which the caller runs in
+    # the transaction that inserts the rows. Counts are added to what is stored
+    # then, so a bulk import checking outside the write lock does not lose
+    # copies the bot wrote in the meantime. The function may be run again after
+    # a rolled back transaction without counting the batch twice.
+    def checkBatch(self, connection, messages, segment=0):
+        # Near-duplicate counts start over with each segment, like the exact ones
+        if segment != self.segment:
+            if self.segment != None:
+                self.index = MinHashIndex(max_signatures=self.max_signatures)
+            self.segment = segment
+        cursor = connection.cursor()
+        counts = {}
+        stored = {}
+        kept = []
+        exact_removed = 0
+        near_removed = 0
+        for message in messages:
+            text = normalize(message)
+            digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+            if digest not in counts:
+                cursor.execute('select count from hash_counts where hash = ? and segment = ?', (digest, segment))
+                row = cursor.fetchone()
+                counts[digest] = row[0] if row else 0
+                stored[digest] = counts[digest]
+            counts[digest] += 1
+            if counts[digest] > self.phrase_cap:
+                exact_removed += 1
+            elif counts[digest] == 1 and self.index.observe(text, self.near_threshold) > self.phrase_cap:
+                # Later exact copies of a suppressed variant are suppressed too
+                counts[digest] = self.phrase_cap
+                near_removed += 1
+            else:
+                kept.append(message)
+        cursor.close()
+
+        counted = []
+
+        def record(connection):
+            cursor = connection.cursor()
+            cursor.executemany(
+                'insert into hash_counts values (?, ?, ?) on conflict(hash, segment) do update set count = count + excluded.count',
+                [(digest, segment, count - stored[digest]) for digest, count in counts.items()]
+            )
+            with self.lock:
+                if not counted:
+                    self.stats['seen'] += len(messages)
+                    self.stats['exact_removed'] += exact_removed
+                    self.stats['near_removed'] += near_removed
+                    counted.append(True)
+                stats = [(f'dedup_{key}', value) for key, value in self.stats.items()]
+            cursor.executemany('insert or replace into state values (?, ?)', stats)
+            cursor.close()
+
+        return kept, record
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        removed = stats['exact_removed'] + stats['near_removed']
+        stats['removed'] = removed
+        stats['removed_ratio'] = removed / stats['seen'] if stats['seen'] else 0.0
+        stats['signatures'] = len(self.index.signatures)
+        return stats
@@ -0,0 +1,224 @@
+import sys
+import io
+import time
+import random
+import itertools
+import collections
+from threading import Lock
+
+# A local stand-in for the parts of the openai 0.x module this project uses.
+# install() swaps it into sys.modules so `import openai` picks it up, letting
+# the bot run offline with injectable latency and failures.
+
+api_key = None
+
+class OpenAIError(Exception):
+
+    def __init__(self, message=None, http_status=None, headers=None):
+        super().__init__(message)
+        self.http_status = http_status
+        self.headers = headers or {}
+
+class APIError(OpenAIError):
+    pass
+
+class Timeout(OpenAIError):
+    pass
+
+class RateLimitError(OpenAIError):
+    pass
+
+class InvalidRequestError(OpenAIError):
+    pass
+
+class error():
+    OpenAIError = OpenAIError
+    APIError = APIError
+    Timeout = Timeout
+    RateLimitError = RateLimitError
+    InvalidRequestError = InvalidRequestError
+
+class OpenAIObject(dict):
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class FakeState():
+
+    # rate_limit_rate injects 429s at random. rate_limit allows that many requests
+    # in any rate_window seconds, like the real per-minute limits. Both answer
+    # with a Retry-After header.
+    def __init__(self, latency=0.0, failure_rate=0.0, training_polls=2, seed=0, rate_limit_rate=0.0, rate_limit=0, rate_window=60, retry_after=1):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.retry_after = retry_after
+        self.recent = collections.deque()
+        self.training_polls = training_polls
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.fine_tunes = {}
+        self.calls = {}
+
+    def call(self, name):
+        now = time.monotonic()
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            while self.recent and self.recent[0] <= now - self.rate_window:
+                self.recent.popleft()
+            if self.rate_limit and len(self.recent) >= self.rate_limit:
+                limited = min(self.retry_after, self.recent[0] + self.rate_window - now)
+            elif self.random.random() < self.rate_limit_rate:
+                limited = self.retry_after
+            else:
+                limited = None
+                self.recent.append(now)
+            fail = self.random.random() < self.failure_rate
+        if limited != None:
+            with self.lock:
+                self.calls['rate_limited'] = self.calls.get('rate_limited', 0) + 1
+            raise RateLimitError(f'Rate limit reached in {name}', http_status=429, headers={'retry-after': f'{limited:.3f}'})
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise APIError(f'Injected failure in {name}', http_status=500)
+
+    def nextId(self, prefix):
+        with self.lock:
+            return f'{prefix}-{next(self.ids)}'
+
+state = FakeState()
+
+def reset(**kwargs):
+    global state
+    state = FakeState(**kwargs)
+    return state
+
+class Completion():
+
+    @staticmethod
+    def create(model, max_tokens=16, stop=None, n=1, **kwargs):
+        state.call('Completion.create')
+        words = ['fake', 'chat', 'line', 'from', model]
+        choices = [OpenAIObject(text=' '.join(state.random.choices(words, k=min(max_tokens, 8))), index=i, finish_reason='stop') for i in range(n)]
+        return OpenAIObject(id=state.nextId('cmpl'), object='text_completion', model=model, choices=choices)
+
+class File():
+
+    # openai 0.x hands the file to requests, which reads it whole and then
+    # builds the multipart body in memory. The fake does the same, so benchmarks
+    # see the real client's peak of about twice the file during an upload.
+    @staticmethod
+    def create(file, purpose, user_provided_filename=None, **kwargs):
+        state.call('File.create')
+        content = bytes(file) if isinstance(file, (bytes, bytearray)) else file.read()
+        body = b''.join((
+            f'--fake\r\nContent-Disposition: form-data; name="file"; filename="{user_provided_filename}"\r\n\r\n'.encode('utf-8'),
+            content,
+            f'\r\n--fake\r\nContent-Disposition: form-data; name="purpose"\r\n\r\n{purpose}\r\n--fake--\r\n'.encode('utf-8'),
+        ))
+        size = len(content)
+        del content, body
+        file_id = state.nextId('file')
+        resp = OpenAIObject(id=file_id, object='file', bytes=size, created_at=int(time.time()), filename=user_provided_filename, purpose=purpose, status='processed')
+        with state.lock:
+            state.files[file_id] = resp
+        return resp
+
+    @staticmethod
+    def retrieve(id, **kwargs):
+        state.call('File.retrieve')
+        with state.lock:
+            if id not in state.files:
+                raise InvalidRequestError(f'No such File object: {id}', http_status=404)
+            return state.files[id]
+
+    @staticmethod
+    def delete(sid, **kwargs):
+        state.call('File.delete')
+        with state.lock:
+            if state.files.pop(sid, None) == None:
+                raise InvalidRequestError(f'No such File object: {sid}', http_status=404)
+        return OpenAIObject(id=sid, object='file', deleted=True)
+
+    @staticmethod
+    def list(**kwargs):
+        state.call('File.list')
+        with state.lock:
+            return OpenAIObject(object='list', data=list(state.files.values()))
+
+class FineTune():
+
+    @staticmethod
+    def create(training_file, model='ada', validation_file=None, **kwargs):
+        state.call('FineTune.create')
+        with state.lock:
+            if training_file not in state.files:
+                raise InvalidRequestError(f'No such File object: {training_file}', http_status=400)
+        now = int(time.time())
+        resp = OpenAIObject(
+            id=state.nextId('ft'),
+            object='fine-tune',
+            model=model,
+            status='pending',
+            fine_tuned_model=None,
+            training_files=[state.files[training_file]],
+            validation_files=[state.files[validation_file]] if validation_file else [],
+            result_files=[],
+            events=[OpenAIObject(object='fine-tune-event', level='info', message='Created fine-tune job', created_at=now)],
+            created_at=now,
+            updated_at=now,
+            polls=0
+        )
+        with state.lock:
+            state.fine_tunes[resp['id']] = resp
+        return resp
+
+    @staticmethod
+    def retrieve(id, **kwargs):
+        state.call('FineTune.retrieve')
+        with state.lock:
+            if id not in state.fine_tunes:
+                raise InvalidRequestError(f'No such fine-tune: {id}', http_status=404)
+            resp = state.fine_tunes[id]
+            if resp['status'] in ('pending', 'running'):
+                resp['polls'] += 1
+                now = int(time.time())
+                if resp['polls'] >= state.training_polls:
+                    resp['status'] = 'succeeded'
+                    resp['fine_tuned_model'] = f"{resp['model']}:ft-fake-{id}"
+                    resp['events'].append(OpenAIObject(object='fine-tune-event', level='info', message='Fine-tune succeeded', created_at=now))
+                elif resp['status'] == 'pending':
+                    resp['status'] = 'running'
+                    resp['events'].append(OpenAIObject(object='fine-tune-event', level='info', message='Fine-tune started', created_at=now))
+                resp['updated_at'] = now
+            return OpenAIObject(resp)
+
+    @staticmethod
+    def stream_events(id, **kwargs):
+        while True:
+            resp = FineTune.retrieve(id)
+            if resp['status'] not in ('pending', 'running'):
+                yield from resp['events']
+                return
+
+class upload_progress():
+
+    class BufferReader(io.BytesIO):
+
+        def __init__(self, buf=b'', desc=None):
+            super().__init__(buf)
+
+def install():
+    module = sys.modules[__name__]
+    sys.modules['openai'] = module
+    sys.modules['openai.error'] = error
+    sys.modules['openai.upload_progress'] = upload_progress
+    return module
@@ -0,0 +1,161 @@
+import logging
+import time
+from threading import Thread, Condition
+
+POLL_INTERVAL = 30
+RETRY_BASE = 5
+RETRY_MAX = 300
+RETRY_ATTEMPTS = 5
+# Poll failures, not necessarily consecutive, before a job is given up on
+POLL_FAILURES_MAX = 50
+ACTIVE_STATES = ('uploaded', 'pending', 'running')
+
+class FineTuneJob():
+
+    def __init__(self, file_id, cutoff_row, message_count, job_id=None, state='uploaded', id=None, validation_file_id=None):
+        self.id = id
+        self.file_id = file_id
+        self.validation_file_id = validation_file_id
+        self.job_id = job_id
+        self.state = state
+        self.cutoff_row = cutoff_row
+        self.message_count = message_count
+        self.events_seen = 0
+        self.state_since = time.monotonic()
+
+def retryDelay(failures, base=RETRY_BASE, maximum=RETRY_MAX):
+    return min(maximum, base * 2 ** (failures - 1))
+
+# A job that OpenAI no longer knows about, or a request it rejects, will not
+# succeed on a later poll.
+def isTerminal(e):
+    return type(e).__name__ == 'InvalidRequestError' or getattr(e, 'http_status', None) == 404
+
+def retry(func, *args, attempts=RETRY_ATTEMPTS, logger=None, **kwargs):
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = retryDelay(attempt)
+            if logger: logger.warning(f'{func.__name__} failed with: {e}. Retrying in {delay} seconds')
+            time.sleep(delay)
+
+class FineTuneScheduler():
+
+    # slots is an optional Sharding.FineTuneSlots shared with other processes so
+    # the job cap holds across every shard, not just this one.
+    def __init__(self, max_jobs=1, poll_interval=POLL_INTERVAL, slots=None, logger=None):
+        self.max_jobs = max_jobs
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.logger = logger if logger else logging.getLogger('retroBot.fine_tune')
+        self.condition = Condition()
+        self.handlers = {}
+        self.active = set()
+        self.thread = Thread(target=self.scheduleLoop, name='fine_tune_scheduler', daemon=True)
+        self.thread.start()
+
+    def register(self, handler):
+        with self.condition:
+            self.handlers[handler.channel] = handler
+            self.condition.notify_all()
+
+    # Refused while the channel has a job running, so its handler is never torn
+    # down underneath the job.
+    def unregister(self, handler):
+        with self.condition:
+            if handler.channel in self.active:
+                return False
+            self.handlers.pop(handler.channel, None)
+            return True
+
+    # Jobs interrupted by a restart go first, then channels with the largest backlog.
+    def nextChannels(self):
+        idle = [handler for channel, handler in self.handlers.items() if channel not in self.active]
+        resumable = [handler for handler in idle if handler.fine_tune_job != None]
+        ready = [handler for handler in idle if handler.fine_tune_job == None and handler.fine_tune_trigger.isReady()]
+        ready.sort(key=lambda handler: handler.fine_tune_trigger.pending, reverse=True)
+        return resumable + ready
+
+    def nextWakeup(self):
+        now = time.monotonic()
+        retry_times = [
+            handler.fine_tune_trigger.retry_at for channel, handler in self.handlers.items()
+            if channel not in self.active and handler.fine_tune_trigger.retry_at > now
+        ]
+        return min(retry_times) - now if retry_times else None
+
+    def scheduleLoop(self):
+        while True:
+            with self.condition:
+                candidates = self.nextChannels()
+                while len(self.active) >= self.max_jobs or not candidates:
+                    self.condition.wait(self.nextWakeup())
+                    candidates = self.nextChannels()
+                handler = candidates[0]
+                self.active.add(handler.channel)
+            # Jobs can poll for hours, so their threads must not hold up exit. An
+            # interrupted job is resumed from the database on the next start.
+            Thread(target=self.runJob, args=(handler,), name=f'fine_tune_{handler.channel.lower()}', daemon=True).start()
+
+    def runJob(self, handler):
+        if self.slots != None:
+            self.slots.acquire(handler.channel)
+        try:
+            model = self.fineTune(handler)
+        except Exception as e:
+            handler.logger.error(f'The following exception has occurred when fine tuning the model: {e}')
+            model = None
+        finally:
+            if self.slots != None:
+                self.slots.release(handler.channel)
+        if model == None:
+            delay = handler.fine_tune_trigger.failed()
+            handler.logger.warning(f'Fine tuning did not produce a model. Retrying in {delay} seconds')
+        with self.condition:
+            self.active.discard(handler.channel)
+            self.condition.notify_all()
+
+    def fineTune(self, handler):
+        job = handler.fine_tune_job
+        if job == None:
+            job = retry(handler.prepareFineTune, logger=handler.logger)
+            if job == None:
+                return None
+        else:
+            handler.logger.info(f'Resuming fine tuning job in state {job.state}: {job.job_id or job.file_id}')
+        if job.job_id == None:
+            try:
+                retry(handler.createFineTune, job, logger=handler.logger)
+            except Exception:
+                handler.updateFineTuneJob(job, 'failed')
+                raise
+        resp = self.waitForJob(handler, job)
+        if resp == None:
+            return None
+        return handler.finishFineTune(job, resp)
+
+    # Returns None once the job has been marked failed because it can no longer be polled.
+    def waitForJob(self, handler, job):
+        failures = 0
+        consecutive = 0
+        while True:
+            try:
+                resp = handler.pollFineTune(job)
+                consecutive = 0
+            except Exception as e:
+                failures += 1
+                consecutive += 1
+                if isTerminal(e) or failures >= POLL_FAILURES_MAX:
+                    handler.logger.error(f'Giving up on fine tuning job {job.job_id} after {failures} failed polls: {e}')
+                    handler.updateFineTuneJob(job, 'failed')
+                    return None
+                delay = retryDelay(consecutive)
+                handler.logger.warning(f'Experienced the following exception while polling fine tuning job {job.job_id}. Retrying in {delay} seconds: {e}')
+                time.sleep(delay)
+                continue
+            if job.state not in ACTIVE_STATES:
+                return resp
+            time.sleep(self.poll_interval)
@@ -0,0 +1,67 @@
+import sqlite3
+import time
+from threading import Condition
+import MessageStore
+
+BACKOFF_BASE = 60
+BACKOFF_MAX = 3600
+
+class FineTuneTrigger():
+
+    def __init__(self, db_file, threshold, db_timeout=10, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, condition=None):
+        self.db_file = db_file
+        self.db_timeout = db_timeout
+        self.threshold = threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.condition = condition if condition else Condition()
+        self.failures = 0
+        self.retry_at = 0
+        connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
+        self.watermark = self.loadWatermark(connection)
+        self.pending = self.countPending(connection)
+        connection.close()
+
+    def loadWatermark(self, connection):
+        cursor = connection.cursor()
+        cursor.execute("select value from state where key = 'last_trained_row'")
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else 0
+
+    def countPending(self, connection):
+        return MessageStore.countRows(connection, self.watermark)
+
+    def isReady(self):
+        return self.pending > self.threshold and time.monotonic() >= self.retry_at
+
+    # Called by the ingestion writer after each committed batch.
+    def add(self, count):
+        with self.condition:
+            self.pending += count
+            if self.isReady():
+                self.condition.notify_all()
+
+    def succeeded(self, cutoff_row, connection=None):
+        own_connection = connection == None
+        if own_connection:
+            connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
+        cursor = connection.cursor()
+        cursor.execute("insert or replace into state values ('last_trained_row', ?)", (cutoff_row,))
+        cursor.close()
+        self.watermark = cutoff_row
+        pending = self.countPending(connection)
+        if own_connection:
+            connection.commit()
+            connection.close()
+        with self.condition:
+            self.pending = pending
+            self.failures = 0
+            self.retry_at = 0
+
+    def failed(self):
+        with self.condition:
+            self.failures += 1
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures - 1))
+            self.retry_at = time.monotonic() + delay
+        return delay
@@ -1,28 +1,76 @@
 import openai
-from openai.upload_progress import BufferReader
 import retroBot.channelHandler
 from retroBot.message import message
 import os
-import re
 import datetime
 import sqlite3
 import time
-import json
-from threading import Thread
+import atexit
+from collections import deque
+from threading import Thread, Lock
+from MessageWriter import MessageWriter
+from FineTuneTrigger import FineTuneTrigger
+from FineTuneScheduler import FineTuneJob
+from CompletionPool import CompletionPool
+from MessageFilter import getTag
+from Dedup import Deduplicator, pruneCounts
+from MessageStore import MessageStore
+from NGramModel import NGramModel
+from RecentChat import RecentChat
+from UploadCache import UploadCache
+from OpenAIClient import PRIORITY_REPLY, PRIORITY_CHATTER, PRIORITY_BACKGROUND
+import ChannelDB
+import DataSet
 
-POLL_INTERVAL=5
 BASE_MODEL='ada'
+NGRAM_MODES = ('fallback', 'primary', 'off')
+# Held messages that wake a dormant channel however slowly they arrived. The
+# oldest are dropped past this while activation keeps failing.
+HELD_MAX = 500
+# Backoff before a dormant channel asks again after a failed activation
+ACTIVATION_RETRY_MIN = 5
+ACTIVATION_RETRY_MAX = 600
 
 class GPTHandler(retroBot.channelHandler):
 
     def __init__(self, channel, parent, *args, **kwargs):
         super().__init__(channel, parent)
-        self.user_id = parent.twitch.get_users(logins=[channel.lower()])['data'][0]['id']
+        self.user_id = parent.user_ids.get(channel)
         self.initConfig()
         self.initDB()
         self.initCooldowns()
-        self.fine_tune_thread = Thread(target=self.fineTuneLoop)
-        self.fine_tune_thread.start()
+        self.initActivation()
+        self.initMetrics()
+        self.parent.channel_activator.register(self)
+        if not self.parent.channel_activator.enabled or self.fine_tune_job != None:
+            self.activate()
+
+    # retroBot's channelHandler looks its channel up with a get_users call of its
+    # own. The shared cache answers every channel from one batched request.
+    def get_channel_id(self):
+        return self.parent.user_ids.get(self.channel)
+
+    # A dormant channel only reads its model and any interrupted fine tune from
+    # the database. Everything else is set up by activate.
+    def initActivation(self):
+        self.active = False
+        self.live = False
+        self.last_activity = time.monotonic()
+        self.messages_received = 0
+        self.state_lock = Lock()
+        self.activation_lock = Lock()
+        self.activation_requested = False
+        self.activation_failures = 0
+        self.activation_retry_at = 0
+        self.held_messages = deque(maxlen=HELD_MAX)
+        self.held_since = 0
+        self.held_count = 0
+        self.message_store = None
+        self.ngram_model = None
+        self.fine_tune_trigger = None
+        self.upload_cache = None
+        self.writer = None
+        self.completion_pool = None
         
     def initCooldowns(self):
         self.cooldowns = {}
@@ -34,39 +82,166 @@ class GPTHandler(retroBot.channelHandler):
         self.cooldowns['reply'] = 120
         self.last_used['reply'] = datetime.datetime.fromtimestamp(0)
 
+    def initMetrics(self):
+        metrics = self.parent.metrics
+        labels = {'channel': self.channel.lower()}
+        self.on_pubmsg_seconds = metrics.histogram('twitchgpt_on_pubmsg_seconds', 'Time spent in on_pubmsg').labels(**labels)
+        self.filter_seconds = metrics.histogram('twitchgpt_filter_message_seconds', 'Time spent in filterMessage').labels(**labels)
+        self.write_seconds = metrics.histogram('twitchgpt_write_message_seconds', 'Time spent in writeMessage, including the enqueue').labels(**labels)
+        self.generate_seconds = metrics.histogram('twitchgpt_generate_message_seconds', 'Latency of live completion requests').labels(**labels)
+        self.prune_seconds = metrics.histogram('twitchgpt_prune_messages_seconds', 'Time spent in pruneMessages').labels(**labels)
+        fine_tune_seconds = metrics.histogram('twitchgpt_fine_tune_phase_seconds', 'Duration of each fine tuning phase')
+        self.fine_tune_seconds = {phase: fine_tune_seconds.labels(phase=phase, **labels) for phase in ('export', 'upload', 'queue_wait', 'training')}
+        self.messages_total = {result: metrics.counter('twitchgpt_messages_total', 'Chat messages handled by outcome').labels(result=result, **labels) for result in ('stored', 'filtered', 'dropped', 'ignored', 'command', 'mention')}
+        self.dataset_rows = {result: metrics.counter('twitchgpt_dataset_rows_total', 'Rows considered by the dataset builder by outcome').labels(result=result, **labels) for result in ('training', 'validation', 'low_information', 'over_budget')}
+        self.generated_total = {source: metrics.counter('twitchgpt_generated_messages_total', 'Generated messages by the source that produced them').labels(source=source, **labels) for source in ('pool', 'openai', 'ngram')}
+        self.generation_errors = metrics.counter('twitchgpt_generation_errors_total', 'Live completion requests that raised').labels(**labels)
+        gauges = [
+            ('twitchgpt_channel_active', 'Whether the channel is active rather than dormant', lambda: int(self.active)),
+            ('twitchgpt_channel_held_messages', 'Messages held by a dormant channel until it activates', lambda: len(self.held_messages)),
+            ('twitchgpt_writer_queue_depth', 'Messages waiting for the ingestion writer', lambda: self.componentStat(self.writer, 'queue_depth')),
+            ('twitchgpt_writer_rows_written', 'Rows committed by the ingestion writer', lambda: self.componentStat(self.writer, 'written')),
+            ('twitchgpt_writer_flushes', 'Batches committed by the ingestion writer', lambda: self.componentStat(self.writer, 'flushes')),
+            ('twitchgpt_writer_flush_retries', 'Batch commits retried because the database was locked', lambda: self.componentStat(self.writer, 'retries')),
+            ('twitchgpt_writer_rows_failed', 'Messages lost to batches that could not be written', lambda: self.componentStat(self.writer, 'failed')),
+            ('twitchgpt_writer_flush_seconds_total', 'Total time spent committing batches', lambda: self.componentStat(self.writer, 'flush_seconds_total')),
+            ('twitchgpt_writer_flush_seconds_max', 'Slowest batch commit', lambda: self.componentStat(self.writer, 'flush_seconds_max')),
+            ('twitchgpt_dedup_removed', 'Messages suppressed as duplicates', lambda: self.componentStat(self.writer and self.writer.dedup, 'removed')),
+            ('twitchgpt_completion_pool_size', 'Pre-generated completions available', lambda: self.componentStat(self.completion_pool, 'size')),
+            ('twitchgpt_completion_pool_hits', 'Replies served from the completion pool', lambda: self.componentStat(self.completion_pool, 'hits')),
+            ('twitchgpt_completion_pool_misses', 'Replies that needed a live request', lambda: self.componentStat(self.completion_pool, 'misses')),
+            ('twitchgpt_recent_chat_tokens', 'Estimated tokens held in the recent chat buffer', lambda: self.componentStat(self.recent_chat, 'tokens')),
+            ('twitchgpt_ngram_edges', 'Transitions held by the local n-gram model', lambda: self.componentStat(self.ngram_model, 'edges')),
+            ('twitchgpt_ngram_bytes', 'Memory held by the local n-gram model', lambda: self.componentStat(self.ngram_model, 'bytes')),
+            ('twitchgpt_upload_cache_hits', 'Dataset uploads skipped because the same file was already uploaded', lambda: self.componentStat(self.upload_cache, 'hits')),
+            ('twitchgpt_upload_cache_misses', 'Datasets uploaded to OpenAI', lambda: self.componentStat(self.upload_cache, 'misses')),
+            ('twitchgpt_fine_tune_pending_rows', 'Stored rows not yet used for fine tuning', lambda: self.fine_tune_trigger.pending if self.fine_tune_trigger else 0),
+        ]
+        for name, help, value in gauges:
+            metrics.gauge(name, help, lambda value=value: [(labels, value())])
+
+    # Components are released while the channel is dormant and read as zero
+    def componentStat(self, component, stat):
+        return component.getStats()[stat] if component else 0
+
+    def initCompletionPool(self):
+        self.completion_pool = CompletionPool(
+            self.fetchCompletions,
+            size=self.completion_pool_size if self.ngram != 'primary' and not self.recent_chat else 0,
+            low_water=self.completion_pool_low_water,
+            name=f'{self.channel.lower()}_completion_pool',
+            logger=self.logger
+        )
+        self.completion_pool.setModel(self.model)
+
     def initDB(self):
         self.db_timeout = 10
-        dir = os.path.join(os.path.dirname(__file__), 'messages')
-        if not os.path.isdir(dir): os.mkdir(dir)
-        self.db_file = os.path.join(dir, f'{self.channel.lower()}.db')
-        connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
-        sqlite3.register_adapter(bool, int)
-        sqlite3.register_converter("BOOLEAN", lambda v: bool(int(v)))
-        cursor = connection.cursor()
-        cursor.execute('PRAGMA journal_mode=WAL')
-        connection.commit()
-        cursor.close()
-        self.initMessageDB(connection)
+        self.db_file = ChannelDB.channelDBFile(self.parent.config, self.channel)
+        connection = ChannelDB.openChannelDB(self.db_file, self.db_timeout)
         self.initModelDB(connection)
+        self.initFineTuneDB(connection)
         connection.close()
 
-    def initMessageDB(self, connection):
-        cursor = connection.cursor()
-        cursor.execute('create table if not exists messages(message TEXT NOT NULL)')
-        connection.commit()
-    
+    def initStorage(self):
+        self.message_store = MessageStore(
+            self.db_file,
+            db_timeout=self.db_timeout,
+            archive_dir=ChannelDB.archiveDir(self.parent.config, self.channel) if self.archive_segments else None,
+            logger=self.logger
+        )
+        self.initNGramModel()
+        self.fine_tune_trigger = FineTuneTrigger(
+            self.db_file,
+            self.message_count_cutoff,
+            db_timeout=self.db_timeout,
+            condition=self.parent.fine_tune_scheduler.condition
+        )
+        self.upload_cache = UploadCache(
+            self.db_file,
+            db_timeout=self.db_timeout,
+            request=self.parent.openai_client.request,
+            logger=self.logger
+        )
+        self.writer = MessageWriter(
+            self.db_file,
+            db_timeout=self.db_timeout,
+            batch_size=self.writer_batch_size,
+            flush_interval=self.writer_flush_interval,
+            queue_size=self.writer_queue_size,
+            backpressure=self.writer_backpressure,
+            name=f'{self.channel.lower()}_writer',
+            logger=self.logger,
+            on_flush=self.fine_tune_trigger.add,
+            on_rows=self.ngram_model.update if self.ngram_model else None,
+            store=self.message_store,
+            dedup=Deduplicator(
+                phrase_cap=self.dedup_phrase_cap,
+                near_threshold=self.dedup_near_threshold,
+                max_signatures=self.dedup_max_signatures
+            )
+        )
+
+    # The model is saved after the writer has flushed on exit, since atexit runs
+    # handlers in reverse. Channels with stored history but no model file build
+    # one from the message store in the background; later rows arrive from the writer.
+    def initNGramModel(self):
+        if self.ngram == 'off':
+            self.ngram_model = None
+            return
+        model_file = ChannelDB.ngramFile(self.parent.config, self.channel)
+        bootstrap = not os.path.exists(model_file)
+        self.ngram_model = NGramModel(
+            order=self.ngram_order,
+            max_edges=self.ngram_max_edges,
+            model_file=model_file,
+            logger=self.logger
+        )
+        atexit.register(self.ngram_model.close)
+        last_row = DataSet.getLastRow(self.db_file, self.db_timeout) if bootstrap else None
+        if last_row != None:
+            rows = DataSet.iterRows(self.db_file, self.db_timeout, end_row=last_row)
+            Thread(target=self.ngram_model.bootstrap, args=(rows,), name=f'{self.channel.lower()}_ngram', daemon=True).start()
+
     def initConfig(self):
         self.max_tokens = self.parent.config['twitch']['channels'][self.channel]['max_tokens']
         self.send_messages = self.parent.config['twitch']['channels'][self.channel]['send_messages']
         self.generate_on = self.parent.config['twitch']['channels'][self.channel]['generate_on']
         self.message_count_cutoff = self.parent.config['twitch']['channels'][self.channel]['message_count_cutoff']
         self.ignored_users = [x.lower() for x in self.parent.config['twitch']['channels'][self.channel]['ignored_users']]
+        self.writer_batch_size = self.parent.config['twitch']['channels'][self.channel]['writer_batch_size']
+        self.writer_flush_interval = self.parent.config['twitch']['channels'][self.channel]['writer_flush_interval']
+        self.writer_queue_size = self.parent.config['twitch']['channels'][self.channel]['writer_queue_size']
+        self.writer_backpressure = self.parent.config['twitch']['channels'][self.channel]['writer_backpressure']
+        self.dedup_phrase_cap = self.parent.config['twitch']['channels'][self.channel]['dedup_phrase_cap']
+        self.dedup_near_threshold = self.parent.config['twitch']['channels'][self.channel]['dedup_near_threshold']
+        self.dedup_max_signatures = self.parent.config['twitch']['channels'][self.channel]['dedup_max_signatures']
+        self.completion_pool_size = self.parent.config['twitch']['channels'][self.channel]['completion_pool_size']
+        self.completion_pool_low_water = self.parent.config['twitch']['channels'][self.channel]['completion_pool_low_water']
+        self.archive_segments = self.parent.config['twitch']['channels'][self.channel]['archive_segments']
+        self.activation_messages = self.parent.config['twitch']['channels'][self.channel]['activation_messages']
+        self.activation_window = self.parent.config['twitch']['channels'][self.channel]['activation_window']
+        self.context_messages = self.parent.config['twitch']['channels'][self.channel]['context_messages']
+        self.context_tokens = self.parent.config['twitch']['channels'][self.channel]['context_tokens']
+        self.recent_chat = RecentChat(self.context_messages) if self.context_messages else None
+        self.ngram = self.parent.config['twitch']['channels'][self.channel]['ngram']
+        if self.ngram not in NGRAM_MODES:
+            raise ValueError(f'Unknown n-gram mode "{self.ngram}". Must be one of: {", ".join(NGRAM_MODES)}')
+        self.ngram_latency_budget = self.parent.config['twitch']['channels'][self.channel]['ngram_latency_budget']
+        self.ngram_order = self.parent.config['twitch']['channels'][self.channel]['ngram_order']
+        self.ngram_max_edges = self.parent.config['twitch']['channels'][self.channel]['ngram_max_edges']
+        self.dataset_builder = DataSet.DataSetBuilder(
+            token_budget=self.parent.config['twitch']['channels'][self.channel]['dataset_token_budget'],
+            sampling=self.parent.config['twitch']['channels'][self.channel]['dataset_sampling'],
+            validation_fraction=self.parent.config['twitch']['channels'][self.channel]['dataset_validation_fraction'],
+            seed=self.parent.config['twitch']['channels'][self.channel]['dataset_seed'],
+            min_words=self.parent.config['twitch']['channels'][self.channel]['dataset_min_words'],
+            min_chars=self.parent.config['twitch']['channels'][self.channel]['dataset_min_chars'],
+            logger=self.logger
+        )
         self.message_count = 0
 
     def initModelDB(self, connection):
         cursor = connection.cursor()
-        cursor.execute('create table if not exists models(iteration INTEGER NOT NULL PRIMARY KEY, date TIMESTAMP NOT NULL, message_count INTEGER NOT NULL, model TEXT NOT NULL)')
-        connection.commit()
         cursor.execute('select COUNT(*) from models')
         model_count = cursor.fetchone()[0]
         if model_count == 0:
@@ -74,35 +249,85 @@ class GPTHandler(retroBot.channelHandler):
         else:
             cursor.execute('select model from models ORDER BY iteration DESC LIMIT 1')
             self.model = cursor.fetchone()[0]
+
+    def initFineTuneDB(self, connection):
+        cursor = connection.cursor()
+        cursor.execute("select id, file_id, job_id, state, cutoff_row, message_count, validation_file_id from fine_tunes where state in ('uploaded', 'pending', 'running') ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
+        cursor.close()
+        if row == None:
+            self.fine_tune_job = None
+        else:
+            self.fine_tune_job = FineTuneJob(row[1], row[4], row[5], job_id=row[2], state=row[3], id=row[0], validation_file_id=row[6])
             
     def on_pubmsg(self, c, e):
-        msg = message(e)
-        if msg.username.lower() in self.ignored_users:
-            return
-        elif msg.content[:1] == '!':
-            self.handleCommands(msg)
-        elif msg.content.lower().find(f'@{self.parent.username.lower()}') != -1:
-            self.logger.info(f'{msg.username}: {msg.content}')
-            if (datetime.datetime.now() - self.last_used['reply']).total_seconds() >= self.cooldowns['reply']:
-                self.generateAndSendMessage(msg.username)
-                self.last_used['reply'] = datetime.datetime.now()
-        else:
-            self.writeMessage(msg)
-        if self.message_count >= self.generate_on:
-            self.generateAndSendMessage()
+        with self.on_pubmsg_seconds.time():
+            msg = message(e)
+            self.last_activity = time.monotonic()
+            self.messages_received += 1
+            if msg.username.lower() in self.ignored_users:
+                self.messages_total['ignored'].inc()
+                return
+            elif msg.content[:1] == '!':
+                self.messages_total['command'].inc()
+                self.handleCommands(msg)
+            elif msg.content.lower().find(f'@{self.parent.username.lower()}') != -1:
+                self.messages_total['mention'].inc()
+                self.logger.info('%s: %s', msg.username, msg.content, extra={'sample': self.channel})
+                if self.recent_chat:
+                    mention = self.filterMessage(msg.content, emotes=getTag(e, 'emotes'))
+                    if mention:
+                        self.recent_chat.add(mention)
+                if (datetime.datetime.now() - self.last_used['reply']).total_seconds() >= self.cooldowns['reply']:
+                    self.parent.generation_worker.submit(self, msg.username)
+                    self.last_used['reply'] = datetime.datetime.now()
+            else:
+                self.writeMessage(msg, emotes=getTag(e, 'emotes'))
+            if self.message_count >= self.generate_on:
+                self.message_count = 0
+                self.parent.generation_worker.submit(self)
     
-    def generateMessage(self, **kwargs):
-        generator = openai.Completion.create(model=self.model, max_tokens=self.max_tokens, stop=['\n'], **kwargs)
+    def generateMessage(self, priority=PRIORITY_CHATTER, timeout=None, **kwargs):
+        with self.generate_seconds.time():
+            generator = self.parent.openai_client.completion(priority=priority, timeout=timeout, model=self.model, max_tokens=self.max_tokens, stop=['\n'], **kwargs)
         return generator.choices[0].text
 
-    def generateAndSendMessage(self, target=None):
-        try:
-            self.message_count = 0
-            generated = self.generateMessage()
-        except Exception as e:
-            self.logger.error(e)
-            generated = None
+    def fetchCompletions(self, model, count):
+        generator = self.parent.openai_client.completion(priority=PRIORITY_BACKGROUND, model=model, max_tokens=self.max_tokens, stop=['\n'], n=count)
+        return [choice.text for choice in generator.choices]
+
+    # With a recent chat buffer the prompt is the latest chat, which pooled
+    # completions were not written against, so the pool is skipped. In fallback
+    # mode the remote call gets at most ngram_latency_budget seconds, after which
+    # the local n-gram model answers instead. In primary mode the n-gram model is
+    # the only generator.
+    def generateAndSendMessage(self, target=None, timeout=None):
+        self.message_count = 0
+        if not self.active:
+            self.activate()
+        completion_pool = self.completion_pool
+        ngram_model = self.ngram_model
+        generated = None
+        prompt = self.recent_chat.prompt(self.context_tokens) if self.recent_chat else None
+        if self.ngram != 'primary' and prompt == None:
+            generated = completion_pool.take() if completion_pool else None
+            source = 'pool'
+        if generated == None and self.ngram != 'primary':
+            source = 'openai'
+            if ngram_model and self.ngram_latency_budget:
+                timeout = min(timeout, self.ngram_latency_budget) if timeout else self.ngram_latency_budget
+            try:
+                context = {'prompt': prompt} if prompt != None else {}
+                generated = self.generateMessage(priority=PRIORITY_REPLY if target != None else PRIORITY_CHATTER, timeout=timeout, **context)
+            except Exception as e:
+                self.generation_errors.inc()
+                self.logger.error(e)
+                generated = None
+        if generated == None and ngram_model:
+            source = 'ngram'
+            generated = ngram_model.generate(max_words=self.max_tokens)
         if generated != None:
+            self.generated_total[source].inc()
             if target != None:
                 generated = f'@{target} {generated}'
             self.logger.info(f'Generated: {generated}')
@@ -110,99 +335,196 @@ class GPTHandler(retroBot.channelHandler):
         else:
             self.logger.error("Could not generate a message :(")
 
-    def writeMessage(self, msg):
-        message = self.filterMessage(msg.content)
-        if message:
-            connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
-            cursor = connection.cursor()
-            cursor.execute('insert into messages values (?)', (message, ))
-            connection.commit()
-            cursor.close()
-            connection.close()
-            self.message_count += 1
-            return True
+    def writeMessage(self, msg, **context):
+        with self.write_seconds.time():
+            message = self.filterMessage(msg.content, **context)
+            if not message:
+                self.messages_total['filtered'].inc()
+                return False
+            if self.recent_chat:
+                self.recent_chat.add(message)
+            with self.activation_lock:
+                if not self.active:
+                    self.holdMessage(message)
+                    return False
+                written = self.writer.write(message)
+            if written:
+                self.messages_total['stored'].inc()
+                self.message_count += 1
+                return True
+            else:
+                self.messages_total['dropped'].inc()
+                return False
+
+    # Called with the activation lock held. A dormant channel holds the messages
+    # it receives and writes them once it activates. activation_messages arriving
+    # within activation_window seconds wake it, and so does the backlog reaching
+    # HELD_MAX, so a quiet channel's chat is stored late rather than dropped. Only
+    # while activation is failing does the backlog lose its oldest messages.
+    def holdMessage(self, message):
+        now = time.monotonic()
+        if now - self.held_since > self.activation_window:
+            self.held_since = now
+            self.held_count = 0
+        if len(self.held_messages) == HELD_MAX:
+            self.messages_total['dropped'].inc()
+        self.held_messages.append(message)
+        self.held_count += 1
+        if self.activation_requested or now < self.activation_retry_at:
+            return
+        if self.held_count >= self.activation_messages:
+            reason = f'{self.held_count} messages in {now - self.held_since:.0f} s'
+        elif len(self.held_messages) == HELD_MAX:
+            reason = f'{len(self.held_messages)} messages held'
         else:
-            return False
-    
-    def filterMessage(self, message):
-        #if self.parent.checkBlacklisted(message):
-        #    return False
-        # Remove links
-        # TODO: Fix
-        message = re.sub(r"http\S+", "", message)
-        # Space filtering
-        message = re.sub(r" +", " ", message)
-        message = message.strip()
-        return message
+            return
+        self.activation_requested = True
+        self.parent.channel_activator.activate(self, reason)
 
-    def fineTuneLoop(self, poll_interval=60):
-        while True:
-            connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
-            cursor = connection.cursor()
-            cursor.execute('select count(*) from messages')
-            message_count = cursor.fetchone()[0]
-            if message_count > self.message_count_cutoff:
-                try:
-                    self.fineTuneModel(model=self.model)
-                except Exception as e:
-                    self.logger.error(f'The following exception has occurred when fine tuning the model: {e}')
-            else:
-                time.sleep(poll_interval)
+    # A failed activation closes whatever it had started and lets the channel
+    # ask again once the backoff has passed.
+    def activate(self):
+        with self.state_lock:
+            if self.active:
+                return False
+            try:
+                self.initStorage()
+                self.initCompletionPool()
+            except Exception:
+                self.releaseStorage()
+                with self.activation_lock:
+                    self.activation_failures += 1
+                    self.activation_retry_at = time.monotonic() + min(ACTIVATION_RETRY_MIN * 2 ** (self.activation_failures - 1), ACTIVATION_RETRY_MAX)
+                    self.activation_requested = False
+                raise
+            with self.activation_lock:
+                for held in self.held_messages:
+                    if self.writer.write(held):
+                        self.messages_total['stored'].inc()
+                        self.message_count += 1
+                self.held_messages.clear()
+                self.activation_requested = False
+                self.activation_failures = 0
+                self.activation_retry_at = 0
+                self.active = True
+            self.parent.fine_tune_scheduler.register(self)
+            return True
 
-    def fineTuneModel(self, poll_interval=POLL_INTERVAL, **kwargs):
+    # Refused while a fine tune for the channel is running or waiting to resume.
+    # The writer is closed after the channel stops accepting messages, so it
+    # flushes everything written before the switch.
+    def deactivate(self):
+        with self.state_lock:
+            if not self.active or self.fine_tune_job != None or not self.parent.fine_tune_scheduler.unregister(self):
+                return False
+            with self.activation_lock:
+                self.active = False
+                self.held_since = 0
+                self.held_count = 0
+            self.releaseStorage()
+            return True
 
-        dataset = self.retrieveDataSet()
-        cutoff_row = dataset[-1][0]
-        dataset_length = len(dataset)
-        dataset = self.formatDataSet(dataset)
-        dataset = self.uploadDataSet(dataset)
+    # Also undoes a partial activation, so any component may be missing
+    def releaseStorage(self):
+        if self.writer:
+            self.writer.close()
+        if self.ngram_model:
+            atexit.unregister(self.ngram_model.close)
+            self.ngram_model.close()
+        if self.completion_pool:
+            self.completion_pool.setModel(None)
+        self.message_store = None
+        self.ngram_model = None
+        self.fine_tune_trigger = None
+        self.upload_cache = None
+        self.writer = None
+        self.completion_pool = None
 
-        resp = openai.FineTune.create(training_file=dataset, **kwargs)
-        job_id = resp['id']
-        self.logger.info(f"Created fine-tuning job: {job_id}")
-        self.logger.debug(resp)
+    def getResources(self):
+        resources = {
+            'channel': self.channel,
+            'active': self.active,
+            'live': self.live,
+            'idle_seconds': time.monotonic() - self.last_activity,
+            'held_messages': len(self.held_messages),
+            'recent_chat_messages': self.componentStat(self.recent_chat, 'messages'),
+            'writer_threads': int(self.writer != None and self.writer.thread.is_alive()),
+            'writer_queue_depth': self.componentStat(self.writer, 'queue_depth'),
+            'dedup_signatures': self.componentStat(self.writer and self.writer.dedup, 'signatures'),
+            'completion_pool_size': self.componentStat(self.completion_pool, 'size'),
+            'ngram_edges': self.componentStat(self.ngram_model, 'edges'),
+            'ngram_bytes': self.componentStat(self.ngram_model, 'bytes'),
+        }
+        return resources
+    
+    def filterMessage(self, message, **context):
+        with self.filter_seconds.time():
+            return self.parent.message_filter.filter(message, **context)
 
-        status = 'pending'
-        while status == 'pending':
-            time.sleep(poll_interval)
-            resp = openai.FineTune.retrieve(id=job_id)
-            status = resp['status']
-            self.logger.debug(resp)
-        
-        finished = False
-        events = openai.FineTune.stream_events(job_id)
-        while finished == False:
-            try:
-                for event in events:
-                    self.logger.info(
-                        "[%s] %s"
-                        % (
-                            datetime.datetime.fromtimestamp(event["created_at"]),
-                            event["message"],
-                        )
-                    )
-                finished = True
-            except Exception as e:
-                self.logger.warning(f'Experienced the following exception while waiting for fine tuning to finish. Will retry: {e}')
-                events = None
-                while events == None:
-                    try:
-                        resp = openai.FineTune.retrieve(id=job_id)
-                        if resp["status"] in ['pending', 'running']:
-                            events = openai.FineTune.stream_events(job_id)
-                        else:
-                            finished = True
-                    except Exception as e:
-                        self.logger.warning(f'Experienced the following exception while retrying connection to fine tuning job. Will retry: {e}')
+    def prepareFineTune(self):
+        cutoff_row = self.message_store.rotate()
+        if cutoff_row is None or cutoff_row <= self.fine_tune_trigger.watermark:
+            self.logger.warning('There are no messages to fine tune on')
+            return None
+        dedup_stats = self.writer.dedup.getStats()
+        self.logger.info(f"Duplicate suppression has removed {dedup_stats['removed']} of {dedup_stats['seen']} messages ({dedup_stats['removed_ratio']:.1%}): {dedup_stats['exact_removed']} exact, {dedup_stats['near_removed']} near")
+        with self.fine_tune_seconds['export'].time():
+            jsonl_file, validation_file, stats = self.formatDataSet(self.retrieveDataSet(cutoff_row))
+        try:
+            if stats['training_rows'] == 0:
+                self.logger.warning(f"None of the {stats['rows_seen']} new messages are worth fine tuning on")
+                return None
+            with self.fine_tune_seconds['upload'].time():
+                file_id = self.uploadDataSet(jsonl_file, stats['training_hash'], stats['training_bytes'], cutoff_row)
+                validation_file_id = self.uploadDataSet(validation_file, stats['validation_hash'], stats['validation_bytes'], cutoff_row, kind='validation') if validation_file else None
+        finally:
+            jsonl_file.close()
+            if validation_file:
+                validation_file.close()
+        job = FineTuneJob(file_id, cutoff_row, stats['training_rows'], validation_file_id=validation_file_id)
+        self.saveFineTuneJob(job)
+        self.fine_tune_job = job
+        self.upload_cache.startCleanup(self.fine_tune_trigger.watermark)
+        return job
 
-        resp = openai.FineTune.retrieve(id=job_id)
+    def createFineTune(self, job):
+        resp = self.parent.openai_client.request(openai.FineTune.create, training_file=job.file_id, validation_file=job.validation_file_id, model=self.model)
+        self.logger.info(f"Created fine-tuning job: {resp['id']}")
         self.logger.debug(resp)
+        job.job_id = resp['id']
+        self.updateFineTuneJob(job, resp['status'])
+        return resp
+
+    def pollFineTune(self, job):
+        resp = self.parent.openai_client.request(openai.FineTune.retrieve, id=job.job_id)
+        events = resp.get('events') or []
+        for event in events[job.events_seen:]:
+            self.logger.info(
+                "[%s] %s"
+                % (
+                    datetime.datetime.fromtimestamp(event["created_at"]),
+                    event["message"],
+                )
+            )
+        job.events_seen = len(events)
+        if resp['status'] != job.state:
+            elapsed = time.monotonic() - job.state_since
+            if job.state == 'pending':
+                self.fine_tune_seconds['queue_wait'].observe(elapsed)
+            elif job.state == 'running':
+                self.fine_tune_seconds['training'].observe(elapsed)
+            self.updateFineTuneJob(job, resp['status'])
+        return resp
 
+    def finishFineTune(self, job, resp):
+        self.logger.debug(resp)
+        self.fine_tune_job = None
         if resp["status"] == "succeeded":
             self.logger.info(f'Fine tuning model creation has succeeded! The resulting model is: {resp["fine_tuned_model"]}')
-            created_date = datetime.datetime.fromtimestamp(resp["result_files"]["created_at"])
-            self.setModel(resp["fine_tuned_model"], dataset_length, created_date)
-            self.pruneMessages(cutoff_row)
+            created_date = datetime.datetime.fromtimestamp(resp["updated_at"])
+            self.setModel(resp["fine_tuned_model"], job.message_count, created_date)
+            self.pruneMessages(job.cutoff_row)
+            self.upload_cache.startCleanup(self.fine_tune_trigger.watermark)
             return resp["fine_tuned_model"]
         elif resp["status"] == "failed":
             self.logger.error(f'Fine tuning model creation has failed!')
@@ -211,62 +533,67 @@ class GPTHandler(retroBot.channelHandler):
             self.logger.error(f'Fine tuning model creation has exploded! Bah gawd!')
             return None
 
-    def setModel(self, model, dataset_length, created_date):
-        self.model = model
+    def saveFineTuneJob(self, job):
+        now = datetime.datetime.now()
         connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
         cursor = connection.cursor()
-        cursor.execute('insert into models values (?, ?, ?, ?)', (None, created_date, dataset_length, model))
+        cursor.execute('insert into fine_tunes values (?, ?, ?, ?, ?, ?, ?, ?, ?)', (None, job.file_id, job.job_id, job.state, job.cutoff_row, job.message_count, now, now, job.validation_file_id))
+        job.id = cursor.lastrowid
         connection.commit()
         cursor.close()
         connection.close()
 
-    def retrieveDataSet(self):
+    def updateFineTuneJob(self, job, state):
+        job.state = state
+        job.state_since = time.monotonic()
         connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
         cursor = connection.cursor()
-        cursor.execute('select rowid, message from messages')
-        rows = cursor.fetchall()
+        cursor.execute('update fine_tunes set job_id = ?, state = ?, updated = ? where id = ?', (job.job_id, job.state, datetime.datetime.now(), job.id))
+        connection.commit()
         cursor.close()
         connection.close()
-        self.logger.debug(f'Retrieved rows {rows[0][0]} through {rows[-1][0]}')
-        return rows
-    
-    def formatDataSet(self, dataset):
-        jsonl_content = ""
-        for row in dataset:
-            row_dict = {
-                'prompt': '\n',
-                'completion': row[1]
-            }
-            jsonl_content += json.dumps(row_dict) + '\n'
-        jsonl_content = bytes(jsonl_content, 'utf-8')
-        return jsonl_content
-    
-    def uploadDataSet(self, dataset):
-        file_name = f"{self.channel}_{time.time()}"
-        buffer_reader = BufferReader(dataset, desc="Upload progress")
-        resp = openai.File.create(
-            file=buffer_reader,
-            purpose="fine-tune",
-            user_provided_filename=file_name
-        )
-        self.logger.debug(
-            "Uploaded file from {file}: {id}".format(
-                file=file_name, id=resp["id"]
-            )
-        )
-        return resp["id"]
+        if state not in ('uploaded', 'pending', 'running') and self.fine_tune_job is job:
+            self.fine_tune_job = None
 
-    def pruneMessages(self, cutoff_row):
+    def setModel(self, model, dataset_length, created_date):
+        self.model = model
+        self.completion_pool.setModel(model)
         connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
         cursor = connection.cursor()
-        cursor.execute('delete from messages where rowid <= ?', (cutoff_row,))
-        connection.commit()
-        cursor.execute('vacuum')
+        cursor.execute('insert into models values (?, ?, ?, ?)', (None, created_date, dataset_length, model))
         connection.commit()
-        cursor.execute('select COUNT(*) from messages', (cutoff_row,))
-        self.message_count = cursor.fetchone()[0]
         cursor.close()
         connection.close()
+
+    def retrieveDataSet(self, cutoff_row=None):
+        start_row = self.fine_tune_trigger.watermark
+        self.logger.debug(f'Retrieving rows {start_row + 1} through {cutoff_row}')
+        return DataSet.iterRows(self.db_file, self.db_timeout, start_row=start_row, end_row=cutoff_row)
+    
+    def formatDataSet(self, dataset):
+        jsonl_file, validation_file, stats = self.dataset_builder.build(dataset)
+        for result in ('training', 'validation', 'low_information', 'over_budget'):
+            self.dataset_rows[result].inc(stats[f'{result}_rows'])
+        self.logger.info(f"Built dataset from {stats['rows_seen']} rows in {stats['seconds']:.3f} s ({stats['rows_per_second']:.0f} rows/s): {stats['training_rows']} training and {stats['validation_rows']} validation rows, ~{stats['tokens']} tokens, {stats['training_bytes'] + stats['validation_bytes']} bytes. Dropped {stats['low_information_rows']} low information and {stats['over_budget_rows']} over budget")
+        return jsonl_file, validation_file, stats
+    
+    # Identical rows build an identical file, so a retry or restart with no new
+    # messages reuses the earlier upload.
+    def uploadDataSet(self, dataset, content_hash, size, cutoff_row, kind='training'):
+        file_name = f"{self.channel}_{time.time()}" + ('' if kind == 'training' else f'_{kind}')
+        return self.upload_cache.upload(dataset, content_hash, file_name, size, kind=kind, start_row=self.fine_tune_trigger.watermark, end_row=cutoff_row)
+
+    def pruneMessages(self, cutoff_row):
+        with self.prune_seconds.time():
+            connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
+            dropped = self.message_store.dropSegments(connection, cutoff_row)
+            pruneCounts(connection, dropped)
+            self.fine_tune_trigger.succeeded(cutoff_row, connection)
+            connection.commit()
+            # execute() only steps the pragma once, which frees a single page
+            connection.executescript('PRAGMA incremental_vacuum')
+            connection.close()
+        self.logger.debug(f'Pruned messages through row {cutoff_row}, dropping segments: {dropped}')
     
     def handleCommands(self, msg):
         return None
@@ -0,0 +1,95 @@
+import logging
+import queue
+import time
+import itertools
+from threading import Thread, Lock
+
+class GenerationJob():
+
+    def __init__(self, handler, target=None, timeout=30):
+        self.handler = handler
+        self.target = target
+        self.priority = 0 if target != None else 1
+        self.created = time.monotonic()
+        self.deadline = self.created + timeout
+        self.timeout = timeout
+        self.started = False
+
+class GenerationWorker():
+
+    def __init__(self, workers=4, timeout=30, logger=None):
+        self.timeout = timeout
+        self.logger = logger if logger else logging.getLogger('retroBot.generation')
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.pending_lock = Lock()
+        self.pending = {}
+        self.stats_lock = Lock()
+        self.stats = {
+            'submitted': 0,
+            'coalesced': 0,
+            'expired': 0,
+            'completed': 0,
+        }
+        self.threads = []
+        for i in range(workers):
+            thread = Thread(target=self.workLoop, name=f'generation_{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Only one job per channel is queued or in flight at a time. A trigger arriving
+    # while one is waiting is folded into it, keeping a mention target if either has
+    # one. Once a job has started only a mention reply can queue another behind it.
+    # Mention replies are taken from the queue ahead of chatter, so a mention folded
+    # into waiting chatter queues the job again as a reply with the later deadline.
+    # The entry it leaves behind is skipped.
+    def submit(self, handler, target=None):
+        requeue = False
+        with self.pending_lock:
+            job = self.pending.get(handler.channel)
+            if job != None and (not job.started or target == None):
+                if target != None and job.target == None:
+                    job.target = target
+                    job.deadline = max(job.deadline, time.monotonic() + self.timeout)
+                    requeue = job.priority != 0
+                    job.priority = 0
+                coalesced = True
+            else:
+                job = GenerationJob(handler, target, self.timeout)
+                self.pending[handler.channel] = job
+                coalesced = False
+        with self.stats_lock:
+            self.stats['submitted'] += 1
+            if coalesced: self.stats['coalesced'] += 1
+        if not coalesced or requeue:
+            self.queue.put((job.priority, next(self.sequence), job))
+        return not coalesced
+
+    def workLoop(self):
+        while True:
+            priority, sequence, job = self.queue.get()
+            with self.pending_lock:
+                if job.started or priority != job.priority:
+                    continue
+                job.started = True
+            remaining = job.deadline - time.monotonic()
+            if remaining <= 0:
+                with self.stats_lock:
+                    self.stats['expired'] += 1
+                job.handler.logger.warning(f'Dropped generation request after waiting {job.timeout}s in the queue')
+            else:
+                try:
+                    job.handler.generateAndSendMessage(job.target, timeout=remaining)
+                except Exception as e:
+                    job.handler.logger.error(f'Generation job failed: {e}')
+                with self.stats_lock:
+                    self.stats['completed'] += 1
+            with self.pending_lock:
+                if self.pending.get(job.handler.channel) is job:
+                    del self.pending[job.handler.channel]
+
+    def getStats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
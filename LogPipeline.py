@@ -0,0 +1,96 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+from threading import Lock
+
+QUEUE_SIZE = 10000
+SAMPLE_RATE = 1.0
+SAMPLE_BURST = 10
+
+# Drops records tagged with extra={'sample': key} once their key has logged more
+# than `rate` records a second, after a burst. The next record let through for a
+# key says how many were dropped. Untagged records always pass.
+class SampleFilter(logging.Filter):
+
+    def __init__(self, rate=SAMPLE_RATE, burst=SAMPLE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.lock = Lock()
+        self.buckets = {}
+        self.stats = {
+            'sampled': 0,
+        }
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key == None or self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, dropped = self.buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, dropped + 1)
+                self.stats['sampled'] += 1
+                return False
+            self.buckets[key] = (tokens - 1, now, 0)
+        if dropped:
+            record.suppressed = dropped
+        return True
+
+# Puts records on the queue as they are, without formatting them. The message and
+# its arguments are only rendered by the listener thread, so a large payload such
+# as an API response costs the logging thread nothing beyond the enqueue. A full
+# queue drops the record rather than blocking the caller.
+class QueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class Formatter(logging.Formatter):
+
+    def format(self, record):
+        suppressed = getattr(record, 'suppressed', None)
+        formatted = super().format(record)
+        return f'{formatted} ({suppressed} similar messages suppressed)' if suppressed else formatted
+
+# Moves the given handlers behind a queue drained by a listener thread, leaving
+# only the enqueue on the caller's thread. Returns the queue handler, whose
+# listener is stopped at exit after the queue has been drained.
+def attachQueue(logger, handlers, queue_size=QUEUE_SIZE, sample_rate=SAMPLE_RATE, sample_burst=SAMPLE_BURST):
+    queue_handler = QueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.sampler = SampleFilter(sample_rate, sample_burst)
+    queue_handler.addFilter(queue_handler.sampler)
+    queue_handler.setLevel(min(handler.level for handler in handlers))
+    queue_handler.listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    queue_handler.listener.start()
+    atexit.register(queue_handler.listener.stop)
+    logger.addHandler(queue_handler)
+    return queue_handler
+
+# Drains the queue and removes the handler. The listener's exit hook goes with
+# it, since a listener cannot be stopped twice.
+def detachQueue(logger, queue_handler):
+    atexit.unregister(queue_handler.listener.stop)
+    queue_handler.listener.stop()
+    logger.removeHandler(queue_handler)
+
+def getStats(queue_handler):
+    return {
+        'queue_depth': queue_handler.queue.qsize(),
+        'dropped': queue_handler.dropped,
+        'sampled': queue_handler.sampler.stats['sampled'],
+    }
@@ -0,0 +1,114 @@
+import os
+import re
+import time
+import logging
+
+LINK_PATTERN = re.compile(r"(?:https?://|www\.)\S+", re.IGNORECASE)
+SPACE_PATTERN = re.compile(r"\s+")
+# Slash and dot commands are run by the chat client and never reach PRIVMSG, so
+# only bot commands are rejected. Chat such as "...that was close" is kept.
+COMMAND_PREFIXES = ('!',)
+
+# Each filter takes the message and the context it arrived with and returns the
+# message to pass on, or None to reject it.
+
+def stripLinks(message, context):
+    return LINK_PATTERN.sub('', message)
+
+def normalizeWhitespace(message, context):
+    return SPACE_PATTERN.sub(' ', message).strip()
+
+def rejectCommands(message, context):
+    if message.lstrip().startswith(COMMAND_PREFIXES):
+        return None
+    return message
+
+# Twitch sends emote positions as an "emotes" tag: "id:start-end,start-end/id:start-end"
+def rejectEmoteOnly(message, context):
+    emotes = context.get('emotes')
+    if not emotes:
+        return message
+    keep = [True] * len(message)
+    for emote in emotes.split('/'):
+        for span in emote.partition(':')[2].split(','):
+            start, _, end = span.partition('-')
+            if start.isdigit() and end.isdigit():
+                for i in range(int(start), min(int(end) + 1, len(message))):
+                    keep[i] = False
+    if not any(keep[i] and not message[i].isspace() for i in range(len(message))):
+        return None
+    return message
+
+def getTag(event, key):
+    for tag in getattr(event, 'tags', None) or []:
+        if tag['key'] == key:
+            return tag['value']
+    return None
+
+class Blacklist():
+
+    def __init__(self, blacklist_file, check_interval=30, logger=None):
+        self.blacklist_file = blacklist_file
+        self.check_interval = check_interval
+        self.logger = logger if logger else logging.getLogger('retroBot.blacklist')
+        self.mtime = None
+        self.next_check = 0
+        self.words = []
+        self.pattern = None
+        self.reload()
+
+    def load(self):
+        with open(self.blacklist_file, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    # All words are compiled into one alternation so a message is scanned once
+    # regardless of how long the blacklist is.
+    def compile(self, words):
+        if not words:
+            return None
+        alternation = '|'.join(re.escape(word) for word in sorted(set(words), key=len, reverse=True))
+        return re.compile(r"\b(?:" + alternation + ")", re.IGNORECASE)
+
+    def reload(self):
+        self.next_check = time.monotonic() + self.check_interval
+        try:
+            mtime = os.stat(self.blacklist_file).st_mtime
+        except OSError as e:
+            if self.mtime != None:
+                self.logger.warning(f'Could not read blacklist file {self.blacklist_file}: {e}')
+            return
+        if mtime == self.mtime:
+            return
+        words = self.load()
+        self.pattern = self.compile(words)
+        self.words = words
+        self.mtime = mtime
+        self.logger.info(f'Loaded {len(words)} blacklisted words from {self.blacklist_file}')
+
+    def isBlacklisted(self, message):
+        if time.monotonic() >= self.next_check:
+            self.reload()
+        pattern = self.pattern
+        return pattern != None and pattern.search(message) != None
+
+    def __call__(self, message, context):
+        if self.isBlacklisted(message):
+            return None
+        return message
+
+DEFAULT_FILTERS = (rejectEmoteOnly, rejectCommands, stripLinks, normalizeWhitespace)
+
+class MessageFilter():
+
+    def __init__(self, filters=DEFAULT_FILTERS, blacklist=None):
+        self.filters = list(filters)
+        self.blacklist = blacklist
+        if blacklist != None:
+            self.filters.append(blacklist)
+
+    def filter(self, message, **context):
+        for stage in self.filters:
+            message = stage(message, context)
+            if not message:
+                return None
+        return message
@@ -0,0 +1,238 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import sqlite3
+from threading import Lock
+
+PAGE_SIZE = 5000
+# Batches an importer checks outside the write lock before a run of rotations
+# makes it check under the lock instead
+IMPORT_ATTEMPTS = 3
+
+# Messages live in one table per fine tune iteration, messages_0, messages_1, ...
+# Each segment's AUTOINCREMENT sequence is seeded from the previous one, so ids
+# keep increasing across segments and watermarks stay valid. Pruning drops
+# whole consumed segments instead of deleting rows and vacuuming the file.
+def segmentTable(segment):
+    return f'messages_{int(segment)}'
+
+def listSegments(connection):
+    cursor = connection.cursor()
+    cursor.execute('select segment, first_row from segments order by segment')
+    segments = cursor.fetchall()
+    cursor.close()
+    return segments
+
+def currentSegment(connection):
+    cursor = connection.cursor()
+    cursor.execute('select max(segment) from segments')
+    segment = cursor.fetchone()[0]
+    cursor.close()
+    return segment
+
+def lastSequence(connection, segment):
+    cursor = connection.cursor()
+    cursor.execute('select seq from sqlite_sequence where name = ?', (segmentTable(segment),))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else 0
+
+def createSegment(connection, segment, after_row):
+    table = segmentTable(segment)
+    cursor = connection.cursor()
+    cursor.execute(f'create table if not exists {table}(id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL)')
+    cursor.execute('delete from sqlite_sequence where name = ?', (table,))
+    cursor.execute('insert into sqlite_sequence(name, seq) values (?, ?)', (table, after_row))
+    cursor.execute('insert into segments values (?, ?, ?)', (segment, after_row + 1, datetime.datetime.now()))
+    cursor.close()
+
+# Moves rows from the single pre-segment messages table into segment 0, keeping
+# their rowids so stored watermarks and job cutoffs still line up.
+def migrate(connection):
+    cursor = connection.cursor()
+    cursor.execute("select count(*) from sqlite_master where type = 'table' and name = 'messages'")
+    legacy = cursor.fetchone()[0] > 0
+    if currentSegment(connection) == None:
+        createSegment(connection, 0, 0)
+    if legacy:
+        cursor.execute(f'insert into {segmentTable(0)}(id, message) select rowid, message from messages')
+        cursor.execute('drop table messages')
+    cursor.close()
+    return legacy
+
+# (segment, first_row, last_possible_row) for each segment, the last bound being
+# None for the segment still being written.
+def segmentRanges(connection):
+    segments = listSegments(connection)
+    ranges = []
+    for i, (segment, first_row) in enumerate(segments):
+        last_row = segments[i + 1][1] - 1 if i + 1 < len(segments) else None
+        ranges.append((segment, first_row, last_row))
+    return ranges
+
+def iterRows(connection, start_row=0, end_row=None, page_size=PAGE_SIZE):
+    cursor = connection.cursor()
+    last_row = start_row
+    try:
+        for segment, first_row, segment_end in segmentRanges(connection):
+            if end_row != None and first_row > end_row:
+                break
+            if segment_end != None and segment_end <= last_row:
+                continue
+            table = segmentTable(segment)
+            while True:
+                if end_row is None:
+                    cursor.execute(f'select id, message from {table} where id > ? order by id limit ?', (last_row, page_size))
+                else:
+                    cursor.execute(f'select id, message from {table} where id > ? and id <= ? order by id limit ?', (last_row, end_row, page_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                yield from rows
+                last_row = rows[-1][0]
+    finally:
+        cursor.close()
+
+def lastRow(connection):
+    cursor = connection.cursor()
+    last_row = None
+    for segment, first_row in reversed(listSegments(connection)):
+        cursor.execute(f'select max(id) from {segmentTable(segment)}')
+        last_row = cursor.fetchone()[0]
+        if last_row != None:
+            break
+    cursor.close()
+    return last_row
+
+def countRows(connection, after_row=0):
+    cursor = connection.cursor()
+    count = 0
+    for segment, first_row, segment_end in segmentRanges(connection):
+        if segment_end != None and segment_end <= after_row:
+            continue
+        cursor.execute(f'select count(*) from {segmentTable(segment)} where id > ?', (after_row,))
+        count += cursor.fetchone()[0]
+    cursor.close()
+    return count
+
+def archiveSegment(connection, segment, archive_dir, page_size=PAGE_SIZE):
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_file = os.path.join(archive_dir, f'{segmentTable(segment)}.jsonl.gz')
+    temp_file = f'{archive_file}.tmp'
+    encoder = json.JSONEncoder()
+    cursor = connection.cursor()
+    last_row = 0
+    count = 0
+    with gzip.open(temp_file, 'wt', encoding='utf-8') as out:
+        while True:
+            cursor.execute(f'select id, message from {segmentTable(segment)} where id > ? order by id limit ?', (last_row, page_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for id, message in rows:
+                out.write(encoder.encode({'id': id, 'message': message}))
+                out.write('\n')
+            count += len(rows)
+            last_row = rows[-1][0]
+    cursor.close()
+    os.replace(temp_file, archive_file)
+    return archive_file, count
+
+class MessageStore():
+
+    def __init__(self, db_file, db_timeout=10, archive_dir=None, logger=None):
+        self.db_file = db_file
+        self.db_timeout = db_timeout
+        self.archive_dir = archive_dir
+        self.logger = logger if logger else logging.getLogger('retroBot.store')
+        self.lock = Lock()
+        connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
+        self.segment = currentSegment(connection)
+        connection.close()
+
+    # Called by the ingestion writer. Holding the lock through the commit means a
+    # rotation never sees a batch half way into the segment it is sealing. The
+    # optional filter is passed the segment being written and runs inside the
+    # same lock and transaction: any write it makes takes SQLite's write lock, so
+    # taking the store lock after it would invert the order rotate() uses and
+    # deadlock until db_timeout. Returns the rows kept.
+    def insert(self, connection, messages, filter=None):
+        with self.lock:
+            rows = filter(connection, messages, self.segment) if filter else messages
+            connection.executemany(f'insert into {segmentTable(self.segment)}(message) values (?)', [(message,) for message in rows])
+            connection.commit()
+            return rows
+
+    # For writers in another process than the bot, such as a bulk import, which
+    # must not hold the bot's write lock through CPU bound filtering. check is
+    # passed the current segment and runs before the lock is taken, returning the
+    # rows to keep and a function that makes its writes in the insert's
+    # transaction (see Deduplicator.checkBatch). Inside the transaction only the
+    # segment is read again; if the bot rotated in between, the batch is checked
+    # again against the new segment so it is never written past the cutoff.
+    def importBatch(self, connection, messages, check=None):
+        with self.lock:
+            for attempt in range(IMPORT_ATTEMPTS):
+                segment = currentSegment(connection)
+                rows, record = check(connection, messages, segment) if check else (messages, None)
+                connection.execute('BEGIN IMMEDIATE')
+                if currentSegment(connection) == segment:
+                    break
+                connection.rollback()
+            else:
+                connection.execute('BEGIN IMMEDIATE')
+                segment = currentSegment(connection)
+                rows, record = check(connection, messages, segment) if check else (messages, None)
+            self.segment = segment
+            if record:
+                record(connection)
+            connection.executemany(f'insert into {segmentTable(segment)}(message) values (?)', [(message,) for message in rows])
+            connection.commit()
+            return rows
+
+    # Seals the segment being written and starts the next one. Returns the last
+    # row of the sealed segments, which becomes the fine tune cutoff. The write
+    # lock is taken before reading, so a batch from another process lands either
+    # before the cutoff or in the new segment.
+    def rotate(self):
+        with self.lock:
+            connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                last_row = lastRow(connection)
+                cursor = connection.cursor()
+                cursor.execute(f'select exists(select 1 from {segmentTable(self.segment)})')
+                empty = not cursor.fetchone()[0]
+                cursor.close()
+                if not empty:
+                    createSegment(connection, self.segment + 1, lastSequence(connection, self.segment))
+                    connection.commit()
+                    self.segment += 1
+                    self.logger.debug(f'Started message segment {self.segment} after row {last_row}')
+            finally:
+                connection.close()
+            return last_row
+
+    # Drops every sealed segment at or below cutoff_row, archiving it first when an
+    # archive directory is set. Rows at or below the cutoff in a segment that is
+    # only partly consumed are deleted. The caller commits.
+    def dropSegments(self, connection, cutoff_row):
+        cursor = connection.cursor()
+        dropped = []
+        for segment, first_row, segment_end in segmentRanges(connection):
+            if first_row > cutoff_row:
+                break
+            if segment_end != None and segment_end <= cutoff_row and segment != self.segment:
+                if self.archive_dir:
+                    archive_file, count = archiveSegment(connection, segment, self.archive_dir)
+                    self.logger.info(f'Archived {count} messages from segment {segment} to {archive_file}')
+                cursor.execute(f'drop table {segmentTable(segment)}')
+                cursor.execute('delete from sqlite_sequence where name = ?', (segmentTable(segment),))
+                cursor.execute('delete from segments where segment = ?', (segment,))
+                dropped.append(segment)
+            else:
+                cursor.execute(f'delete from {segmentTable(segment)} where id <= ?', (cutoff_row,))
+        cursor.close()
+        return dropped
@@ -0,0 +1,152 @@
+import sqlite3
+import logging
+import queue
+import time
+import atexit
+from threading import Thread, Lock, Event
+from MessageStore import MessageStore
+
+BACKPRESSURE_POLICIES = ('block', 'drop')
+# Attempts at a batch while another writer, such as a bulk import or a prune,
+# holds the database lock, with the delay doubling from FLUSH_RETRY_BASE
+FLUSH_ATTEMPTS = 6
+FLUSH_RETRY_BASE = 0.5
+
+def isLocked(e):
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+class MessageWriter():
+
+    def __init__(self, db_file, db_timeout=10, batch_size=100, flush_interval=2.0, queue_size=10000, backpressure='block', name='writer', logger=None, on_flush=None, on_rows=None, dedup=None, store=None):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f'Unknown backpressure policy "{backpressure}". Must be one of: {", ".join(BACKPRESSURE_POLICIES)}')
+        self.db_file = db_file
+        self.db_timeout = db_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+        self.on_flush = on_flush
+        self.on_rows = on_rows
+        self.dedup = dedup
+        self.store = store if store else MessageStore(db_file, db_timeout)
+        self.logger = logger if logger else logging.getLogger(f'retroBot.{name}')
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats_lock = Lock()
+        self.stats = {
+            'enqueued': 0,
+            'dropped': 0,
+            'failed': 0,
+            'retries': 0,
+            'written': 0,
+            'deduplicated': 0,
+            'flushes': 0,
+            'flush_seconds_total': 0.0,
+            'flush_seconds_max': 0.0,
+            'last_flush_seconds': 0.0,
+        }
+        self.stopped = Event()
+        self.thread = Thread(target=self.writeLoop, name=name, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, message):
+        try:
+            if self.backpressure == 'block':
+                self.queue.put(message)
+            else:
+                self.queue.put_nowait(message)
+        except queue.Full:
+            with self.stats_lock:
+                self.stats['dropped'] += 1
+            return False
+        with self.stats_lock:
+            self.stats['enqueued'] += 1
+        return True
+
+    def writeLoop(self):
+        connection = sqlite3.connect(self.db_file, timeout=self.db_timeout, check_same_thread=False)
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        if self.dedup:
+            self.dedup.initDB(connection)
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+        while not stopping or not self.queue.empty():
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline or (stopping and batch):
+                if batch:
+                    self.flush(connection, batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+        if batch:
+            self.flush(connection, batch)
+        cursor.close()
+        connection.close()
+
+    # A batch that hits a locked database is retried, reusing its dedup check so
+    # the messages are not counted twice. Any other error loses the batch, which
+    # is counted as failed.
+    def flush(self, connection, batch):
+        start = time.perf_counter()
+        checks = {}
+
+        def filter(connection, messages, segment):
+            if segment not in checks:
+                checks[segment] = self.dedup.checkBatch(connection, messages, segment)
+            rows, record = checks[segment]
+            record(connection)
+            return rows
+
+        for attempt in range(1, FLUSH_ATTEMPTS + 1):
+            try:
+                rows = self.store.insert(connection, batch, filter=filter if self.dedup else None)
+                break
+            except Exception as e:
+                connection.rollback()
+                if not isLocked(e) or attempt == FLUSH_ATTEMPTS:
+                    self.logger.error(f'Failed to write {len(batch)} messages: {e}')
+                    with self.stats_lock:
+                        self.stats['failed'] += len(batch)
+                    return
+                delay = FLUSH_RETRY_BASE * 2 ** (attempt - 1)
+                self.logger.warning(f'Could not write {len(batch)} messages: {e}. Retrying in {delay} seconds')
+                with self.stats_lock:
+                    self.stats['retries'] += 1
+                time.sleep(delay)
+        elapsed = time.perf_counter() - start
+        with self.stats_lock:
+            self.stats['written'] += len(rows)
+            self.stats['deduplicated'] += len(batch) - len(rows)
+            self.stats['flushes'] += 1
+            self.stats['flush_seconds_total'] += elapsed
+            self.stats['flush_seconds_max'] = max(self.stats['flush_seconds_max'], elapsed)
+            self.stats['last_flush_seconds'] = elapsed
+        if self.on_flush and rows:
+            self.on_flush(len(rows))
+        if self.on_rows and rows:
+            try:
+                self.on_rows(rows)
+            except Exception as e:
+                self.logger.error(f'Failed to pass {len(rows)} written messages on: {e}')
+
+    def getStats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
+
+    def close(self, timeout=None):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.thread.join(timeout)
@@ -0,0 +1,234 @@
+import bisect
+import time
+import logging
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 1800, 3600)
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{escapeLabel(value)}"' for key, value in items) + '}'
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Timer():
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metric.observe(time.perf_counter() - self.start)
+
+class NullMetric():
+
+    def labels(self, **labels):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_METRIC = NullMetric()
+
+class Counter():
+
+    type = 'counter'
+
+    def __init__(self, name, help, lock):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.values = {}
+
+    def labels(self, **labels):
+        return BoundCounter(self, tuple(sorted(labels.items())))
+
+    def inc(self, amount=1, key=()):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            return [f'{self.name}{formatLabels(key)} {formatValue(value)}' for key, value in self.values.items()]
+
+class BoundCounter():
+
+    def __init__(self, counter, key):
+        self.counter = counter
+        self.key = key
+
+    def inc(self, amount=1):
+        self.counter.inc(amount, self.key)
+
+class Histogram():
+
+    type = 'histogram'
+
+    def __init__(self, name, help, lock, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def labels(self, **labels):
+        return BoundHistogram(self, tuple(sorted(labels.items())))
+
+    def observe(self, value, key=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry == None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{formatLabels(key, [("le", formatValue(bound))])} {cumulative}')
+                lines.append(f'{self.name}_sum{formatLabels(key)} {formatValue(total)}')
+                lines.append(f'{self.name}_count{formatLabels(key)} {count}')
+        return lines
+
+class BoundHistogram():
+
+    def __init__(self, histogram, key):
+        self.histogram = histogram
+        self.key = key
+
+    def observe(self, value):
+        self.histogram.observe(value, self.key)
+
+    def time(self):
+        return Timer(self)
+
+# Gauges are read at scrape time from a callback returning [(labels dict, value)],
+# so components that already keep counters do not pay anything per event.
+class GaugeCallback():
+
+    type = 'gauge'
+
+    def __init__(self, name, help, lock):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.callbacks = []
+
+    def add(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def collect(self):
+        with self.lock:
+            callbacks = list(self.callbacks)
+        lines = []
+        for callback in callbacks:
+            try:
+                samples = callback()
+            except Exception:
+                continue
+            for labels, value in samples:
+                lines.append(f'{self.name}{formatLabels(sorted(labels.items()))} {formatValue(value)}')
+        return lines
+
+class MetricsRegistry():
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.metrics = {}
+
+    def register(self, cls, name, help, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric == None:
+                metric = self.metrics[name] = cls(name, help, Lock(), **kwargs)
+            return metric
+
+    def counter(self, name, help):
+        if not self.enabled:
+            return NULL_METRIC
+        return self.register(Counter, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        if not self.enabled:
+            return NULL_METRIC
+        return self.register(Histogram, name, help, buckets=buckets)
+
+    def gauge(self, name, help, callback):
+        if not self.enabled:
+            return
+        self.register(GaugeCallback, name, help).add(callback)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer():
+
+    def __init__(self, registry, host='127.0.0.1', port=9108, logger=None):
+        self.registry = registry
+        self.logger = logger if logger else logging.getLogger('retroBot.metrics')
+        registry_ref = registry
+
+        class RequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry_ref.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), RequestHandler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, name='metrics_server', daemon=True)
+        self.thread.start()
+        self.logger.info(f'Serving metrics on http://{host}:{self.server.server_address[1]}/metrics')
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,318 @@
+import bisect
+import json
+import logging
+import os
+import random
+import time
+from array import array
+from threading import Lock
+
+BOUNDARY = 0
+MAX_EDGES = 2000000
+SAVE_INTERVAL = 300
+# Contexts with more successors than this get a cumulative table for sampling
+CACHE_DEGREE = 64
+# A cached table is rebuilt once its context has grown by this factor
+CACHE_STALENESS = 1.25
+MAGIC = b'NGRAM2\n'
+MASK64 = (1 << 64) - 1
+FIBONACCI = 11400714819323198485
+TABLES = ('contexts', 'edges')
+# Columns persisted in this order, after the two hash tables.
+ARRAYS = (
+    ('ctx_head', 'q'),
+    ('ctx_total', 'Q'),
+    ('edge_next', 'I'),
+    ('edge_count', 'I'),
+    ('edge_link', 'q'),
+)
+
+# An open addressing map from 64 bit keys to non-negative ints in two flat
+# arrays, about a third of the memory of a dict of Python ints.
+class IntTable():
+
+    def __init__(self, capacity=1024):
+        self.allocate(capacity)
+        self.size = 0
+
+    def allocate(self, capacity):
+        self.bits = capacity.bit_length() - 1
+        self.mask = capacity - 1
+        self.keys = array('Q', bytes(8 * capacity))
+        self.values = array('q', [-1]) * capacity
+
+    def index(self, key):
+        return ((key * FIBONACCI) & MASK64) >> (64 - self.bits)
+
+    def get(self, key):
+        keys = self.keys
+        values = self.values
+        i = self.index(key)
+        while True:
+            value = values[i]
+            if value < 0:
+                return None
+            if keys[i] == key:
+                return value
+            i = (i + 1) & self.mask
+
+    # Returns the existing value for key, or stores and returns value.
+    def setdefault(self, key, value):
+        keys = self.keys
+        values = self.values
+        i = self.index(key)
+        while True:
+            existing = values[i]
+            if existing < 0:
+                break
+            if keys[i] == key:
+                return existing
+            i = (i + 1) & self.mask
+        keys[i] = key
+        values[i] = value
+        self.size += 1
+        if self.size * 3 > len(values) * 2:
+            self.grow()
+        return value
+
+    def grow(self):
+        keys = self.keys
+        values = self.values
+        self.allocate(len(values) * 2)
+        for key, value in zip(keys, values):
+            if value >= 0:
+                i = self.index(key)
+                while self.values[i] >= 0:
+                    i = (i + 1) & self.mask
+                self.keys[i] = key
+                self.values[i] = value
+
+    def __len__(self):
+        return self.size
+
+# A word-level Markov model kept in flat arrays. Contexts of `order` word ids are
+# packed into one 64 bit key and mapped to a slot. Each slot's successors form a
+# linked list through the edge arrays, newest first.
+class NGramModel():
+
+    def __init__(self, order=2, max_edges=MAX_EDGES, model_file=None, save_interval=SAVE_INTERVAL, logger=None):
+        self.order = order
+        self.id_bits = 64 // order
+        self.max_vocab = (1 << min(self.id_bits, 32)) - 1
+        self.max_edges = max_edges
+        self.model_file = model_file
+        self.save_interval = save_interval
+        self.logger = logger if logger else logging.getLogger('retroBot.ngram')
+        self.random = random.Random()
+        self.lock = Lock()
+        self.reset()
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.stats = {
+            'messages': 0,
+            'tokens': 0,
+            'generated': 0,
+            'full': 0,
+        }
+        if model_file and os.path.exists(model_file):
+            try:
+                self.load()
+            except (OSError, EOFError, ValueError, KeyError) as e:
+                self.logger.warning(f'Ignoring unreadable n-gram model {model_file}: {e}')
+                self.reset()
+
+    def reset(self):
+        self.words = ['']
+        self.vocab = {'': BOUNDARY}
+        self.contexts = IntTable()
+        self.edges = IntTable()
+        self.samplers = {}
+        for name, typecode in ARRAYS:
+            setattr(self, name, array(typecode))
+
+    def contextKey(self, ids):
+        key = 0
+        for id in ids:
+            key = (key << self.id_bits) | id
+        return key
+
+    def tokenIds(self, message):
+        ids = []
+        for word in message.split():
+            id = self.vocab.get(word)
+            if id == None:
+                if len(self.words) > self.max_vocab:
+                    return None
+                id = self.vocab[word] = len(self.words)
+                self.words.append(word)
+            ids.append(id)
+        return ids
+
+    def add(self, message):
+        ids = self.tokenIds(message)
+        if not ids:
+            return 0
+        sequence = [BOUNDARY] * self.order + ids + [BOUNDARY]
+        for i in range(self.order, len(sequence)):
+            full = len(self.edge_next) >= self.max_edges
+            key = self.contextKey(sequence[i - self.order:i])
+            slot = self.contexts.get(key) if full else self.contexts.setdefault(key, len(self.ctx_head))
+            if slot == None:
+                self.stats['full'] += 1
+                continue
+            if slot == len(self.ctx_head):
+                self.ctx_head.append(-1)
+                self.ctx_total.append(0)
+            next_id = sequence[i]
+            edge_key = (slot << 32) | next_id
+            edge = self.edges.get(edge_key) if full else self.edges.setdefault(edge_key, len(self.edge_next))
+            if edge == None:
+                self.stats['full'] += 1
+                continue
+            if edge == len(self.edge_next):
+                self.edge_next.append(next_id)
+                self.edge_count.append(0)
+                self.edge_link.append(self.ctx_head[slot])
+                self.ctx_head[slot] = edge
+            self.edge_count[edge] += 1
+            self.ctx_total[slot] += 1
+        return len(ids)
+
+    # Called by the ingestion writer with each committed batch.
+    def update(self, messages):
+        with self.lock:
+            for message in messages:
+                self.stats['tokens'] += self.add(message)
+            self.stats['messages'] += len(messages)
+            self.dirty = True
+            save = self.model_file and time.monotonic() - self.saved_at >= self.save_interval
+        if save:
+            self.save()
+
+    # Builds the model from rows already in the message store, for channels that
+    # had history before the model file existed.
+    def bootstrap(self, rows, batch_size=1000):
+        start = time.perf_counter()
+        batch = []
+        for id, message in rows:
+            batch.append(message)
+            if len(batch) >= batch_size:
+                self.update(batch)
+                batch = []
+        if batch:
+            self.update(batch)
+        if self.model_file:
+            self.save()
+        stats = self.getStats()
+        self.logger.info(f"Built n-gram model from {stats['messages']} stored messages in {time.perf_counter() - start:.1f} s: {stats['words']} words, {stats['edges']} edges")
+
+    # Walks the successor list, or for busy contexts bisects a cumulative table
+    # built on the first walk. The table may lag behind recent updates, which
+    # only skews the sample slightly.
+    def sample(self, slot, rng):
+        sampler = self.samplers.get(slot)
+        if sampler != None and self.ctx_total[slot] <= sampler[0] * CACHE_STALENESS:
+            total, edges, cumulative = sampler
+            return edges[bisect.bisect_right(cumulative, rng.randrange(total))]
+        remaining = rng.randrange(self.ctx_total[slot])
+        edge = self.ctx_head[slot]
+        chosen = None
+        edges = array('q')
+        cumulative = array('Q')
+        total = 0
+        while edge >= 0:
+            count = self.edge_count[edge]
+            if chosen == None and remaining < count:
+                chosen = edge
+            remaining -= count
+            total += count
+            edges.append(edge)
+            cumulative.append(total)
+            if len(edges) == CACHE_DEGREE and chosen != None and sampler == None:
+                return chosen
+            edge = self.edge_link[edge]
+        if len(edges) > CACHE_DEGREE:
+            self.samplers[slot] = (total, edges, cumulative)
+        return chosen
+
+    def generate(self, max_words=64, rng=None):
+        rng = rng if rng else self.random
+        words = []
+        with self.lock:
+            context = [BOUNDARY] * self.order
+            while len(words) < max_words:
+                slot = self.contexts.get(self.contextKey(context))
+                if slot == None:
+                    break
+                next_id = self.edge_next[self.sample(slot, rng)]
+                if next_id == BOUNDARY:
+                    break
+                words.append(self.words[next_id])
+                context = context[1:] + [next_id]
+            self.stats['generated'] += 1
+        return ' '.join(words) if words else None
+
+    def save(self):
+        with self.lock:
+            header = json.dumps({
+                'order': self.order,
+                'words': len(self.words) - 1,
+                'tables': {name: [len(getattr(self, name).values), len(getattr(self, name))] for name in TABLES},
+                'arrays': {name: len(getattr(self, name)) for name, typecode in ARRAYS},
+            }).encode('utf-8')
+            vocab = '\n'.join(self.words[1:]).encode('utf-8')
+            temp_file = f'{self.model_file}.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(MAGIC)
+                f.write(len(header).to_bytes(4, 'little'))
+                f.write(header)
+                f.write(len(vocab).to_bytes(8, 'little'))
+                f.write(vocab)
+                for name in TABLES:
+                    getattr(self, name).keys.tofile(f)
+                    getattr(self, name).values.tofile(f)
+                for name, typecode in ARRAYS:
+                    getattr(self, name).tofile(f)
+            os.replace(temp_file, self.model_file)
+            self.dirty = False
+            self.saved_at = time.monotonic()
+
+    def load(self):
+        with open(self.model_file, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('not an n-gram model file')
+            header = json.loads(f.read(int.from_bytes(f.read(4), 'little')).decode('utf-8'))
+            if header['order'] != self.order:
+                raise ValueError(f"model has order {header['order']}, expected {self.order}")
+            vocab = f.read(int.from_bytes(f.read(8), 'little')).decode('utf-8')
+            self.words = [''] + (vocab.split('\n') if header['words'] else [])
+            for name in TABLES:
+                capacity, size = header['tables'][name]
+                table = IntTable(capacity)
+                table.keys = array('Q')
+                table.keys.fromfile(f, capacity)
+                table.values = array('q')
+                table.values.fromfile(f, capacity)
+                table.size = size
+                setattr(self, name, table)
+            for name, typecode in ARRAYS:
+                values = array(typecode)
+                values.fromfile(f, header['arrays'][name])
+                setattr(self, name, values)
+        self.vocab = {word: id for id, word in enumerate(self.words)}
+        self.samplers = {}
+        self.logger.info(f'Loaded n-gram model with {len(self.words) - 1} words and {len(self.edge_next)} edges from {self.model_file}')
+
+    def close(self):
+        if self.model_file and self.dirty:
+            self.save()
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['words'] = len(self.words) - 1
+            stats['contexts'] = len(self.ctx_head)
+            stats['edges'] = len(self.edge_next)
+            stats['bytes'] = sum(len(getattr(self, name)) * getattr(self, name).itemsize for name, typecode in ARRAYS)
+            stats['bytes'] += sum(len(table.keys) * table.keys.itemsize + len(table.values) * table.values.itemsize for table in (self.contexts, self.edges))
+        return stats
@@ -0,0 +1,194 @@
+import openai
+import heapq
+import itertools
+import logging
+import random
+import time
+from concurrent.futures import Future
+from threading import Condition, Lock
+import DataSet
+
+PRIORITY_REPLY = 0
+PRIORITY_CHATTER = 1
+PRIORITY_BACKGROUND = 2
+BURST_SECONDS = 10
+MAX_RETRIES = 5
+RETRY_BASE = 1
+RETRY_MAX = 60
+RETRYABLE_ERRORS = ('RateLimitError', 'APIError', 'Timeout', 'ServiceUnavailableError', 'APIConnectionError', 'TryAgain')
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket():
+
+    def __init__(self, per_minute, burst_seconds=BURST_SECONDS):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    # Seconds until amount is available. Amounts larger than the bucket wait for
+    # it to fill rather than forever.
+    def wait(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+def retryAfter(e):
+    headers = getattr(e, 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        return float(value) if value != None else None
+    except ValueError:
+        return None
+
+def isRetryable(e):
+    errors = tuple(cls for cls in (getattr(openai.error, name, None) for name in RETRYABLE_ERRORS) if cls)
+    return isinstance(e, errors) or getattr(e, 'http_status', None) in RETRYABLE_STATUS
+
+def isRateLimited(e):
+    return type(e).__name__ == 'RateLimitError' or getattr(e, 'http_status', None) == 429
+
+# Shared by every channel in the process. Requests wait for the request and
+# token buckets in priority order, so a mention reply queued behind idle chatter
+# goes first. A 429 pauses every caller until its Retry-After has passed.
+class OpenAIClient():
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_retries=MAX_RETRIES, retry_base=RETRY_BASE, retry_max=RETRY_MAX, burst_seconds=BURST_SECONDS, logger=None):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.logger = logger if logger else logging.getLogger('retroBot.openai')
+        self.random = random.Random()
+        self.condition = Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.paused_until = 0
+        self.in_flight_lock = Lock()
+        self.in_flight = {}
+        self.stats_lock = Lock()
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'coalesced': 0,
+            'failed': 0,
+            'wait_seconds_total': 0.0,
+        }
+
+    def acquire(self, priority, tokens, deadline):
+        entry = (priority, next(self.sequence))
+        start = time.monotonic()
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = max(0, self.paused_until - now)
+                    if self.waiting[0] == entry and delay == 0:
+                        delay = max(
+                            self.requests.wait(1, now) if self.requests else 0,
+                            self.tokens.wait(tokens, now) if self.tokens else 0
+                        )
+                        if delay == 0:
+                            if self.requests: self.requests.take(1)
+                            if self.tokens: self.tokens.take(tokens)
+                            break
+                    if deadline != None and now + delay >= deadline:
+                        raise openai.error.Timeout(f'Rate limited past the request deadline ({len(self.waiting)} requests waiting)')
+                    timeout = delay if delay > 0 else None
+                    if deadline != None:
+                        timeout = min(timeout, deadline - now) if timeout else deadline - now
+                    self.condition.wait(timeout)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+        with self.stats_lock:
+            self.stats['wait_seconds_total'] += time.monotonic() - start
+
+    def pause(self, delay):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    # Full jitter backoff, or the server's Retry-After plus a little jitter so the
+    # callers it paused do not all return at once.
+    def retryDelay(self, e, attempt):
+        retry_after = retryAfter(e)
+        if retry_after != None:
+            return retry_after + self.random.uniform(0, self.retry_base)
+        return self.random.uniform(0, min(self.retry_max, self.retry_base * 2 ** attempt))
+
+    def execute(self, func, args, kwargs, priority, tokens, deadline):
+        attempt = 0
+        while True:
+            self.acquire(priority, tokens, deadline)
+            if deadline != None:
+                kwargs['request_timeout'] = max(0.001, deadline - time.monotonic())
+            with self.stats_lock:
+                self.stats['requests'] += 1
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not isRetryable(e) or attempt >= self.max_retries:
+                    with self.stats_lock:
+                        self.stats['failed'] += 1
+                    raise
+                attempt += 1
+                delay = self.retryDelay(e, attempt)
+                if deadline != None and time.monotonic() + delay >= deadline:
+                    with self.stats_lock:
+                        self.stats['failed'] += 1
+                    raise
+                with self.stats_lock:
+                    self.stats['retries'] += 1
+                    if isRateLimited(e): self.stats['rate_limited'] += 1
+                self.logger.warning(f'{getattr(func, "__qualname__", func)} failed with: {e}. Retrying in {delay:.2f} seconds')
+                if isRateLimited(e):
+                    self.pause(delay)
+                else:
+                    time.sleep(delay)
+
+    # Calls func under the rate limits with retries. With coalesce set, a call
+    # identical to one already in flight waits for that call's result instead of
+    # making its own request.
+    def request(self, func, *args, priority=PRIORITY_BACKGROUND, tokens=0, timeout=None, coalesce=False, **kwargs):
+        deadline = time.monotonic() + timeout if timeout else None
+        if not coalesce:
+            return self.execute(func, args, kwargs, priority, tokens, deadline)
+        key = (func, repr(args), tuple(sorted((name, repr(value)) for name, value in kwargs.items())))
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            leader = future == None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            with self.stats_lock:
+                self.stats['coalesced'] += 1
+            return future.result(timeout)
+        try:
+            result = self.execute(func, args, kwargs, priority, tokens, deadline)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+
+    def completion(self, priority=PRIORITY_CHATTER, timeout=None, **kwargs):
+        tokens = DataSet.estimateTokens(kwargs.get('prompt') or '') + kwargs.get('max_tokens', 16) * kwargs.get('n', 1)
+        return self.request(openai.Completion.create, priority=priority, tokens=tokens, timeout=timeout, coalesce=True, **kwargs)
+
+    def getStats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        with self.condition:
+            stats['waiting'] = len(self.waiting)
+        return stats
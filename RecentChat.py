@@ -0,0 +1,64 @@
+from array import array
+from threading import Lock
+
+# The usual rule of thumb for English text. DataSet.estimateTokens is closer but
+# runs a regex, which costs more than the rest of on_pubmsg's buffer update.
+CHARS_PER_TOKEN = 4
+# The newline joining each message to the next in a prompt
+LINE_TOKENS = 1
+
+# The last `capacity` filtered messages of a channel, for building reply prompts
+# without reading the database. Messages and their token counts live in slots
+# allocated up front and overwritten in turn, so the buffer never grows, and the
+# running token total is adjusted as messages come and go.
+class RecentChat():
+
+    def __init__(self, capacity=50):
+        self.capacity = capacity
+        self.messages = [None] * capacity
+        self.tokens = array('I', [0]) * capacity
+        self.head = 0
+        self.count = 0
+        self.total_tokens = 0
+        self.lock = Lock()
+
+    def add(self, message):
+        tokens = (len(message) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN + LINE_TOKENS
+        with self.lock:
+            self.messages[self.head] = message
+            self.total_tokens += tokens - self.tokens[self.head]
+            self.tokens[self.head] = tokens
+            self.head = (self.head + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+
+    # The most recent messages that fit in max_tokens, oldest first, each ending in
+    # a newline so the model continues with a new chat line as it was trained to.
+    # None while the buffer is empty.
+    def prompt(self, max_tokens):
+        messages = []
+        used = 0
+        with self.lock:
+            if self.count == 0:
+                return None
+            if self.total_tokens <= max_tokens:
+                start = (self.head - self.count) % self.capacity
+                messages = [self.messages[(start + i) % self.capacity] for i in range(self.count)]
+            else:
+                for i in range(1, self.count + 1):
+                    index = (self.head - i) % self.capacity
+                    used += self.tokens[index]
+                    if used > max_tokens:
+                        break
+                    messages.append(self.messages[index])
+                messages.reverse()
+        if not messages:
+            return None
+        return '\n'.join(messages) + '\n'
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'messages': self.count,
+                'tokens': self.total_tokens,
+            }
@@ -0,0 +1,214 @@
+import copy
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+import time
+from threading import Thread
+
+HEALTH_INTERVAL = 10
+RESTART_BASE = 5
+RESTART_MAX = 300
+
+def splitChannels(channels, shards):
+    assignments = [[] for i in range(shards)]
+    for i, channel in enumerate(channels):
+        assignments[i % shards].append(channel)
+    return [channels for channels in assignments if channels]
+
+# Config handed to a worker process. Saving does not touch the file; it sends
+# the shard's channel settings to the supervisor, which owns config.yaml.
+class ShardConfig(dict):
+
+    def __init__(self, config, shard, status_queue):
+        super().__init__(config)
+        self.shard = shard
+        self.status_queue = status_queue
+
+    def save(self):
+        self.status_queue.put(('config', self.shard, copy.deepcopy(self['twitch']['channels'])))
+
+# The fine tune job cap across every shard. Each slot is leased to a shard and
+# one of its channels. A shard that dies mid job never releases its lease, so
+# the supervisor reclaims the leases of any shard it sees exit before starting
+# it again.
+class FineTuneSlots():
+
+    def __init__(self, context, max_jobs, channels):
+        self.channels = list(channels)
+        self.condition = context.Condition()
+        self.shards = context.Array('i', [-1] * max_jobs, lock=False)
+        self.jobs = context.Array('i', [-1] * max_jobs, lock=False)
+        self.shard = None
+
+    # Called in the shard's process before any job runs
+    def bind(self, shard):
+        self.shard = shard
+
+    def acquire(self, channel):
+        job = self.channels.index(channel)
+        with self.condition:
+            while True:
+                for slot in range(len(self.shards)):
+                    if self.shards[slot] == -1:
+                        self.shards[slot] = self.shard
+                        self.jobs[slot] = job
+                        return
+                self.condition.wait()
+
+    def release(self, channel):
+        job = self.channels.index(channel)
+        with self.condition:
+            for slot in range(len(self.shards)):
+                if self.shards[slot] == self.shard and self.jobs[slot] == job:
+                    self.shards[slot] = -1
+                    self.jobs[slot] = -1
+                    break
+            self.condition.notify_all()
+
+    # Returns the channels whose leases were taken back
+    def reclaim(self, shard):
+        channels = []
+        with self.condition:
+            for slot in range(len(self.shards)):
+                if self.shards[slot] == shard:
+                    channels.append(self.channels[self.jobs[slot]])
+                    self.shards[slot] = -1
+                    self.jobs[slot] = -1
+            if channels:
+                self.condition.notify_all()
+        return channels
+
+def shardHealth(bot, shard, started):
+    handlers = list(bot.channel_activator.handlers.values())
+    return {
+        'pid': os.getpid(),
+        'shard': shard,
+        'uptime': time.monotonic() - started,
+        'channels': len(handlers),
+        'active_channels': sum(1 for handler in handlers if handler.active),
+        'messages': sum(handler.messages_received for handler in handlers),
+        'writer_queue_depth': sum(handler.componentStat(handler.writer, 'queue_depth') for handler in handlers),
+        'threads': threading.active_count(),
+        'generation_queue_depth': bot.generation_worker.getStats()['queue_depth'],
+        'fine_tunes_active': len(bot.fine_tune_scheduler.active),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def runShard(shard, config, status_queue, fine_tune_slots, health_interval):
+    from TwitchGPT import GPTBot, setup_logger
+    setup_logger('retroBot', filename=f'retroBot.shard{shard}')
+    logger = logging.getLogger(f'retroBot.shard{shard}')
+    config = ShardConfig(config, shard, status_queue)
+    fine_tune_slots.bind(shard)
+    bot = GPTBot(config, fine_tune_slots=fine_tune_slots)
+    started = time.monotonic()
+
+    def reportHealth():
+        while True:
+            try:
+                status_queue.put(('health', shard, shardHealth(bot, shard, started)))
+            except Exception as e:
+                logger.warning(f'Could not report shard health: {e}')
+            time.sleep(health_interval)
+
+    Thread(target=reportHealth, name='shard_health', daemon=True).start()
+    bot.start()
+
+class Supervisor():
+
+    def __init__(self, config, shards, health_interval=HEALTH_INTERVAL, logger=None):
+        self.config = config
+        self.health_interval = health_interval
+        self.logger = logger if logger else logging.getLogger('retroBot.supervisor')
+        self.context = multiprocessing.get_context('spawn')
+        self.status_queue = self.context.Queue()
+        self.fine_tune_slots = FineTuneSlots(self.context, config['gpt']['fine_tune_max_jobs'], config['twitch']['channels'])
+        self.assignments = splitChannels(list(config['twitch']['channels']), shards)
+        self.processes = {}
+        self.restarts = {}
+        self.restart_at = {}
+        self.health = {}
+
+    # The OpenAI limits are account wide, so each shard gets an equal share.
+    def shardConfig(self, shard):
+        config = {key: copy.deepcopy(self.config[key]) for key in ('gpt', 'twitch')}
+        channels = self.config['twitch']['channels']
+        config['twitch']['channels'] = {channel: copy.deepcopy(channels[channel]) for channel in self.assignments[shard]}
+        for limit in ('openai_requests_per_minute', 'openai_tokens_per_minute'):
+            if config['gpt'].get(limit):
+                config['gpt'][limit] = max(1, config['gpt'][limit] // len(self.assignments))
+        metrics = config['gpt'].get('metrics')
+        if metrics and metrics.get('port'):
+            metrics['port'] += shard
+        return config
+
+    def startShard(self, shard):
+        process = self.context.Process(
+            target=runShard,
+            args=(shard, self.shardConfig(shard), self.status_queue, self.fine_tune_slots, self.health_interval),
+            name=f'shard{shard}',
+            daemon=True
+        )
+        process.start()
+        self.processes[shard] = process
+        self.health[shard] = {'reported': time.monotonic(), 'messages': 0, 'rate': 0.0}
+        self.logger.info(f'Started shard {shard} (pid {process.pid}) with channels: {", ".join(self.assignments[shard])}')
+
+    def run(self):
+        for shard in range(len(self.assignments)):
+            self.startShard(shard)
+        try:
+            while True:
+                try:
+                    kind, shard, payload = self.status_queue.get(timeout=min(self.health_interval, RESTART_BASE))
+                    if kind == 'config':
+                        self.saveConfig(payload)
+                    elif kind == 'health':
+                        self.recordHealth(shard, payload)
+                except queue.Empty:
+                    pass
+                self.checkShards()
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+
+    def saveConfig(self, channels):
+        for channel, channel_config in channels.items():
+            self.config['twitch']['channels'][channel] = channel_config
+        self.config.save()
+
+    def recordHealth(self, shard, health):
+        now = time.monotonic()
+        previous = self.health.get(shard, {})
+        elapsed = now - previous.get('reported', now)
+        health['reported'] = now
+        health['rate'] = (health['messages'] - previous.get('messages', 0)) / elapsed if elapsed > 0 else 0.0
+        self.health[shard] = health
+        if health['uptime'] > RESTART_MAX:
+            self.restarts[shard] = 0
+        self.logger.debug(f"Shard {shard}: {health['active_channels']} of {health['channels']} channels active, {health['threads']} threads, {health['rate']:.1f} msg/s, writer queue {health['writer_queue_depth']}, generation queue {health['generation_queue_depth']}, {health['fine_tunes_active']} fine tunes, {health['max_rss_kb']} KiB max RSS")
+
+    def checkShards(self):
+        now = time.monotonic()
+        for shard, process in list(self.processes.items()):
+            if shard in self.restart_at:
+                if now >= self.restart_at[shard]:
+                    del self.restart_at[shard]
+                    self.startShard(shard)
+            elif not process.is_alive():
+                restarts = self.restarts.get(shard, 0)
+                delay = min(RESTART_MAX, RESTART_BASE * 2 ** restarts)
+                self.logger.error(f'Shard {shard} exited with code {process.exitcode}. Restarting in {delay} seconds')
+                reclaimed = self.fine_tune_slots.reclaim(shard)
+                if reclaimed:
+                    self.logger.warning(f'Reclaimed fine tune slots shard {shard} held for: {", ".join(reclaimed)}')
+                self.restarts[shard] = restarts + 1
+                self.restart_at[shard] = now + delay
+            elif now - self.health[shard]['reported'] > self.health_interval * 3:
+                self.logger.warning(f"Shard {shard} has not reported health for {now - self.health[shard]['reported']:.0f} seconds")
+
+    def getHealth(self):
+        return dict(self.health)
@@ -1,7 +1,17 @@
 from GPTHandler import GPTHandler
+from ChannelActivator import ChannelActivator
+from GenerationWorker import GenerationWorker
+from FineTuneScheduler import FineTuneScheduler
+from MessageFilter import MessageFilter, Blacklist
+from Metrics import MetricsRegistry, MetricsServer
+from OpenAIClient import OpenAIClient
+from Sharding import Supervisor
+from UserCache import UserIDCache
+import ChannelDB
+import LogPipeline
+from concurrent.futures import ThreadPoolExecutor
 import retroBot
 from retroBot.config import config as GPTConfig
-import re
 import logging
 import logging.handlers
 import os
@@ -9,20 +19,17 @@ import openai
 
 class GPTBot(retroBot.retroBot):
 
-    def __init__(self, config):
+    def __init__(self, config, fine_tune_slots=None):
         self.config = config
+        self.fine_tune_slots = fine_tune_slots
         openai.api_key = config['gpt']['api_key']
-        #self.blacklist_file = config['gpt']['blacklist_file']
-        #self.blacklist_words = self.load_blacklist(self.blacklist_file)
         self.username = config['twitch']['username']
         self.client_id = config['twitch']['client_id']
         self.client_secret = config['twitch']['client_secret']
-        for channel in config['twitch']['channels']:
-            channel_config = config['twitch']['channels'][channel]
-            for setting in config['gpt']['defaults']:
-                if not setting in channel_config or not channel_config[setting]:
-                    channel_config[setting] = config['gpt']['defaults'][setting]
-            self.config.save()
+        fill_defaults(config)
+        self.config.save()
+        self.initServices()
+        self.prepareChannels()
         super(GPTBot, self).__init__(
             config['twitch']['username'],
             config['twitch']['client_id'],
@@ -31,31 +38,87 @@ class GPTBot(retroBot.retroBot):
             handler=GPTHandler
         )
         
-    def load_blacklist(self, blacklist_file):
-        with open(blacklist_file, 'r') as f:
-            words = [line.rstrip('\n') for line in f]
-        return words
+    # Process-wide services shared by every GPTHandler. They must exist before
+    # retroBot creates the handlers.
+    def initServices(self):
+        self.user_ids = UserIDCache(
+            lambda: self.twitch,
+            os.path.join(ChannelDB.messageDir(self.config), 'users.json'),
+            ttl=self.config['gpt']['user_cache_ttl'],
+            logins=self.config['twitch']['channels']
+        )
+        metrics_config = self.config['gpt'].get('metrics') or {}
+        self.metrics = MetricsRegistry(enabled=bool(metrics_config.get('enabled')))
+        if self.metrics.enabled:
+            self.metrics_server = MetricsServer(self.metrics, metrics_config.get('host', '127.0.0.1'), metrics_config.get('port', 9108))
+        self.openai_client = OpenAIClient(
+            requests_per_minute=self.config['gpt']['openai_requests_per_minute'],
+            tokens_per_minute=self.config['gpt']['openai_tokens_per_minute'],
+            max_retries=self.config['gpt']['openai_max_retries']
+        )
+        self.blacklist_file = self.config['gpt'].get('blacklist_file')
+        self.blacklist = Blacklist(self.blacklist_file) if self.blacklist_file else None
+        self.message_filter = MessageFilter(blacklist=self.blacklist)
+        self.generation_worker = GenerationWorker(
+            workers=self.config['gpt']['generation_workers'],
+            timeout=self.config['gpt']['generation_timeout']
+        )
+        self.fine_tune_scheduler = FineTuneScheduler(
+            max_jobs=self.config['gpt']['fine_tune_max_jobs'],
+            poll_interval=self.config['gpt']['fine_tune_poll_interval'],
+            slots=getattr(self, 'fine_tune_slots', None)
+        )
+        self.metrics.gauge('twitchgpt_generation_queue_depth', 'Generation jobs waiting for a worker', lambda: [({}, self.generation_worker.getStats()['queue_depth'])])
+        self.metrics.gauge('twitchgpt_generation_coalesced', 'Generation triggers merged into a waiting job', lambda: [({}, self.generation_worker.getStats()['coalesced'])])
+        self.metrics.gauge('twitchgpt_generation_expired', 'Generation jobs dropped after their deadline', lambda: [({}, self.generation_worker.getStats()['expired'])])
+        for stat, help in (('retries', 'OpenAI requests retried'), ('rate_limited', 'OpenAI requests answered with a rate limit'), ('coalesced', 'OpenAI requests served by an identical one in flight'), ('waiting', 'OpenAI requests waiting for the rate limiter')):
+            self.metrics.gauge(f'twitchgpt_openai_{stat}', help, lambda stat=stat: [({}, self.openai_client.getStats()[stat])])
+        self.channel_activator = ChannelActivator(
+            lambda: self.twitch,
+            idle_timeout=self.config['gpt']['activation_idle_timeout'],
+            poll_interval=self.config['gpt']['activation_poll_interval']
+        )
+        self.metrics.gauge('twitchgpt_active_channels', 'Channels active rather than dormant', lambda: [({}, self.channel_activator.getStats()['active'])])
+        self.metrics.gauge('twitchgpt_threads', 'Threads in the process', lambda: [({}, self.channel_activator.getStats()['threads'])])
+        self.metrics.gauge('twitchgpt_fine_tune_active_jobs', 'Fine tuning jobs currently running', lambda: [({}, len(self.fine_tune_scheduler.active))])
+
+    # Schema setup for every channel runs in parallel before retroBot creates the
+    # handlers, which then find their databases ready.
+    def prepareChannels(self):
+        db_files = [ChannelDB.channelDBFile(self.config, channel) for channel in self.config['twitch']['channels']]
+        with ThreadPoolExecutor(max_workers=self.config['gpt']['startup_workers']) as pool:
+            list(pool.map(ChannelDB.prepareChannelDB, db_files))
 
     def checkBlacklisted(self, message):
         # Check words that the bot should NEVER learn.
-        for i in self.blacklist_words:
-            if re.search(r"\b" + i, message, re.IGNORECASE):
-                return True
-        return False
+        return self.blacklist != None and self.blacklist.isBlacklisted(message)
 
 
 def main():
     logger = setup_logger('retroBot')
     config = load_config(os.path.join(os.path.dirname(__file__), 'config.yaml'))
-    bot = GPTBot(config)
-    bot.start()
+    shards = config['gpt'].get('shards') or 1
+    if shards > 1:
+        fill_defaults(config)
+        config.save()
+        Supervisor(config, shards, health_interval=config['gpt'].get('shard_health_interval') or 10).run()
+    else:
+        bot = GPTBot(config)
+        bot.start()
+
+def fill_defaults(config):
+    for channel in config['twitch']['channels']:
+        channel_config = config['twitch']['channels'][channel]
+        for setting in config['gpt']['defaults']:
+            if not setting in channel_config or not channel_config[setting]:
+                channel_config[setting] = config['gpt']['defaults'][setting]
 
 def load_config(filename):
     config = GPTConfig(filename)
     config.save()
     return config
 
-def setup_logger(logname, logpath=""):
+def setup_logger(logname, logpath="", filename=None):
     if not logpath or logpath == "":
         logpath = os.path.join(os.path.dirname(__file__), 'logs')
     else:
@@ -64,15 +127,15 @@ def setup_logger(logname, logpath=""):
         os.mkdir(logpath)
     logger = logging.getLogger(logname)
     logger.setLevel(logging.DEBUG)
-    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(logpath, logname), when='midnight')
+    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(logpath, filename or logname), when='midnight')
     stream_handler = logging.StreamHandler()
-    form = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    form = LogPipeline.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
     file_handler.setFormatter(form)
     stream_handler.setFormatter(form)
     file_handler.setLevel(logging.INFO)
     stream_handler.setLevel(logging.DEBUG)
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    # Formatting and file and terminal writes happen on the listener thread, off the IRC callbacks
+    LogPipeline.attachQueue(logger, (file_handler, stream_handler))
     return logger
 
 if __name__ == '__main__':
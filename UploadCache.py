@@ -0,0 +1,147 @@
+import datetime
+import logging
+import sqlite3
+import openai
+from threading import Thread, Lock
+from FineTuneScheduler import ACTIVE_STATES
+
+def isMissing(e):
+    return getattr(e, 'http_status', None) == 404
+
+# Maps the SHA-256 of an uploaded file to its OpenAI file ID in the uploads table,
+# so a retry or restart that rebuilds the same dataset reuses the earlier upload
+# instead of sending the whole corpus again. A hit is confirmed with File.retrieve
+# in case the file was deleted on OpenAI's side.
+class UploadCache():
+
+    # request runs each API call, e.g. OpenAIClient.request. Calls go straight to
+    # openai without it.
+    def __init__(self, db_file, db_timeout=10, request=None, logger=None):
+        self.db_file = db_file
+        self.db_timeout = db_timeout
+        self.request = request if request else lambda func, *args, **kwargs: func(*args, **kwargs)
+        self.logger = logger if logger else logging.getLogger('retroBot.uploads')
+        self.lock = Lock()
+        self.cleanup_thread = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale': 0,
+            'deleted': 0,
+            'bytes_uploaded': 0,
+            'bytes_saved': 0,
+        }
+
+    def lookup(self, cursor, content_hash):
+        cursor.execute('select file_id from uploads where hash = ?', (content_hash,))
+        row = cursor.fetchone()
+        if row == None:
+            return None
+        try:
+            self.request(openai.File.retrieve, id=row[0])
+        except Exception as e:
+            if not isMissing(e):
+                raise
+            self.logger.info(f'Uploaded file {row[0]} no longer exists')
+            cursor.execute('delete from uploads where hash = ?', (content_hash,))
+            self.stats['stale'] += 1
+            return None
+        return row[0]
+
+    # Returns the file ID for dataset, uploading it only when no file with the
+    # same content hash is known. start_row and end_row record the message rows
+    # the file was built from.
+    def upload(self, dataset, content_hash, file_name, size, kind='training', start_row=None, end_row=None):
+        with self.lock:
+            connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
+            try:
+                cursor = connection.cursor()
+                now = datetime.datetime.now()
+                file_id = self.lookup(cursor, content_hash)
+                if file_id != None:
+                    cursor.execute('update uploads set last_used = ? where hash = ?', (now, content_hash))
+                    connection.commit()
+                    self.stats['hits'] += 1
+                    self.stats['bytes_saved'] += size
+                    self.logger.info(f'Reusing uploaded file {file_id} for {size} bytes of {kind} data')
+                    return file_id
+
+                # A retried upload must resend the file from the start. openai 0.x
+                # reads the file whole and builds the multipart body in memory, so
+                # an upload briefly holds about twice the dataset; the spooled file
+                # only bounds memory while the dataset is built.
+                def upload(**kwargs):
+                    dataset.seek(0)
+                    return openai.File.create(
+                        file=dataset,
+                        purpose="fine-tune",
+                        user_provided_filename=file_name,
+                        **kwargs
+                    )
+
+                resp = self.request(upload)
+                cursor.execute(
+                    'insert into uploads values (?, ?, ?, ?, ?, ?, ?, ?) on conflict(hash) do update set file_id = excluded.file_id, created = excluded.created, last_used = excluded.last_used',
+                    (content_hash, resp['id'], kind, size, start_row, end_row, now, now)
+                )
+                connection.commit()
+                cursor.close()
+                self.stats['misses'] += 1
+                self.stats['bytes_uploaded'] += size
+                self.logger.debug(
+                    "Uploaded file from {file}: {id}".format(
+                        file=file_name, id=resp["id"]
+                    )
+                )
+                return resp['id']
+            finally:
+                connection.close()
+
+    # Files named by an unfinished fine tune are kept, as is the newest upload of
+    # each kind while its rows are untrained, since a retry may rebuild the same
+    # dataset. Everything else has been trained on or superseded and is deleted
+    # from OpenAI. A file that fails to delete keeps its row for the next pass.
+    def cleanup(self, watermark):
+        with self.lock:
+            connection = sqlite3.connect(self.db_file, timeout=self.db_timeout)
+            try:
+                cursor = connection.cursor()
+                states = ', '.join('?' * len(ACTIVE_STATES))
+                cursor.execute(f'''
+                    select hash, file_id from uploads
+                    where end_row is not null
+                    and file_id not in (select file_id from fine_tunes where state in ({states}))
+                    and file_id not in (select validation_file_id from fine_tunes where state in ({states}) and validation_file_id is not null)
+                    and (end_row <= ? or end_row < (select max(end_row) from uploads as newer where newer.kind = uploads.kind))
+                ''', ACTIVE_STATES + ACTIVE_STATES + (watermark,))
+                for content_hash, file_id in cursor.fetchall():
+                    try:
+                        self.request(openai.File.delete, sid=file_id)
+                    except Exception as e:
+                        if not isMissing(e):
+                            self.logger.warning(f'Could not delete uploaded file {file_id}: {e}')
+                            continue
+                    cursor.execute('delete from uploads where hash = ?', (content_hash,))
+                    connection.commit()
+                    self.stats['deleted'] += 1
+                    self.logger.debug(f'Deleted uploaded file {file_id}')
+                cursor.close()
+            finally:
+                connection.close()
+
+    # Runs cleanup off the fine tuning thread. A pass still running is left to finish.
+    def startCleanup(self, watermark):
+        if self.cleanup_thread != None and self.cleanup_thread.is_alive():
+            return
+        self.cleanup_thread = Thread(target=self.runCleanup, args=(watermark,), name='upload_cleanup', daemon=True)
+        self.cleanup_thread.start()
+
+    def runCleanup(self, watermark):
+        try:
+            self.cleanup(watermark)
+        except Exception as e:
+            self.logger.error(f'Uploaded file cleanup failed: {e}')
+
+    # Not under the lock, which an upload holds for its whole transfer
+    def getStats(self):
+        return dict(self.stats)
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+BATCH_SIZE = 100
+TTL = 86400
+
+# Resolves Twitch logins to user IDs. Lookups are batched up to 100 logins per
+# get_users call and cached on disk, so a restart only asks Twitch about
+# channels whose entries have expired.
+class UserIDCache():
+
+    def __init__(self, get_twitch, cache_file, ttl=TTL, logins=(), logger=None):
+        self.get_twitch = get_twitch
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.logins = [login.lower() for login in logins]
+        self.logger = logger if logger else logging.getLogger('retroBot.users')
+        self.lock = Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning(f'Ignoring unreadable user cache {self.cache_file}: {e}')
+            return {}
+
+    # Shards share the cache file, each resolving only its own channels, so the
+    # file is merged rather than overwritten, keeping the newer of two entries.
+    # Each process writes its own temp file. Two shards saving at once can still
+    # lose one side's new entries, which only costs a lookup after the restart.
+    def save(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        for login, entry in self.load().items():
+            if login not in self.entries or self.entries[login][1] < entry[1]:
+                self.entries[login] = entry
+        temp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_file, self.cache_file)
+
+    def isFresh(self, login, now):
+        entry = self.entries.get(login)
+        return entry != None and now - entry[1] < self.ttl
+
+    def resolve(self, logins):
+        now = time.time()
+        missing = sorted({login.lower() for login in logins if not self.isFresh(login.lower(), now)})
+        if missing:
+            twitch = self.get_twitch()
+            for start in range(0, len(missing), BATCH_SIZE):
+                batch = missing[start:start + BATCH_SIZE]
+                for user in twitch.get_users(logins=batch)['data']:
+                    self.entries[user['login'].lower()] = [user['id'], now]
+            self.logger.debug(f'Resolved {len(missing)} Twitch users in {(len(missing) + BATCH_SIZE - 1) // BATCH_SIZE} requests')
+            self.save()
+        return {login.lower(): self.entries[login.lower()][0] for login in logins if login.lower() in self.entries}
+
+    # The first lookup resolves every known login at once, so handlers created
+    # one after another share a single round of requests.
+    def get(self, login):
+        login = login.lower()
+        with self.lock:
+            if not self.isFresh(login, time.time()):
+                self.resolve(set(self.logins) | {login})
+            if login not in self.entries:
+                raise KeyError(f'Twitch user not found: {login}')
+            return self.entries[login][0]
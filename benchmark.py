@@ -0,0 +1,821 @@
+import argparse
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+import json
+import random
+import string
+import re
+import copy
+import itertools
+import statistics
+import yaml
+import DataSet
+import ChannelDB
+import MessageStore
+import FakeOpenAI
+import LogPipeline
+from UserCache import UserIDCache
+from NGramModel import NGramModel
+from RecentChat import RecentChat
+from concurrent.futures import ThreadPoolExecutor
+from MessageFilter import Blacklist
+
+
+def random_message(rng, min_words=1, max_words=16):
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for i in range(rng.randint(min_words, max_words))]
+    return ' '.join(words)
+
+def create_message_db(db_file, row_count, seed=0):
+    rng = random.Random(seed)
+    connection = ChannelDB.openChannelDB(db_file)
+    table = MessageStore.segmentTable(MessageStore.currentSegment(connection))
+    connection.executemany(f'insert into {table}(message) values (?)', ((random_message(rng),) for i in range(row_count)))
+    connection.commit()
+    connection.close()
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+# The pre-streaming export: fetchall, quadratic string concatenation and one bytes blob.
+def legacy_export(db_file):
+    connection = sqlite3.connect(db_file)
+    cursor = connection.cursor()
+    cursor.execute(f'select rowid, message from {MessageStore.segmentTable(0)}')
+    rows = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    jsonl_content = ""
+    for row in rows:
+        jsonl_content += json.dumps({'prompt': '\n', 'completion': row[1]}) + '\n'
+    return io.BytesIO(bytes(jsonl_content, 'utf-8'))
+
+def streaming_export(db_file):
+    jsonl_file, row_count = DataSet.spoolDataSet(DataSet.iterRows(db_file))
+    return jsonl_file
+
+# The spool bounds the export, but the upload still holds the whole file in
+# memory, twice over, as openai 0.x and requests build the request body.
+def bench_export(args):
+    print(f'{"rows":>10} {"method":>10} {"seconds":>10} {"peak MiB":>10} {"upload s":>10} {"upload MiB":>10} {"bytes":>12}')
+    for row_count in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'bench.db')
+            create_message_db(db_file, row_count, args.seed)
+            methods = [('streaming', streaming_export)]
+            if not args.skip_legacy:
+                methods.insert(0, ('legacy', legacy_export))
+            for name, func in methods:
+                jsonl_file, elapsed, peak = measure(func, db_file)
+                size = jsonl_file.seek(0, os.SEEK_END)
+                jsonl_file.seek(0)
+                resp, upload_elapsed, upload_peak = measure(FakeOpenAI.File.create, file=jsonl_file, purpose='fine-tune')
+                jsonl_file.close()
+                print(f'{row_count:>10} {name:>10} {elapsed:>10.3f} {peak / 2**20:>10.2f} {upload_elapsed:>10.3f} {upload_peak / 2**20:>10.2f} {size:>12}')
+
+def bench_dataset(args):
+    print(f'{"rows":>10} {"sampling":>10} {"budget":>10} {"seconds":>8} {"rows/s":>10} {"kept":>8} {"valid":>6} {"tokens":>10} {"bytes":>12}')
+    for row_count in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'bench.db')
+            create_message_db(db_file, row_count, args.seed)
+            jsonl_file, full_count = DataSet.spoolDataSet(DataSet.iterRows(db_file))
+            full_size = jsonl_file.seek(0, os.SEEK_END)
+            jsonl_file.close()
+            print(f'{row_count:>10} {"none":>10} {"-":>10} {"":>8} {"":>10} {full_count:>8} {0:>6} {"":>10} {full_size:>12}')
+            for sampling in args.sampling:
+                for budget in args.budget:
+                    builder = DataSet.DataSetBuilder(budget, sampling, args.validation, args.seed, args.min_words, args.min_chars)
+                    training, validation, stats = builder.build(DataSet.iterRows(db_file))
+                    training.close()
+                    if validation:
+                        validation.close()
+                    size = stats['training_bytes'] + stats['validation_bytes']
+                    print(f"{row_count:>10} {sampling:>10} {budget or '-':>10} {stats['seconds']:>8.3f} {stats['rows_per_second']:>10.0f} {stats['training_rows']:>8} {stats['validation_rows']:>6} {stats['tokens']:>10} {size:>12}")
+
+# The pre-segment prune: delete the trained rows from one table, then rewrite the file.
+def legacy_prune(db_file, trained, untrained, rng):
+    connection = sqlite3.connect(db_file)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('create table messages(message TEXT NOT NULL)')
+    connection.executemany('insert into messages values (?)', ((random_message(rng),) for i in range(trained + untrained)))
+    connection.commit()
+    start = time.perf_counter()
+    connection.execute('delete from messages where rowid <= ?', (trained,))
+    connection.commit()
+    connection.execute('vacuum')
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return elapsed
+
+def segmented_prune(db_file, trained, untrained, rng):
+    ChannelDB.prepareChannelDB(db_file)
+    store = MessageStore.MessageStore(db_file)
+    connection = sqlite3.connect(db_file)
+    store.insert(connection, [random_message(rng) for i in range(trained)])
+    cutoff_row = store.rotate()
+    store.insert(connection, [random_message(rng) for i in range(untrained)])
+    start = time.perf_counter()
+    store.dropSegments(connection, cutoff_row)
+    connection.commit()
+    connection.executescript('PRAGMA incremental_vacuum')
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return elapsed
+
+def bench_prune(args):
+    print(f'{"rows":>10} {"method":>10} {"seconds":>10} {"MiB after":>10}')
+    for row_count in args.rows:
+        untrained = int(row_count * args.untrained)
+        methods = [('segmented', segmented_prune)]
+        if not args.skip_legacy:
+            methods.insert(0, ('legacy', legacy_prune))
+        for name, func in methods:
+            with tempfile.TemporaryDirectory() as tmp:
+                db_file = os.path.join(tmp, 'bench.db')
+                elapsed = func(db_file, row_count, untrained, random.Random(args.seed))
+                size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+                print(f'{row_count:>10} {name:>10} {elapsed:>10.3f} {size / 2**20:>10.2f}')
+
+# The per-word loop from the old GPTBot.checkBlacklisted.
+def legacy_blacklisted(words, message):
+    for i in words:
+        if re.search(r"\b" + i, message, re.IGNORECASE):
+            return True
+    return False
+
+def bench_filter(args):
+    rng = random.Random(args.seed)
+    messages = [random_message(rng) for i in range(args.messages)]
+    print(f'{"words":>8} {"method":>10} {"seconds":>10} {"us/msg":>10} {"matches":>8}')
+    for word_count in args.words:
+        words = sorted({random_message(rng, 1, 1) for i in range(word_count)})
+        with tempfile.TemporaryDirectory() as tmp:
+            blacklist_file = os.path.join(tmp, 'blacklist.txt')
+            with open(blacklist_file, 'w') as f:
+                f.write('\n'.join(words))
+            start = time.perf_counter()
+            blacklist = Blacklist(blacklist_file)
+            compile_time = time.perf_counter() - start
+            methods = [('compiled', blacklist.isBlacklisted)]
+            if not args.skip_legacy:
+                methods.insert(0, ('legacy', lambda message: legacy_blacklisted(words, message)))
+            for name, func in methods:
+                start = time.perf_counter()
+                matches = sum(1 for message in messages if func(message))
+                elapsed = time.perf_counter() - start
+                print(f'{len(words):>8} {name:>10} {elapsed:>10.3f} {elapsed / len(messages) * 1e6:>10.2f} {matches:>8}')
+            print(f'{len(words):>8} {"compile":>10} {compile_time:>10.3f}')
+
+class StubTwitch():
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.user_ids = {}
+        self.live = set()
+        self.calls = 0
+
+    def get_users(self, logins=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        data = []
+        for login in logins or []:
+            user_id = self.user_ids.setdefault(login, str(len(self.user_ids) + 1000))
+            data.append({'id': user_id, 'login': login, 'display_name': login})
+        return {'data': data}
+
+    def get_streams(self, user_id=None, first=20, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return {'data': [{'user_id': id, 'type': 'live'} for id in user_id or [] if id in self.live]}
+
+class StubEvent():
+
+    def __init__(self, channel, username, content, emotes=''):
+        self.type = 'pubmsg'
+        self.source = f'{username}!{username}@{username}.tmi.twitch.tv'
+        self.target = f'#{channel}'
+        self.arguments = [content]
+        self.tags = [
+            {'key': 'badge-info', 'value': None},
+            {'key': 'badges', 'value': None},
+            {'key': 'color', 'value': None},
+            {'key': 'display-name', 'value': username},
+            {'key': 'emotes', 'value': emotes or None},
+            {'key': 'first-msg', 'value': '0'},
+            {'key': 'id', 'value': f'{channel}-{username}-{time.monotonic_ns()}'},
+            {'key': 'mod', 'value': '0'},
+            {'key': 'room-id', 'value': '1'},
+            {'key': 'subscriber', 'value': '0'},
+            {'key': 'tmi-sent-ts', 'value': str(int(time.time() * 1000))},
+            {'key': 'turbo', 'value': '0'},
+            {'key': 'user-id', 'value': str(abs(hash(username)) % 10**8)},
+            {'key': 'user-type', 'value': None},
+        ]
+
+def load_replay_log(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            username, separator, content = line.partition(': ')
+            if not separator:
+                username, content = 'viewer', line
+            yield username, content
+
+def synthetic_replay_log(seed, bot_username, mention_rate=0.01):
+    rng = random.Random(seed)
+    usernames = [f'viewer{i}' for i in range(200)]
+    copypasta = [random_message(rng, 8, 16) for i in range(20)]
+    while True:
+        roll = rng.random()
+        if roll < mention_rate:
+            content = f'@{bot_username} {random_message(rng)}'
+        elif roll < 0.15:
+            content = rng.choice(copypasta)
+        elif roll < 0.2:
+            content = 'Kappa'
+        else:
+            content = random_message(rng)
+        yield rng.choice(usernames), content
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# The bot's file and terminal handlers, with the terminal swapped for /dev/null.
+# 'direct' attaches them to the logger as setup_logger used to, 'queue' puts them
+# behind the logging pipeline.
+def replay_logging(mode, log_dir):
+    logger = logging.getLogger('retroBot')
+    logger.setLevel(logging.DEBUG)
+    if mode == 'off':
+        return None, []
+    file_handler = logging.FileHandler(os.path.join(log_dir, 'replay.log'))
+    stream_handler = logging.StreamHandler(open(os.devnull, 'w'))
+    form = LogPipeline.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    file_handler.setFormatter(form)
+    stream_handler.setFormatter(form)
+    file_handler.setLevel(logging.INFO)
+    stream_handler.setLevel(logging.DEBUG)
+    if mode == 'direct':
+        logger.addHandler(file_handler)
+        logger.addHandler(stream_handler)
+        return None, [file_handler, stream_handler]
+    queue_handler = LogPipeline.attachQueue(logger, (file_handler, stream_handler))
+    return queue_handler, [queue_handler]
+
+def replay_config(args, message_dir):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config['gpt']['message_dir'] = message_dir
+    config['gpt']['user_cache_ttl'] = 86400
+    config['gpt']['fine_tune_poll_interval'] = args.poll_interval
+    config['gpt']['metrics'] = {'enabled': args.metrics, 'host': '127.0.0.1', 'port': 0}
+    config['gpt']['activation_idle_timeout'] = args.idle_timeout
+    config['twitch']['username'] = 'benchbot'
+    defaults = config['gpt']['defaults']
+    defaults['send_messages'] = False
+    defaults['message_count_cutoff'] = args.cutoff
+    defaults['generate_on'] = args.generate_on
+    defaults['dataset_token_budget'] = args.token_budget
+    defaults['dataset_validation_fraction'] = args.validation
+    defaults['ngram'] = args.ngram
+    defaults['context_messages'] = args.context_messages
+    config['twitch']['channels'] = {f'channel{i}': copy.deepcopy(defaults) for i in range(args.channels)}
+    return config
+
+# GPTBot's shared services without retroBot's IRC connection. FakeOpenAI must be
+# installed first.
+def stub_bot(config, twitch):
+    from TwitchGPT import GPTBot
+
+    class StubBot():
+        initServices = GPTBot.initServices
+        checkBlacklisted = GPTBot.checkBlacklisted
+
+        def __init__(self, config, twitch):
+            self.config = config
+            self.username = config['twitch']['username']
+            self.twitch = twitch
+            self.initServices()
+
+    return StubBot(config, twitch)
+
+def bench_replay(args):
+    FakeOpenAI.install()
+    FakeOpenAI.reset(latency=args.openai_latency, failure_rate=args.failure_rate, training_polls=args.training_polls, seed=args.seed, rate_limit_rate=args.rate_limit_rate)
+    from GPTHandler import GPTHandler
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queue_handler, log_handlers = replay_logging(args.logging, tmp)
+        config = replay_config(args, tmp)
+        bot = stub_bot(config, StubTwitch(args.twitch_latency))
+
+        cycle_times = []
+        run_job = bot.fine_tune_scheduler.runJob
+        def timed_run_job(handler):
+            start = time.perf_counter()
+            run_job(handler)
+            cycle_times.append(time.perf_counter() - start)
+        bot.fine_tune_scheduler.runJob = timed_run_job
+
+        start = time.perf_counter()
+        handlers = [GPTHandler(channel, bot) for channel in config['twitch']['channels']]
+        startup = time.perf_counter() - start
+
+        if args.log:
+            source = itertools.cycle(list(load_replay_log(args.log)))
+        else:
+            source = synthetic_replay_log(args.seed, bot.username, args.mention_rate)
+        latencies = []
+        interval = 1 / args.rate if args.rate else 0
+        start = time.perf_counter()
+        for i, (username, content) in enumerate(itertools.islice(source, args.messages)):
+            handler = handlers[i % len(handlers)]
+            event = StubEvent(handler.channel, username, content)
+            if interval:
+                delay = start + i * interval - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+            call_start = time.perf_counter()
+            handler.on_pubmsg(None, event)
+            latencies.append(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start
+
+        for handler in handlers:
+            if handler.writer:
+                handler.writer.close()
+            if handler.ngram_model:
+                handler.ngram_model.close()
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline and (bot.fine_tune_scheduler.active or any(handler.fine_tune_trigger.isReady() for handler in handlers)):
+            time.sleep(0.05)
+        writer_stats = [handler.writer.getStats() for handler in handlers if handler.writer]
+        log_stats = LogPipeline.getStats(queue_handler) if queue_handler else None
+        if queue_handler:
+            LogPipeline.detachQueue(logging.getLogger('retroBot'), queue_handler)
+        for handler in log_handlers:
+            logging.getLogger('retroBot').removeHandler(handler)
+            handler.close()
+
+    written = sum(stats['written'] for stats in writer_stats)
+    flush_seconds = sum(stats['flush_seconds_total'] for stats in writer_stats)
+    flushes = sum(stats['flushes'] for stats in writer_stats)
+    print(f'channels:               {len(handlers)}')
+    print(f'startup:                {startup:.3f} s ({bot.twitch.calls} Twitch lookups)')
+    print(f'messages:               {len(latencies)} in {elapsed:.3f} s ({len(latencies) / elapsed:.0f} msg/s)')
+    print(f'on_pubmsg p50 / p99:    {percentile(latencies, 0.5) * 1e6:.1f} / {percentile(latencies, 0.99) * 1e6:.1f} us')
+    print(f'on_pubmsg mean / max:   {statistics.mean(latencies) * 1e6:.1f} / {max(latencies) * 1e6:.1f} us')
+    print(f'rows written:           {written} ({sum(stats["deduplicated"] for stats in writer_stats)} deduplicated, {sum(stats["dropped"] for stats in writer_stats)} dropped, {sum(stats["failed"] for stats in writer_stats)} failed)')
+    print(f'db write cost:          {flushes} flushes, {flush_seconds:.3f} s total, {flush_seconds / written * 1e6 if written else 0:.1f} us/row')
+    print(f'generation:             {bot.generation_worker.getStats()}')
+    print(f'fine-tune cycles:       {len(cycle_times)}' + (f', mean {statistics.mean(cycle_times):.3f} s, max {max(cycle_times):.3f} s' if cycle_times else ''))
+    print(f'openai calls:           {FakeOpenAI.state.calls}')
+    print(f'openai client:          {bot.openai_client.getStats()}')
+    upload_stats = [handler.upload_cache.getStats() for handler in handlers if handler.upload_cache]
+    print(f"upload cache:           {sum(stats['hits'] for stats in upload_stats)} hits, {sum(stats['misses'] for stats in upload_stats)} misses, {sum(stats['deleted'] for stats in upload_stats)} deleted")
+    if log_stats:
+        print(f'logging:                {log_stats}')
+    if args.ngram != 'off':
+        ngram_stats = [handler.ngram_model.getStats() for handler in handlers if handler.ngram_model]
+        print(f"n-gram models:          {sum(stats['generated'] for stats in ngram_stats)} generated, {sum(stats['tokens'] for stats in ngram_stats)} tokens, {sum(stats['edges'] for stats in ngram_stats)} edges")
+
+# Chat with word frequencies following Zipf's law, closer to real chat than
+# uniformly random words for an n-gram model.
+def zipf_messages(rng, count, vocab_size=20000, max_words=12):
+    vocab = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 8))) for i in range(vocab_size)]
+    weights = list(itertools.accumulate(1 / (i + 1) for i in range(vocab_size)))
+    return [' '.join(rng.choices(vocab, cum_weights=weights, k=rng.randint(1, max_words))) for i in range(count)]
+
+def bench_ngram(args):
+    print(f'{"messages":>10} {"tokens":>10} {"edges":>10} {"us/token":>9} {"MiB/Mtok":>9} {"gen p50":>8} {"gen p99":>8} {"file MiB":>9} {"save s":>7} {"load s":>7}')
+    for message_count in args.messages:
+        rng = random.Random(args.seed)
+        messages = zipf_messages(rng, message_count, args.vocab)
+        tokens = sum(len(message.split()) for message in messages)
+        with tempfile.TemporaryDirectory() as tmp:
+            model_file = os.path.join(tmp, 'bench.ngram')
+            model = NGramModel(order=args.order, model_file=model_file, save_interval=float('inf'))
+            # Timed without tracing, which slows the update loop several times over
+            start = time.perf_counter()
+            for i in range(0, len(messages), args.batch_size):
+                model.update(messages[i:i + args.batch_size])
+            update = time.perf_counter() - start
+            tracemalloc.start()
+            traced = NGramModel(order=args.order)
+            for i in range(0, len(messages), args.batch_size):
+                traced.update(messages[i:i + args.batch_size])
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del traced
+            latencies = []
+            for i in range(args.generations):
+                start = time.perf_counter()
+                model.generate(max_words=args.max_words, rng=rng)
+                latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            model.save()
+            save = time.perf_counter() - start
+            size = os.path.getsize(model_file)
+            start = time.perf_counter()
+            NGramModel(order=args.order, model_file=model_file)
+            load = time.perf_counter() - start
+        print(f"{message_count:>10} {tokens:>10} {model.getStats()['edges']:>10} {update / tokens * 1e6:>9.2f} {memory / 2**20 / tokens * 1e6:>9.1f} {percentile(latencies, 0.5) * 1e6:>8.1f} {percentile(latencies, 0.99) * 1e6:>8.1f} {size / 2**20:>9.1f} {save:>7.3f} {load:>7.3f}")
+
+# The alternative to the ring buffer: read the latest rows back from the channel
+# database for every prompt.
+def db_prompt(connection, count, max_tokens):
+    table = MessageStore.segmentTable(MessageStore.currentSegment(connection))
+    messages = []
+    used = 0
+    for (message,) in connection.execute(f'select message from {table} order by id desc limit ?', (count,)):
+        used += DataSet.estimateTokens(message) + 1
+        if used > max_tokens:
+            break
+        messages.append(message)
+    messages.reverse()
+    return '\n'.join(messages) + '\n'
+
+def bench_context(args):
+    rng = random.Random(args.seed)
+    messages = [random_message(rng) for i in range(args.messages)]
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'bench.db')
+        create_message_db(db_file, args.db_rows, args.seed)
+        connection = sqlite3.connect(db_file)
+        print(f'{"capacity":>9} {"budget":>7} {"add us":>7} {"KiB":>8} {"growth B":>8} {"prompt us":>10} {"p99 us":>8} {"db us":>8} {"db p99":>8} {"tokens":>7}')
+        for capacity in args.capacity:
+            for budget in args.budget:
+                tracemalloc.start()
+                recent_chat = RecentChat(capacity)
+                for message in messages[:capacity]:
+                    recent_chat.add(message)
+                filled = tracemalloc.get_traced_memory()[0]
+                for message in messages[capacity:]:
+                    recent_chat.add(message)
+                growth = tracemalloc.get_traced_memory()[0] - filled
+                tracemalloc.stop()
+                # Timed again untraced, as tracing slows every allocation
+                recent_chat = RecentChat(capacity)
+                start = time.perf_counter()
+                for message in messages:
+                    recent_chat.add(message)
+                add = (time.perf_counter() - start) / len(messages)
+                latencies = []
+                for i in range(args.prompts):
+                    start = time.perf_counter()
+                    prompt = recent_chat.prompt(budget)
+                    latencies.append(time.perf_counter() - start)
+                db_latencies = []
+                for i in range(args.prompts):
+                    start = time.perf_counter()
+                    db_prompt(connection, capacity, budget)
+                    db_latencies.append(time.perf_counter() - start)
+                print(f"{capacity:>9} {budget:>7} {add * 1e6:>7.2f} {filled / 1024:>8.1f} {growth:>8} {percentile(latencies, 0.5) * 1e6:>10.1f} {percentile(latencies, 0.99) * 1e6:>8.1f} {percentile(db_latencies, 0.5) * 1e6:>8.1f} {percentile(db_latencies, 0.99) * 1e6:>8.1f} {DataSet.estimateTokens(prompt):>7}")
+        connection.close()
+
+def thread_count():
+    import threading
+    return threading.active_count()
+
+# Many configured channels, most of them idle. Compares starting every channel
+# eagerly with lazy activation, where only channels with traffic or a live
+# stream come up, then lets the idle ones time out.
+def bench_activation(args):
+    FakeOpenAI.install()
+    FakeOpenAI.reset(latency=0, seed=args.seed)
+    from GPTHandler import GPTHandler
+    rng = random.Random(args.seed)
+    print(f'{"channels":>9} {"mode":>6} {"startup s":>10} {"active":>7} {"threads":>8} {"MiB":>8} {"KiB/chan":>9} {"after idle":>11} {"threads":>8} {"MiB":>8}')
+    for channel_count in args.channels:
+        for mode in ('eager', 'lazy'):
+            with tempfile.TemporaryDirectory() as tmp:
+                args.idle_timeout = 0 if mode == 'eager' else 3600
+                args.cutoff = 2000
+                args.generate_on = 10 ** 9
+                args.token_budget = args.validation = args.context_messages = 0
+                args.poll_interval = 30
+                args.metrics = False
+                args.ngram = 'fallback'
+                args.channels = channel_count
+                config = replay_config(args, tmp)
+                config['gpt']['activation_poll_interval'] = 3600
+                twitch = StubTwitch()
+                tracemalloc.start()
+                baseline_threads = thread_count()
+                bot = stub_bot(config, twitch)
+                start = time.perf_counter()
+                handlers = [GPTHandler(channel, bot) for channel in config['twitch']['channels']]
+                startup = time.perf_counter() - start
+                busy = rng.sample(handlers, max(1, int(channel_count * args.busy)))
+                live = rng.sample(handlers, max(1, int(channel_count * args.live)))
+                twitch.live = {handler.user_id for handler in live}
+                for i in range(args.messages):
+                    handler = busy[i % len(busy)]
+                    handler.on_pubmsg(None, StubEvent(handler.channel, f'viewer{i % 50}', random_message(rng)))
+                if mode == 'lazy':
+                    bot.channel_activator.check()
+                bot.channel_activator.pool.submit(lambda: None).result()
+                time.sleep(0.5)
+                active = sum(1 for handler in handlers if handler.active)
+                threads = thread_count() - baseline_threads
+                memory = tracemalloc.get_traced_memory()[0]
+                # Everything but the live streams goes quiet past the timeout
+                if mode == 'lazy':
+                    for handler in handlers:
+                        handler.last_activity -= 7200
+                    bot.channel_activator.check()
+                    bot.channel_activator.pool.shutdown(wait=True)
+                    idle_active = sum(1 for handler in handlers if handler.active)
+                    idle_threads = thread_count() - baseline_threads
+                    idle_memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                after = f'{idle_active:>11} {idle_threads:>8} {idle_memory / 2**20:>8.1f}' if mode == 'lazy' else f'{"-":>11} {"-":>8} {"-":>8}'
+                print(f'{channel_count:>9} {mode:>6} {startup:>10.3f} {active:>7} {threads:>8} {memory / 2**20:>8.1f} {memory / channel_count / 1024:>9.1f} {after}')
+                for handler in handlers:
+                    if handler.writer:
+                        handler.writer.close()
+                    if handler.ngram_model:
+                        handler.ngram_model.close()
+        if args.resources:
+            for resources in bot.channel_activator.getResources()[:args.resources]:
+                print(resources)
+
+# Concurrent completions against a fake that enforces requests per minute with
+# 429s. Direct calls fail once over the limit; the client queues and retries.
+def bench_ratelimit(args):
+    FakeOpenAI.install()
+    from OpenAIClient import OpenAIClient, PRIORITY_REPLY, PRIORITY_CHATTER
+
+    def run(name, call):
+        FakeOpenAI.reset(latency=args.openai_latency, rate_limit=args.server_limit, rate_window=args.window, retry_after=args.retry_after, seed=args.seed)
+        latencies = {PRIORITY_REPLY: [], PRIORITY_CHATTER: []}
+        failures = 0
+
+        def request(i):
+            priority = PRIORITY_REPLY if i % args.reply_every == 0 else PRIORITY_CHATTER
+            prompt = f'prompt {i % args.distinct}'
+            start = time.perf_counter()
+            try:
+                call(priority, prompt)
+            except Exception:
+                return priority, None
+            return priority, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for priority, latency in pool.map(request, range(args.requests)):
+                if latency == None:
+                    failures += 1
+                else:
+                    latencies[priority].append(latency)
+        elapsed = time.perf_counter() - start
+        for priority, label in ((PRIORITY_REPLY, 'reply'), (PRIORITY_CHATTER, 'chatter')):
+            values = latencies[priority]
+            p50 = percentile(values, 0.5) if values else 0
+            p99 = percentile(values, 0.99) if values else 0
+            print(f'{name:>8} {label:>8} {len(values):>6} {p50:>8.3f} {p99:>8.3f}', end='')
+            print(f' {failures:>8} {FakeOpenAI.state.calls.get("rate_limited", 0):>6} {elapsed:>8.2f}' if priority == PRIORITY_CHATTER else '')
+
+    print(f'{"method":>8} {"class":>8} {"ok":>6} {"p50 s":>8} {"p99 s":>8} {"failures":>8} {"429s":>6} {"seconds":>8}')
+    if not args.skip_legacy:
+        run('direct', lambda priority, prompt: FakeOpenAI.Completion.create(model='ada', prompt=prompt, max_tokens=16))
+    client_rpm = args.server_limit * 60 / args.window * args.client_share if args.client_share else 0
+    client = OpenAIClient(requests_per_minute=client_rpm, max_retries=args.max_retries, retry_base=0.05, burst_seconds=args.window / 2)
+    run('client', lambda priority, prompt: client.completion(priority=priority, model='ada', prompt=prompt, max_tokens=16))
+    print(f'client stats: {client.getStats()}')
+
+# The pre-batching startup: one get_users call and a full schema setup per channel, in turn.
+# Fine-tune rounds in which every round but the last attempt fails after the
+# upload, as a failed FineTune.create or a restart would, with no new chat in
+# between. Each round then succeeds and moves the watermark on.
+def bench_uploads(args):
+    FakeOpenAI.install()
+    from UploadCache import UploadCache
+
+    print(f'{"mode":>8} {"creates":>8} {"retrieves":>9} {"deletes":>8} {"hits":>6} {"misses":>6} {"MiB sent":>9} {"files left":>10} {"seconds":>8}')
+    for mode in ('legacy', 'cached'):
+        FakeOpenAI.reset(latency=args.openai_latency, seed=args.seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'bench.db')
+            upload_cache = UploadCache(db_file)
+            builder = DataSet.DataSetBuilder(validation_fraction=args.validation, seed=args.seed)
+            watermark = 0
+            sent = 0
+            elapsed = 0
+            for round in range(args.rounds):
+                create_message_db(db_file, args.rows, args.seed + round)
+                cutoff_row = DataSet.getLastRow(db_file)
+                start = time.perf_counter()
+                for attempt in range(args.attempts):
+                    training, validation, stats = builder.build(DataSet.iterRows(db_file, start_row=watermark, end_row=cutoff_row))
+                    for kind, dataset in (('training', training), ('validation', validation)):
+                        if dataset == None:
+                            continue
+                        file_name = f'bench_{time.time()}_{kind}'
+                        if mode == 'legacy':
+                            FakeOpenAI.File.create(file=dataset, purpose='fine-tune', user_provided_filename=file_name)
+                            sent += stats[f'{kind}_bytes']
+                        else:
+                            upload_cache.upload(dataset, stats[f'{kind}_hash'], file_name, stats[f'{kind}_bytes'], kind=kind, start_row=watermark, end_row=cutoff_row)
+                        dataset.close()
+                watermark = cutoff_row
+                if mode == 'cached':
+                    upload_cache.cleanup(watermark)
+                elapsed += time.perf_counter() - start
+        calls = FakeOpenAI.state.calls
+        cache_stats = upload_cache.getStats()
+        if mode == 'cached':
+            sent = cache_stats['bytes_uploaded']
+        print(f"{mode:>8} {calls.get('File.create', 0):>8} {calls.get('File.retrieve', 0):>9} {calls.get('File.delete', 0):>8} {cache_stats['hits'] if mode == 'cached' else '-':>6} {cache_stats['misses'] if mode == 'cached' else '-':>6} {sent / 2**20:>9.2f} {len(FakeOpenAI.state.files):>10} {elapsed:>8.3f}")
+
+def legacy_startup(twitch, db_dir, channels):
+    for channel in channels:
+        twitch.get_users(logins=[channel])['data'][0]['id']
+        connection = sqlite3.connect(os.path.join(db_dir, f'{channel}.db'))
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.commit()
+        for statement in ChannelDB.SCHEMA:
+            connection.execute(statement)
+            connection.commit()
+        connection.close()
+
+def batched_startup(twitch, db_dir, channels, workers):
+    user_ids = UserIDCache(lambda: twitch, os.path.join(db_dir, 'users.json'), logins=channels)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(ChannelDB.prepareChannelDB, [os.path.join(db_dir, f'{channel}.db') for channel in channels]))
+    for channel in channels:
+        user_ids.get(channel)
+
+# Real GPTHandlers on the stub bot, so retroBot's own per-channel lookup in
+# channelHandler.__init__ is counted along with the cache's.
+def handler_startup(twitch, db_dir, channels):
+    FakeOpenAI.install()
+    from GPTHandler import GPTHandler
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config['gpt']['message_dir'] = db_dir
+    config['gpt']['metrics'] = {'enabled': False}
+    config['twitch']['username'] = 'benchbot'
+    config['twitch']['channels'] = {channel: copy.deepcopy(config['gpt']['defaults']) for channel in channels}
+    bot = stub_bot(config, twitch)
+    handlers = [GPTHandler(channel, bot) for channel in channels]
+    for handler in handlers:
+        if handler.writer:
+            handler.writer.close()
+        if handler.ngram_model:
+            handler.ngram_model.close()
+
+def bench_startup(args):
+    print(f'{"channels":>8} {"method":>12} {"seconds":>10} {"lookups":>8}')
+    for channel_count in args.channels:
+        channels = [f'channel{i}' for i in range(channel_count)]
+        runs = [('legacy', legacy_startup, ()), ('cold', batched_startup, (args.workers,)), ('warm', batched_startup, (args.workers,))]
+        if args.handlers:
+            runs.append(('handlers', handler_startup, ()))
+        with tempfile.TemporaryDirectory() as legacy_dir, tempfile.TemporaryDirectory() as batched_dir, tempfile.TemporaryDirectory() as handler_dir:
+            for name, func, extra in runs:
+                twitch = StubTwitch(args.twitch_latency)
+                start = time.perf_counter()
+                func(twitch, {'legacy': legacy_dir, 'handlers': handler_dir}.get(name, batched_dir), channels, *extra)
+                elapsed = time.perf_counter() - start
+                print(f'{channel_count:>8} {name:>12} {elapsed:>10.3f} {twitch.calls:>8}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for TwitchGPT')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Dataset export memory and time against row count')
+    export_parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    export_parser.add_argument('--seed', type=int, default=0)
+    export_parser.add_argument('--skip-legacy', action='store_true', help='Only run the streaming export')
+    export_parser.set_defaults(func=bench_export)
+
+    dataset_parser = subparsers.add_parser('dataset', help='Dataset builder throughput and output size against token budgets')
+    dataset_parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    dataset_parser.add_argument('--budget', type=int, nargs='+', default=[0, 100000, 1000000], help='Token budgets, 0 for unlimited')
+    dataset_parser.add_argument('--sampling', nargs='+', default=list(DataSet.SAMPLING_STRATEGIES), choices=DataSet.SAMPLING_STRATEGIES)
+    dataset_parser.add_argument('--validation', type=float, default=0.05, help='Validation fraction')
+    dataset_parser.add_argument('--min-words', type=int, default=2)
+    dataset_parser.add_argument('--min-chars', type=int, default=4)
+    dataset_parser.add_argument('--seed', type=int, default=0)
+    dataset_parser.set_defaults(func=bench_dataset)
+
+    prune_parser = subparsers.add_parser('prune', help='Pruning trained messages: delete and vacuum against dropping a segment')
+    prune_parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000], help='Trained rows to prune')
+    prune_parser.add_argument('--untrained', type=float, default=0.1, help='Rows written after the cutoff, as a fraction of the trained rows')
+    prune_parser.add_argument('--seed', type=int, default=0)
+    prune_parser.add_argument('--skip-legacy', action='store_true', help='Only run the segmented prune')
+    prune_parser.set_defaults(func=bench_prune)
+
+    filter_parser = subparsers.add_parser('filter', help='Blacklist matching against the per-word regex loop')
+    filter_parser.add_argument('--words', type=int, nargs='+', default=[10, 100, 1000])
+    filter_parser.add_argument('--messages', type=int, default=10000)
+    filter_parser.add_argument('--seed', type=int, default=0)
+    filter_parser.add_argument('--skip-legacy', action='store_true', help='Only run the compiled matcher')
+    filter_parser.set_defaults(func=bench_filter)
+
+    startup_parser = subparsers.add_parser('startup', help='Channel startup: per-channel lookups and schema setup against batched, cached, parallel startup')
+    startup_parser.add_argument('--channels', type=int, nargs='+', default=[10, 100, 500])
+    startup_parser.add_argument('--twitch-latency', type=float, default=0.05, help='Seconds added to every stub Twitch lookup')
+    startup_parser.add_argument('--workers', type=int, default=8)
+    startup_parser.add_argument('--handlers', action='store_true', help='Also start real GPTHandlers on a stub bot, which needs retroBot importable')
+    startup_parser.set_defaults(func=bench_startup)
+
+    replay_parser = subparsers.add_parser('replay', help='Replay chat through GPTHandler.on_pubmsg against stand-in OpenAI and Twitch')
+    replay_parser.add_argument('--channels', type=int, default=4)
+    replay_parser.add_argument('--messages', type=int, default=20000)
+    replay_parser.add_argument('--rate', type=float, default=0, help='Messages per second across all channels, 0 for as fast as possible')
+    replay_parser.add_argument('--log', help='Chat log to replay, one "username: message" per line. Synthetic chat is used when omitted')
+    replay_parser.add_argument('--mention-rate', type=float, default=0.01, help='Fraction of synthetic messages that mention the bot and get logged')
+    replay_parser.add_argument('--logging', choices=('off', 'direct', 'queue'), default='queue', help='Log to a file and /dev/null directly from the callback, through the queue pipeline, or not at all')
+    replay_parser.add_argument('--cutoff', type=int, default=2000, help='message_count_cutoff for every channel')
+    replay_parser.add_argument('--generate-on', type=int, default=500)
+    replay_parser.add_argument('--token-budget', type=int, default=0, help='dataset_token_budget for every channel, 0 for unlimited')
+    replay_parser.add_argument('--validation', type=float, default=0, help='dataset_validation_fraction for every channel')
+    replay_parser.add_argument('--openai-latency', type=float, default=0.05, help='Seconds added to every fake OpenAI call')
+    replay_parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of fake OpenAI calls that fail')
+    replay_parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of fake OpenAI calls answered with a 429')
+    replay_parser.add_argument('--idle-timeout', type=float, default=0, help='activation_idle_timeout, 0 to start every channel active')
+    replay_parser.add_argument('--context-messages', type=int, default=0, help='Recent chat buffer size for every channel, 0 to generate without context')
+    replay_parser.add_argument('--ngram', choices=('fallback', 'primary', 'off'), default='fallback', help='n-gram mode for every channel')
+    replay_parser.add_argument('--training-polls', type=int, default=2, help='Polls before a fake fine-tune succeeds')
+    replay_parser.add_argument('--poll-interval', type=float, default=0.05)
+    replay_parser.add_argument('--twitch-latency', type=float, default=0.0, help='Seconds added to every stub Twitch lookup')
+    replay_parser.add_argument('--drain-timeout', type=float, default=30, help='Seconds to wait for fine-tunes to finish after the replay')
+    replay_parser.add_argument('--metrics', action='store_true', help='Enable instrumentation and the metrics endpoint to measure its overhead')
+    replay_parser.add_argument('--seed', type=int, default=0)
+    replay_parser.set_defaults(func=bench_replay)
+
+    context_parser = subparsers.add_parser('context', help='Recent chat buffer: add cost, memory and prompt building against reading the database')
+    context_parser.add_argument('--capacity', type=int, nargs='+', default=[20, 50, 200])
+    context_parser.add_argument('--budget', type=int, nargs='+', default=[128, 512], help='Prompt token budgets')
+    context_parser.add_argument('--messages', type=int, default=100000, help='Messages added to each buffer')
+    context_parser.add_argument('--prompts', type=int, default=2000)
+    context_parser.add_argument('--db-rows', type=int, default=100000, help='Rows in the database read by the comparison')
+    context_parser.add_argument('--seed', type=int, default=0)
+    context_parser.set_defaults(func=bench_context)
+
+    activation_parser = subparsers.add_parser('activation', help='Threads, memory and startup with every channel active against lazy activation')
+    activation_parser.add_argument('--channels', type=int, nargs='+', default=[50, 200])
+    activation_parser.add_argument('--busy', type=float, default=0.1, help='Fraction of channels that get chat')
+    activation_parser.add_argument('--live', type=float, default=0.05, help='Fraction of channels that are live')
+    activation_parser.add_argument('--messages', type=int, default=2000, help='Chat messages spread over the busy channels')
+    activation_parser.add_argument('--resources', type=int, default=0, help='Print the per-channel resource report for this many channels')
+    activation_parser.add_argument('--seed', type=int, default=0)
+    activation_parser.set_defaults(func=bench_activation)
+
+    ngram_parser = subparsers.add_parser('ngram', help='Local n-gram model update cost, generation latency, memory and persistence')
+    ngram_parser.add_argument('--messages', type=int, nargs='+', default=[10000, 100000, 300000])
+    ngram_parser.add_argument('--vocab', type=int, default=20000, help='Distinct words, drawn with Zipf frequencies')
+    ngram_parser.add_argument('--order', type=int, default=2)
+    ngram_parser.add_argument('--batch-size', type=int, default=100, help='Messages per update, as the writer would flush them')
+    ngram_parser.add_argument('--generations', type=int, default=2000)
+    ngram_parser.add_argument('--max-words', type=int, default=64)
+    ngram_parser.add_argument('--seed', type=int, default=0)
+    ngram_parser.set_defaults(func=bench_ngram)
+
+    ratelimit_parser = subparsers.add_parser('ratelimit', help='Concurrent completions against a rate limited fake, direct and through the shared client')
+    ratelimit_parser.add_argument('--requests', type=int, default=400)
+    ratelimit_parser.add_argument('--concurrency', type=int, default=32)
+    ratelimit_parser.add_argument('--server-limit', type=int, default=50, help='Requests the fake allows per window before answering 429')
+    ratelimit_parser.add_argument('--window', type=float, default=1.0, help='Fake rate limit window in seconds')
+    ratelimit_parser.add_argument('--client-share', type=float, default=0.9, help='Fraction of the server limit the client allows itself, 0 to rely on retries alone')
+    ratelimit_parser.add_argument('--retry-after', type=float, default=0.5)
+    ratelimit_parser.add_argument('--max-retries', type=int, default=20)
+    ratelimit_parser.add_argument('--reply-every', type=int, default=10, help='Every nth request is a mention reply')
+    ratelimit_parser.add_argument('--distinct', type=int, default=1000, help='Distinct prompts; fewer means more identical requests to coalesce')
+    ratelimit_parser.add_argument('--openai-latency', type=float, default=0.02)
+    ratelimit_parser.add_argument('--seed', type=int, default=0)
+    ratelimit_parser.add_argument('--skip-legacy', action='store_true', help='Only run the client')
+    ratelimit_parser.set_defaults(func=bench_ratelimit)
+
+    uploads_parser = subparsers.add_parser('uploads', help='Fine-tune retries uploading every attempt against the content-addressed upload cache')
+    uploads_parser.add_argument('--rows', type=int, default=50000, help='New rows per fine-tune round')
+    uploads_parser.add_argument('--rounds', type=int, default=3)
+    uploads_parser.add_argument('--attempts', type=int, default=4, help='Dataset builds and uploads per round, all but the last failing')
+    uploads_parser.add_argument('--validation', type=float, default=0.05, help='Validation fraction')
+    uploads_parser.add_argument('--openai-latency', type=float, default=0.05, help='Seconds added to every fake OpenAI call')
+    uploads_parser.add_argument('--seed', type=int, default=0)
+    uploads_parser.set_defaults(func=bench_uploads)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
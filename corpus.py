@@ -0,0 +1,233 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import resource
+import sys
+import time
+import yaml
+import ChannelDB
+import DataSet
+from Dedup import Deduplicator
+from MessageFilter import MessageFilter, Blacklist
+from MessageStore import MessageStore
+
+# Rows per write transaction, kept small so the bot never waits long on the
+# import's write lock
+BATCH_SIZE = 5000
+REPORT_INTERVAL = 5
+FORMATS = ('auto', 'irc', 'chatlog', 'jsonl', 'plain')
+# Tuned for one long load: fewer fsyncs and a large page cache. The journal
+# stays in WAL so a running bot can keep reading and writing the database.
+INGEST_PRAGMAS = (
+    'PRAGMA synchronous=OFF',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# @tags :user!user@user.tmi.twitch.tv PRIVMSG #channel :message
+IRC_PATTERN = re.compile(r"^(?:@(?P<tags>\S+) )?:(?P<username>[^!\s]+)(?:!\S+)? PRIVMSG #(?P<channel>\S+) :(?P<content>.*)$")
+# [2023-01-01 12:34:56] username: message, [12:34:56] <username> message, username: message
+CHATLOG_PATTERN = re.compile(r"^(?:\[[^\]]*\]\s*)?(?:<(?P<bracketed>[^>\s]+)>\s?|(?P<username>[\w]+):\s)(?P<content>.*)$")
+
+def openInput(filename):
+    if filename == '-':
+        return sys.stdin
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8', errors='replace')
+    return open(filename, 'r', encoding='utf-8', errors='replace')
+
+def detectFormat(line):
+    if IRC_PATTERN.match(line):
+        return 'irc'
+    if line.startswith('{'):
+        return 'jsonl'
+    if CHATLOG_PATTERN.match(line):
+        return 'chatlog'
+    return 'plain'
+
+def parseTags(tags):
+    parsed = {}
+    for tag in tags.split(';'):
+        key, _, value = tag.partition('=')
+        parsed[key] = value
+    return parsed
+
+# Yields (username, message, context) or None for lines that are not chat.
+def parseLine(line, format, channel=None):
+    if format == 'irc':
+        match = IRC_PATTERN.match(line)
+        if not match or (channel and match['channel'].lower() != channel):
+            return None
+        tags = parseTags(match['tags']) if match['tags'] else {}
+        return match['username'], match['content'], {'emotes': tags.get('emotes')}
+    elif format == 'chatlog':
+        match = CHATLOG_PATTERN.match(line)
+        if not match:
+            return None
+        return match['bracketed'] or match['username'], match['content'], {}
+    elif format == 'jsonl':
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        content = record.get('message') or record.get('completion') if isinstance(record, dict) else None
+        return (record.get('username'), content, {}) if content else None
+    return None, line, {}
+
+def parseFiles(filenames, format, channel, stats):
+    for filename in filenames:
+        file_format = None if format == 'auto' else format
+        with openInput(filename) as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                stats['lines'] += 1
+                if file_format == None:
+                    file_format = detectFormat(line)
+                parsed = parseLine(line, file_format, channel)
+                if parsed == None:
+                    stats['unparsed'] += 1
+                    continue
+                yield parsed
+
+def channelConfig(config, channel):
+    settings = dict(config['gpt']['defaults'])
+    for setting, value in ((config['twitch'].get('channels') or {}).get(channel) or {}).items():
+        if value:
+            settings[setting] = value
+    return settings
+
+def loadConfig(filename):
+    with open(filename, 'r') as f:
+        return yaml.safe_load(f)
+
+def report(stats, start, final=False):
+    elapsed = time.perf_counter() - start
+    rate = stats['written'] / elapsed if elapsed > 0 else 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{'done' if final else 'progress'}: {stats['lines']} lines, {stats['written']} rows written, {stats['filtered']} filtered, {stats['deduplicated']} deduplicated, {stats['unparsed']} unparsed in {elapsed:.1f} s ({rate:.0f} rows/s, {rss} KiB max RSS)", file=sys.stderr)
+
+def importCorpus(args):
+    config = loadConfig(args.config)
+    channel = args.channel.lower()
+    settings = channelConfig(config, channel)
+    blacklist_file = config['gpt'].get('blacklist_file')
+    message_filter = MessageFilter(blacklist=Blacklist(blacklist_file) if blacklist_file else None)
+    ignored_users = {user.lower() for user in settings.get('ignored_users') or []}
+    mention = f"@{config['twitch']['username'].lower()}" if config['twitch'].get('username') else None
+    dedup = None if args.no_dedup else Deduplicator(
+        phrase_cap=settings['dedup_phrase_cap'],
+        near_threshold=settings['dedup_near_threshold'],
+        max_signatures=settings['dedup_max_signatures']
+    )
+
+    db_file = ChannelDB.channelDBFile(config, channel)
+    connection = ChannelDB.openChannelDB(db_file, args.db_timeout)
+    for pragma in INGEST_PRAGMAS:
+        connection.execute(pragma)
+    if dedup:
+        dedup.initDB(connection)
+    store = MessageStore(db_file, args.db_timeout)
+
+    stats = dict.fromkeys(('lines', 'unparsed', 'filtered', 'deduplicated', 'written'), 0)
+    start = time.perf_counter()
+    next_report = start + REPORT_INTERVAL
+    batch = []
+
+    def flush():
+        rows = store.importBatch(connection, batch, check=dedup.checkBatch if dedup else None)
+        stats['deduplicated'] += len(batch) - len(rows)
+        stats['written'] += len(rows)
+        batch.clear()
+
+    for username, content, context in parseFiles(args.files, args.format, channel, stats):
+        if username and username.lower() in ignored_users or content[:1] == '!' or mention and mention in content.lower():
+            stats['filtered'] += 1
+            continue
+        message = message_filter.filter(content, **context)
+        if not message:
+            stats['filtered'] += 1
+            continue
+        batch.append(message)
+        if len(batch) >= args.batch_size:
+            flush()
+            if time.perf_counter() >= next_report:
+                report(stats, start)
+                next_report = time.perf_counter() + REPORT_INTERVAL
+    if batch:
+        flush()
+    connection.close()
+    report(stats, start, final=True)
+
+def exportCorpus(args):
+    config = loadConfig(args.config)
+    channel = args.channel.lower()
+    db_file = ChannelDB.channelDBFile(config, channel)
+    if not os.path.exists(db_file):
+        raise SystemExit(f'No message database for {channel} at {db_file}')
+    rows = DataSet.iterRows(db_file, args.db_timeout, start_row=args.start_row, end_row=args.end_row)
+    if args.output == '-':
+        out = sys.stdout.buffer
+    elif args.output.endswith('.gz'):
+        out = gzip.open(args.output, 'wb')
+    else:
+        out = open(args.output, 'wb')
+    start = time.perf_counter()
+    try:
+        if args.builder:
+            settings = channelConfig(config, channel)
+            builder = DataSet.DataSetBuilder(
+                token_budget=settings['dataset_token_budget'],
+                sampling=settings['dataset_sampling'],
+                validation_fraction=0,
+                seed=settings['dataset_seed'],
+                min_words=settings['dataset_min_words'],
+                min_chars=settings['dataset_min_chars']
+            )
+            training, validation, builder_stats = builder.build(rows)
+            with training:
+                while True:
+                    chunk = training.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            count = builder_stats['training_rows']
+        else:
+            count = DataSet.writeJSONL(rows, out)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'done: exported {count} rows in {elapsed:.1f} s ({count / elapsed if elapsed > 0 else 0:.0f} rows/s, {rss} KiB max RSS)', file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import chat logs into a channel database and export training JSONL')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'))
+    parser.add_argument('--db-timeout', type=float, default=30)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='Stream chat logs through the message filters into messages/<channel>.db')
+    import_parser.add_argument('channel')
+    import_parser.add_argument('files', nargs='+', help='Log files, .gz for gzipped input or - for stdin')
+    import_parser.add_argument('--format', choices=FORMATS, default='auto', help='Raw Twitch IRC, "[time] user: message" chat logs, JSONL with a message or completion field, or plain lines')
+    import_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Rows per transaction')
+    import_parser.add_argument('--no-dedup', action='store_true', help='Skip duplicate and copypasta suppression')
+    import_parser.set_defaults(func=importCorpus)
+
+    export_parser = subparsers.add_parser('export', help='Stream stored messages out as training JSONL')
+    export_parser.add_argument('channel')
+    export_parser.add_argument('output', help='Output file, .gz to compress or - for stdout')
+    export_parser.add_argument('--start-row', type=int, default=0, help='Export rows after this one')
+    export_parser.add_argument('--end-row', type=int, help='Export rows up to and including this one')
+    export_parser.add_argument('--builder', action='store_true', help="Apply the channel's dataset builder settings")
+    export_parser.set_defaults(func=exportCorpus)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
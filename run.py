@@ -2,7 +2,12 @@ import openai
 from openai.upload_progress import BufferReader
 import logging
 import datetime
+import hashlib
+import os
 import time
+import yaml
+import ChannelDB
+from UploadCache import UploadCache
 
 
 openai.api_key = ""
@@ -10,6 +15,7 @@ seed = 'who'
 base_model = 'ada'
 api_type = 'open_ai'
 training_file = 'training.jsonl'
+config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
 
 
 def setup_logger(name):
@@ -32,18 +38,19 @@ def upload_file(file = None, content = None):
             with open(file, "rb") as f:
                 content = f.read()
 
+        # Uploading the same bytes again returns the earlier file
+        with open(config_file, 'r') as f:
+            upload_cache_file = ChannelDB.uploadCacheFile(yaml.safe_load(f))
+        ChannelDB.prepareUploadDB(upload_cache_file)
+        upload_cache = UploadCache(upload_cache_file, logger=logger)
         buffer_reader = BufferReader(content, desc="Upload progress")
-        resp = openai.File.create(
-            file=buffer_reader,
-            purpose="fine-tune",
-            user_provided_filename=file,
-        )
+        file_id = upload_cache.upload(buffer_reader, hashlib.sha256(content).hexdigest(), file, len(content))
         logger.info(
             "Uploaded file from {file}: {id}".format(
-                file=file, id=resp["id"]
+                file=file, id=file_id
             )
         )
-        return resp["id"]
+        return file_id
 
 def create_model(training_file, validation_file=None, **kwargs):
     create_args = {"training_file": upload_file(training_file)}
@@ -0,0 +1,192 @@
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+import pytest
+import ChannelDB
+import DataSet
+import FakeOpenAI
+import FineTuneScheduler
+from FineTuneScheduler import FineTuneScheduler as Scheduler, FineTuneJob, ACTIVE_STATES
+from FineTuneTrigger import FineTuneTrigger
+from MessageStore import MessageStore
+
+# A lightweight stand-in for GPTHandler with the same fine tuning calls made
+# against FakeOpenAI, for driving the scheduler on its own.
+class Handler():
+
+    def __init__(self, channel, db_file, fine_tune_job=None, running=None):
+        self.channel = channel
+        self.db_file = db_file
+        self.logger = logging.getLogger(f'test.{channel}')
+        self.fine_tune_trigger = FineTuneTrigger(db_file, 0)
+        self.fine_tune_job = fine_tune_job
+        self.running = running
+        self.prepared = 0
+        self.models = []
+
+    def prepareFineTune(self):
+        self.prepared += 1
+        if self.running != None:
+            self.running.enter()
+        resp = FakeOpenAI.File.create(file=b'{"prompt": "\\n", "completion": " chat\\n"}\n', purpose='fine-tune')
+        self.fine_tune_job = FineTuneJob(resp['id'], DataSet.getLastRow(self.db_file), 1)
+        return self.fine_tune_job
+
+    def createFineTune(self, job):
+        resp = FakeOpenAI.FineTune.create(training_file=job.file_id)
+        job.job_id = resp['id']
+        self.updateFineTuneJob(job, resp['status'])
+        return resp
+
+    def pollFineTune(self, job):
+        resp = FakeOpenAI.FineTune.retrieve(id=job.job_id)
+        if resp['status'] != job.state:
+            self.updateFineTuneJob(job, resp['status'])
+        return resp
+
+    def updateFineTuneJob(self, job, state):
+        job.state = state
+        if state not in ACTIVE_STATES and self.fine_tune_job is job:
+            self.fine_tune_job = None
+
+    def finishFineTune(self, job, resp):
+        self.fine_tune_job = None
+        if self.running != None:
+            self.running.exit()
+        if resp['status'] == 'succeeded':
+            self.fine_tune_trigger.succeeded(job.cutoff_row)
+            self.models.append(resp['fine_tuned_model'])
+            return resp['fine_tuned_model']
+        return None
+
+class Running():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.peak = 0
+
+    def enter(self):
+        with self.lock:
+            self.count += 1
+            self.peak = max(self.peak, self.count)
+
+    def exit(self):
+        with self.lock:
+            self.count -= 1
+
+def waitFor(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+@pytest.fixture(autouse=True)
+def fake_openai():
+    FakeOpenAI.reset(training_polls=2)
+
+@pytest.fixture
+def channel_db(tmp_path):
+    def create(channel, rows=10):
+        db_file = os.path.join(tmp_path, f'{channel}.db')
+        ChannelDB.prepareChannelDB(db_file)
+        store = MessageStore(db_file)
+        connection = ChannelDB.openChannelDB(db_file)
+        store.insert(connection, [f'message {i}' for i in range(rows)])
+        connection.close()
+        return db_file
+    return create
+
+def test_resumes_job_interrupted_by_restart(channel_db):
+    file_id = FakeOpenAI.File.create(file=b'', purpose='fine-tune')['id']
+    job_id = FakeOpenAI.FineTune.create(training_file=file_id)['id']
+    creates = dict(FakeOpenAI.state.calls)
+    # No new rows, so only the saved job makes the channel a candidate
+    handler = Handler('resumed', channel_db('resumed', rows=0), FineTuneJob(file_id, 1, 1, job_id=job_id, state='pending'))
+    scheduler = Scheduler(poll_interval=0.01)
+    scheduler.register(handler)
+    assert waitFor(lambda: handler.models and not scheduler.active)
+    assert handler.prepared == 0
+    assert handler.models == [f'ada:ft-fake-{job_id}']
+    assert FakeOpenAI.state.calls['File.create'] == creates['File.create']
+    assert FakeOpenAI.state.calls['FineTune.create'] == creates['FineTune.create']
+    assert handler.fine_tune_job == None
+
+def test_failed_preparation_backs_off(channel_db, monkeypatch):
+    delays = []
+    monkeypatch.setattr(FineTuneScheduler, 'time', type('Time', (), {'sleep': staticmethod(delays.append), 'monotonic': staticmethod(time.monotonic)}))
+    FakeOpenAI.reset(failure_rate=1.0)
+    handler = Handler('failing', channel_db('failing'))
+    scheduler = Scheduler(poll_interval=0.01)
+    scheduler.register(handler)
+    assert waitFor(lambda: handler.fine_tune_trigger.failures == 1 and not scheduler.active)
+    assert delays == [FineTuneScheduler.retryDelay(attempt) for attempt in range(1, FineTuneScheduler.RETRY_ATTEMPTS)]
+    assert delays == [5, 10, 20, 40]
+    assert handler.fine_tune_trigger.retry_at > time.monotonic() + handler.fine_tune_trigger.backoff_base - 5
+    assert not handler.fine_tune_trigger.isReady()
+    # Nothing is retried before the backoff runs out
+    time.sleep(0.2)
+    assert handler.prepared == FineTuneScheduler.RETRY_ATTEMPTS
+
+def test_retry_delay_is_capped():
+    assert [FineTuneScheduler.retryDelay(failures) for failures in range(1, 9)] == [5, 10, 20, 40, 80, 160, 300, 300]
+
+def test_job_cap_holds_across_channels(channel_db):
+    FakeOpenAI.reset(training_polls=5)
+    running = Running()
+    handlers = [Handler(f'channel{i}', channel_db(f'channel{i}'), running=running) for i in range(4)]
+    scheduler = Scheduler(max_jobs=2, poll_interval=0.01)
+    for handler in handlers:
+        scheduler.register(handler)
+    assert waitFor(lambda: all(handler.models for handler in handlers) and not scheduler.active)
+    assert running.peak == 2
+    assert FakeOpenAI.state.calls['FineTune.create'] == 4
+
+def test_missing_job_releases_its_slot(channel_db):
+    missing = Handler('missing', channel_db('missing', rows=0), FineTuneJob('file-0', 1, 1, job_id='ft-deleted', state='running'))
+    waiting = Handler('waiting', channel_db('waiting'))
+    scheduler = Scheduler(max_jobs=1, poll_interval=0.01)
+    scheduler.register(missing)
+    scheduler.register(waiting)
+    assert waitFor(lambda: waiting.models and not scheduler.active)
+    assert FakeOpenAI.state.calls['FineTune.retrieve'] >= 1
+    assert missing.fine_tune_job == None
+    assert missing.models == []
+
+def test_handler_resumes_persisted_job(tmp_path):
+    pytest.importorskip('retroBot')
+    import benchmark
+    from GPTHandler import GPTHandler
+    args = argparse.Namespace(channels=1, poll_interval=0.01, metrics=False, idle_timeout=0, cutoff=1000000, generate_on=1000000, token_budget=0, validation=0, ngram='off', context_messages=0)
+    config = benchmark.replay_config(args, str(tmp_path))
+    # A cutoff the first bot never reaches, so only the saved job starts a fine tune
+    first = GPTHandler('channel0', benchmark.stub_bot(config, benchmark.StubTwitch()))
+    for i in range(50):
+        first.writer.write(f'chat message number {i} for the dataset')
+    first.writer.close()
+    first.parent.fine_tune_scheduler.unregister(first)
+    job = first.prepareFineTune()
+    first.createFineTune(job)
+    assert job.state == 'pending'
+    calls = dict(FakeOpenAI.state.calls)
+
+    # The first bot stops polling here, as if it was restarted mid job
+    second = GPTHandler('channel0', benchmark.stub_bot(config, benchmark.StubTwitch()))
+    assert second.fine_tune_job != None
+    assert (second.fine_tune_job.id, second.fine_tune_job.job_id) == (job.id, job.job_id)
+    assert waitFor(lambda: second.fine_tune_job == None and second.model != first.model)
+    assert second.model == f'ada:ft-fake-{job.job_id}'
+    assert waitFor(lambda: second.fine_tune_trigger.watermark == job.cutoff_row)
+    connection = sqlite3.connect(second.db_file)
+    assert connection.execute("select value from state where key = 'last_trained_row'").fetchone()[0] == job.cutoff_row
+    assert connection.execute('select state from fine_tunes where id = ?', (job.id,)).fetchone()[0] == 'succeeded'
+    connection.close()
+    assert FakeOpenAI.state.calls['File.create'] == calls['File.create']
+    assert FakeOpenAI.state.calls['FineTune.create'] == calls['FineTune.create']
+    assert FakeOpenAI.state.calls['FineTune.retrieve'] > calls.get('FineTune.retrieve', 0)
+    second.writer.close()
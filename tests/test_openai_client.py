@@ -0,0 +1,144 @@
+import threading
+import time
+import pytest
+import FakeOpenAI
+from OpenAIClient import OpenAIClient as Client, TokenBucket, PRIORITY_REPLY, PRIORITY_CHATTER
+
+@pytest.fixture(autouse=True)
+def fake_openai():
+    FakeOpenAI.reset()
+
+def rateLimitedOnce(retry_after):
+    calls = []
+    def request(**kwargs):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise FakeOpenAI.RateLimitError('Rate limit reached', http_status=429, headers={'retry-after': str(retry_after)})
+        return 'ok'
+    return request, calls
+
+def test_retry_after_is_honoured():
+    client = Client(retry_base=0.01)
+    request, calls = rateLimitedOnce(0.3)
+    assert client.request(request) == 'ok'
+    assert len(calls) == 2
+    assert 0.3 <= calls[1] - calls[0] < 0.5
+    stats = client.getStats()
+    assert (stats['retries'], stats['rate_limited'], stats['failed']) == (1, 1, 0)
+
+def test_rate_limit_pauses_other_callers():
+    client = Client(retry_base=0.01)
+    request, calls = rateLimitedOnce(0.3)
+    thread = threading.Thread(target=client.request, args=(request,))
+    thread.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    client.request(lambda: None)
+    assert time.monotonic() - start >= 0.2
+    thread.join()
+
+def test_retries_through_fake_server_limit():
+    FakeOpenAI.reset(rate_limit=2, rate_window=0.2, retry_after=0.2)
+    client = Client(retry_base=0.01)
+    texts = [client.completion(model='ada', prompt=f'prompt {i}', max_tokens=4).choices[0].text for i in range(5)]
+    assert len(texts) == 5
+    assert FakeOpenAI.state.calls['rate_limited'] >= 1
+    assert client.getStats()['failed'] == 0
+
+def test_retry_after_past_deadline_raises():
+    client = Client(retry_base=0.01)
+    request, calls = rateLimitedOnce(5)
+    with pytest.raises(FakeOpenAI.RateLimitError):
+        client.request(request, timeout=1)
+    assert len(calls) == 1
+
+def test_token_bucket_wait():
+    bucket = TokenBucket(60, burst_seconds=2)
+    now = bucket.updated
+    assert bucket.capacity == 2
+    assert bucket.wait(1, now) == 0
+    bucket.take(2)
+    assert bucket.wait(1, now) == pytest.approx(1.0)
+    assert bucket.wait(1, now + 0.5) == pytest.approx(0.5)
+    # More than the bucket holds waits for it to fill
+    assert bucket.wait(10, now + 0.5) == pytest.approx(1.5)
+
+def test_request_bucket_spaces_requests():
+    client = Client(requests_per_minute=600, burst_seconds=0.1)
+    start = time.monotonic()
+    for i in range(5):
+        client.request(lambda: None)
+    # One request of burst, then one every 0.1 s
+    assert time.monotonic() - start >= 0.35
+    assert client.getStats()['wait_seconds_total'] >= 0.35
+
+def test_token_bucket_limits_large_requests():
+    client = Client(tokens_per_minute=6000, burst_seconds=1)
+    start = time.monotonic()
+    client.request(lambda: None, tokens=100)
+    client.request(lambda: None, tokens=50)
+    assert time.monotonic() - start >= 0.45
+
+def test_bucket_wait_past_deadline_times_out():
+    client = Client(requests_per_minute=60, burst_seconds=1)
+    client.request(lambda: None)
+    with pytest.raises(FakeOpenAI.Timeout):
+        client.request(lambda: None, timeout=0.2)
+
+def test_reply_goes_ahead_of_waiting_chatter():
+    client = Client(requests_per_minute=600, burst_seconds=0.1)
+    client.request(lambda: None)
+    order = []
+    threads = [threading.Thread(target=client.request, args=(order.append, 'chatter'), kwargs={'priority': PRIORITY_CHATTER}) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.02)
+    reply = threading.Thread(target=client.request, args=(order.append, 'reply'), kwargs={'priority': PRIORITY_REPLY})
+    reply.start()
+    for thread in threads + [reply]:
+        thread.join()
+    assert order[0] == 'reply'
+
+def test_identical_completions_are_coalesced():
+    FakeOpenAI.reset(latency=0.2)
+    client = Client()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.completion(model='ada', prompt='same', max_tokens=4))) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakeOpenAI.state.calls['Completion.create'] == 1
+    assert all(result is results[0] for result in results)
+    assert client.getStats()['coalesced'] == 4
+
+def test_different_completions_are_not_coalesced():
+    FakeOpenAI.reset(latency=0.1)
+    client = Client()
+    threads = [threading.Thread(target=client.completion, kwargs={'model': 'ada', 'prompt': f'prompt {i}', 'max_tokens': 4}) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakeOpenAI.state.calls['Completion.create'] == 3
+    assert client.getStats()['coalesced'] == 0
+
+def test_coalesced_callers_share_a_failure():
+    FakeOpenAI.reset(latency=0.2)
+    client = Client(max_retries=0)
+    errors = []
+    def failing(**kwargs):
+        time.sleep(0.2)
+        raise FakeOpenAI.InvalidRequestError('bad request', http_status=400)
+    def call():
+        try:
+            client.request(failing, coalesce=True, prompt='same')
+        except FakeOpenAI.InvalidRequestError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=call) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+    assert client.getStats()['requests'] == 1
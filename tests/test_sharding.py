@@ -0,0 +1,33 @@
+import os
+import threading
+from Sharding import Supervisor
+
+# Leaves the process without releasing its slot, as a crash mid job would
+def dieHoldingSlot(slots, shard, channel):
+    slots.bind(shard)
+    slots.acquire(channel)
+    os._exit(1)
+
+def test_supervisor_reclaims_slot_of_dead_shard():
+    config = {'gpt': {'fine_tune_max_jobs': 1}, 'twitch': {'channels': {'channel0': {}, 'channel1': {}}}}
+    supervisor = Supervisor(config, 2)
+    slots = supervisor.fine_tune_slots
+    process = supervisor.context.Process(target=dieHoldingSlot, args=(slots, 0, 'channel0'))
+    process.start()
+    process.join(30)
+    assert process.exitcode == 1
+    supervisor.processes[0] = process
+
+    slots.bind(1)
+    acquired = threading.Event()
+    def acquire():
+        slots.acquire('channel1')
+        acquired.set()
+    threading.Thread(target=acquire, daemon=True).start()
+    assert not acquired.wait(0.5)
+
+    supervisor.checkShards()
+    assert acquired.wait(10)
+    assert 0 in supervisor.restart_at
+    slots.release('channel1')
+    assert list(slots.shards) == [-1]